@@ -0,0 +1,620 @@
+# Copyright 2023-, Semiotic AI, Inc.
+# SPDX-License-Identifier: Apache-2.0
+
+"""Offline evaluation of Agora cost models, to replay logged queries against a
+generated model.
+
+Supports the subset of Agora used by the AutoAgora models and typical manual
+entries:
+
+- `<query> [when <condition>] => <cost>;` statements, where `<query>` is a GraphQL
+  query whose arguments are either constants or `$captures`, and
+- `default [when <condition>] => <cost>;` statements,
+
+with arithmetic (`+ - * /`), comparison and boolean (`&& || !`) expressions over
+numbers, booleans, captures and model variables.
+
+Each root field of a query is priced by the first statement, in model order, that
+has a root field matching it, and the query's price is the sum of its root fields'.
+A statement root field matches a query field of the same name if all its arguments
+are present with the same values (objects matching as subsets), and all its
+sub-selections match one of the query field's sub-selections. To avoid scanning
+the whole model for every field, the statements are indexed by root field name.
+"""
+
+import re
+import time
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import graphql
+from graphql import language
+
+from autoagora.utils.constants import DEFAULT_AGORA_VARIABLES
+
+Expression = Callable[[Dict[str, Any]], Any]
+
+
+@dataclass(frozen=True)
+class _Capture:
+    name: str
+
+
+@dataclass
+class _FieldPattern:
+    """Precompiled statement field."""
+
+    name: str
+    arguments: List[Tuple[str, Any]]
+    selections: List["_FieldPattern"]
+
+
+@dataclass
+class _QueryField:
+    """Query field, with the fragments of its sub-selections inlined."""
+
+    name: str
+    arguments: Dict[str, language.ValueNode]
+    selections: List["_QueryField"]
+
+
+@dataclass
+class _Statement:
+    index: int
+    # None for `default` statements
+    fields: Optional[List[_FieldPattern]]
+    condition: Optional[Expression]
+    cost: Expression
+
+
+@dataclass
+class ReplayStats:
+    """Prices and matching statistics of replayed queries."""
+
+    # Number of replayed queries
+    queries: int = 0
+    # Queries without a price: a root field matched no statement, or the matching
+    # statement could not be evaluated.
+    unpriced: int = 0
+    # Number of root fields priced, and of those priced by a `default` statement
+    root_fields: int = 0
+    default_root_fields: int = 0
+    # Root fields priced by each statement, by statement index in the model
+    statement_matches: Counter = field(default_factory=Counter)
+    # Price of each priced query, in replay order
+    costs: List[float] = field(default_factory=list)
+    # Time spent pricing the queries, parsing included
+    evaluation_seconds: float = 0.0
+
+    @property
+    def priced_share(self) -> float:
+        return (self.queries - self.unpriced) / self.queries if self.queries else 0.0
+
+    @property
+    def default_share(self) -> float:
+        """Share of the priced root fields that only a `default` statement
+        matched."""
+        return self.default_root_fields / self.root_fields if self.root_fields else 0.0
+
+
+#
+# Model text
+#
+
+
+def _strip_comments(text: str) -> str:
+    stripped = []
+    in_string = False
+    in_comment = False
+    escaped = False
+    for char in text:
+        if in_comment:
+            if char == "\n":
+                in_comment = False
+                stripped.append(char)
+            continue
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == "#":
+            in_comment = True
+            continue
+        stripped.append(char)
+    return "".join(stripped)
+
+
+def _split_outside_strings(text: str, separator: str) -> List[str]:
+    parts = []
+    start = 0
+    in_string = False
+    escaped = False
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif text.startswith(separator, i):
+            parts.append(text[start:i])
+            i += len(separator)
+            start = i
+            continue
+        i += 1
+    parts.append(text[start:])
+    return parts
+
+
+def _query_end(text: str) -> int:
+    """Index right after the closing brace of the GraphQL query at the start of
+    `text`."""
+    depth = 0
+    in_string = False
+    escaped = False
+    for i, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+            if depth == 0:
+                return i + 1
+    raise ValueError(f"Unbalanced braces in Agora statement: {text}")
+
+
+#
+# Expressions
+#
+
+_TOKEN_RE = re.compile(
+    r"\s*(?:"
+    r"(?P<number>\d+(?:\.\d*)?(?:[eE][+-]?\d+)?|\.\d+(?:[eE][+-]?\d+)?)"
+    r"|\$(?P<variable>[A-Za-z_]\w*)"
+    r"|(?P<boolean>true|false)\b"
+    r"|(?P<operator>&&|\|\||==|!=|<=|>=|[-+*/()<>!])"
+    r")"
+)
+
+_BINARY_OPERATORS: Dict[str, Callable[[Any, Any], Any]] = {
+    "||": lambda a, b: a or b,
+    "&&": lambda a, b: a and b,
+    "==": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    "<": lambda a, b: a < b,
+    ">": lambda a, b: a > b,
+    "<=": lambda a, b: a <= b,
+    ">=": lambda a, b: a >= b,
+    "+": lambda a, b: a + b,
+    "-": lambda a, b: a - b,
+    "*": lambda a, b: a * b,
+    "/": lambda a, b: a / b,
+}
+
+# Binary operators by increasing precedence
+_PRECEDENCE_LEVELS: Sequence[Sequence[str]] = (
+    ("||",),
+    ("&&",),
+    ("==", "!=", "<", ">", "<=", ">="),
+    ("+", "-"),
+    ("*", "/"),
+)
+
+
+def _tokenize(text: str) -> List[Tuple[str, str]]:
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = _TOKEN_RE.match(text, position)
+        if match is None or match.end() == position:
+            raise ValueError(f"Invalid Agora expression: {text}")
+        kind = match.lastgroup
+        assert kind is not None
+        tokens.append((kind, match.group(kind)))
+        position = match.end()
+    return tokens
+
+
+class _ExpressionParser:
+    """Recursive descent parser compiling an Agora expression into a closure over
+    the variables."""
+
+    def __init__(self, text: str):
+        self.text = text
+        self.tokens = _tokenize(text)
+        self.position = 0
+
+    def parse(self) -> Expression:
+        expression = self._binary(0)
+        if self.position != len(self.tokens):
+            raise ValueError(f"Invalid Agora expression: {self.text}")
+        return expression
+
+    def _peek(self) -> Optional[Tuple[str, str]]:
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def _next(self) -> Tuple[str, str]:
+        token = self._peek()
+        if token is None:
+            raise ValueError(f"Unexpected end of Agora expression: {self.text}")
+        self.position += 1
+        return token
+
+    def _binary(self, level: int) -> Expression:
+        if level == len(_PRECEDENCE_LEVELS):
+            return self._unary()
+        left = self._binary(level + 1)
+        while True:
+            token = self._peek()
+            if token is None or token[1] not in _PRECEDENCE_LEVELS[level]:
+                return left
+            self.position += 1
+            right = self._binary(level + 1)
+            left = (
+                lambda operator, left, right: lambda variables: operator(
+                    left(variables), right(variables)
+                )
+            )(_BINARY_OPERATORS[token[1]], left, right)
+
+    def _unary(self) -> Expression:
+        token = self._peek()
+        if token == ("operator", "-"):
+            self.position += 1
+            operand = self._unary()
+            return lambda variables: -operand(variables)
+        if token == ("operator", "!"):
+            self.position += 1
+            operand = self._unary()
+            return lambda variables: not operand(variables)
+        return self._primary()
+
+    def _primary(self) -> Expression:
+        kind, value = self._next()
+        if kind == "number":
+            number = float(value)
+            return lambda variables: number
+        if kind == "boolean":
+            boolean = value == "true"
+            return lambda variables: boolean
+        if kind == "variable":
+            return lambda variables: variables[value]
+        if value == "(":
+            expression = self._binary(0)
+            if self._next() != ("operator", ")"):
+                raise ValueError(f"Unbalanced parentheses in: {self.text}")
+            return expression
+        raise ValueError(f"Unexpected {value!r} in Agora expression: {self.text}")
+
+
+def compile_expression(text: str) -> Expression:
+    """Compiles an Agora cost or condition expression.
+
+    Args:
+        text (str): Expression, such as `$count * 0.1 * $GLOBAL_COST_MULTIPLIER`.
+
+    Returns:
+        Expression: Function evaluating the expression given the variables (without
+            the `$` prefix). Raises `KeyError` on undefined variables.
+    """
+    return _ExpressionParser(text).parse()
+
+
+#
+# GraphQL
+#
+
+
+def _pattern_value(node: language.ValueNode) -> Any:
+    """Converts a statement argument value, with variables as captures."""
+    if isinstance(node, language.VariableNode):
+        return _Capture(node.name.value)
+    if isinstance(node, language.ListValueNode):
+        return [_pattern_value(value) for value in node.values]
+    if isinstance(node, language.ObjectValueNode):
+        return {field.name.value: _pattern_value(field.value) for field in node.fields}
+    return graphql.value_from_ast_untyped(node)
+
+
+def _field_pattern(node: language.FieldNode) -> _FieldPattern:
+    return _FieldPattern(
+        name=node.name.value,
+        arguments=[
+            (argument.name.value, _pattern_value(argument.value))
+            for argument in node.arguments or ()
+        ],
+        selections=[
+            _field_pattern(selection)
+            for selection in (
+                node.selection_set.selections if node.selection_set else ()
+            )
+            if isinstance(selection, language.FieldNode)
+        ],
+    )
+
+
+def _query_fields(
+    selection_set: Optional[language.SelectionSetNode],
+    fragments: Dict[str, language.FragmentDefinitionNode],
+) -> List[_QueryField]:
+    fields = []
+    for selection in selection_set.selections if selection_set else ():
+        if isinstance(selection, language.FieldNode):
+            fields.append(
+                _QueryField(
+                    name=selection.name.value,
+                    arguments={
+                        argument.name.value: argument.value
+                        for argument in selection.arguments or ()
+                    },
+                    selections=_query_fields(selection.selection_set, fragments),
+                )
+            )
+        elif isinstance(selection, language.InlineFragmentNode):
+            fields += _query_fields(selection.selection_set, fragments)
+        elif isinstance(selection, language.FragmentSpreadNode):
+            fragment = fragments.get(selection.name.value)
+            if fragment is None:
+                raise ValueError(f"Unknown fragment: {selection.name.value}")
+            fields += _query_fields(fragment.selection_set, fragments)
+    return fields
+
+
+@lru_cache(maxsize=10_000)
+def _parse_query(query: str) -> Tuple[_QueryField, ...]:
+    """Root fields of a query, memoized since the logged queries share their
+    skeletons."""
+    document = graphql.parse(query)
+    operations = [
+        definition
+        for definition in document.definitions
+        if isinstance(definition, language.OperationDefinitionNode)
+    ]
+    if len(operations) != 1:
+        raise ValueError("Expected a single GraphQL operation.")
+    fragments = {
+        definition.name.value: definition
+        for definition in document.definitions
+        if isinstance(definition, language.FragmentDefinitionNode)
+    }
+    return tuple(_query_fields(operations[0].selection_set, fragments))
+
+
+def _match_value(pattern: Any, value: Any, captures: Dict[str, Any]) -> bool:
+    if isinstance(pattern, _Capture):
+        if pattern.name in captures:
+            return captures[pattern.name] == value
+        captures[pattern.name] = value
+        return True
+    if isinstance(pattern, dict):
+        return isinstance(value, dict) and all(
+            key in value and _match_value(sub_pattern, value[key], captures)
+            for key, sub_pattern in pattern.items()
+        )
+    if isinstance(pattern, list):
+        return (
+            isinstance(value, list)
+            and len(pattern) == len(value)
+            and all(
+                _match_value(sub_pattern, sub_value, captures)
+                for sub_pattern, sub_value in zip(pattern, value)
+            )
+        )
+    return pattern == value
+
+
+def _match_field(
+    pattern: _FieldPattern,
+    query_field: _QueryField,
+    variables: Dict[str, Any],
+    captures: Dict[str, Any],
+) -> bool:
+    if pattern.name != query_field.name:
+        return False
+    for name, value_pattern in pattern.arguments:
+        node = query_field.arguments.get(name)
+        if node is None:
+            return False
+        value = graphql.value_from_ast_untyped(node, variables)
+        if not _match_value(value_pattern, value, captures):
+            return False
+    for sub_pattern in pattern.selections:
+        for sub_field in query_field.selections:
+            sub_captures = dict(captures)
+            if _match_field(sub_pattern, sub_field, variables, sub_captures):
+                captures.update(sub_captures)
+                break
+        else:
+            return False
+    return True
+
+
+#
+# Model
+#
+
+
+class AgoraModel:
+    """Precompiled Agora cost model.
+
+    Args:
+        model (str): Agora model text, such as the output of
+            `model_builder.build_template`.
+        variables (Optional[Dict[str, Any]], optional): Model variables. Defaults
+            to `DEFAULT_AGORA_VARIABLES` with a `GLOBAL_COST_MULTIPLIER` of 1.
+    """
+
+    def __init__(self, model: str, variables: Optional[Dict[str, Any]] = None):
+        if variables is None:
+            variables = {**DEFAULT_AGORA_VARIABLES, "GLOBAL_COST_MULTIPLIER": 1}
+        self.variables = variables
+        self.statements: List[_Statement] = []
+        # Statements with a root field of that name, in model order
+        self._index: Dict[
+            str, List[Tuple[_Statement, Optional[_FieldPattern]]]
+        ] = defaultdict(list)
+        self._defaults: List[_Statement] = []
+        # Candidate statements by root field name, `default` statements merged in
+        self._candidates: Dict[
+            str, List[Tuple[_Statement, Optional[_FieldPattern]]]
+        ] = dict()
+
+        for text in _split_outside_strings(_strip_comments(model), ";"):
+            if text.strip():
+                self._add_statement(text.strip())
+
+    def _add_statement(self, text: str):
+        parts = _split_outside_strings(text, "=>")
+        if len(parts) != 2:
+            raise ValueError(f"Invalid Agora statement: {text}")
+        match, cost = (part.strip() for part in parts)
+
+        if match.startswith("default"):
+            fields = None
+            condition_text = match[len("default") :].strip()
+        else:
+            query_end = _query_end(match)
+            document = graphql.parse(match[:query_end])
+            operation = document.definitions[0]
+            assert isinstance(operation, language.OperationDefinitionNode)
+            fields = [
+                _field_pattern(selection)
+                for selection in operation.selection_set.selections
+                if isinstance(selection, language.FieldNode)
+            ]
+            condition_text = match[query_end:].strip()
+
+        if condition_text:
+            if not condition_text.startswith("when"):
+                raise ValueError(f"Invalid Agora statement: {text}")
+            condition = compile_expression(condition_text[len("when") :])
+        else:
+            condition = None
+
+        statement = _Statement(
+            index=len(self.statements),
+            fields=fields,
+            condition=condition,
+            cost=compile_expression(cost),
+        )
+        self.statements.append(statement)
+        if fields is None:
+            self._defaults.append(statement)
+        else:
+            for field_pattern in fields:
+                self._index[field_pattern.name].append((statement, field_pattern))
+
+    def _candidate_statements(
+        self, name: str
+    ) -> List[Tuple[_Statement, Optional[_FieldPattern]]]:
+        candidates = self._candidates.get(name)
+        if candidates is None:
+            candidates = list(self._index.get(name, []))
+            candidates += [(statement, None) for statement in self._defaults]
+            candidates.sort(key=lambda candidate: candidate[0].index)
+            self._candidates[name] = candidates
+        return candidates
+
+    def _price_field(
+        self, query_field: _QueryField, variables: Dict[str, Any]
+    ) -> Optional[Tuple[_Statement, float]]:
+        for statement, field_pattern in self._candidate_statements(query_field.name):
+            captures: Dict[str, Any] = dict()
+            if field_pattern is not None and not _match_field(
+                field_pattern, query_field, variables, captures
+            ):
+                continue
+            scope = {**self.variables, **captures}
+            if statement.condition is not None and not statement.condition(scope):
+                continue
+            return statement, float(statement.cost(scope))
+        return None
+
+    def cost(
+        self, query: str, variables: Optional[Dict[str, Any]] = None
+    ) -> Optional[float]:
+        """Prices a query.
+
+        Args:
+            query (str): GraphQL query.
+            variables (Optional[Dict[str, Any]], optional): Query variables.
+                Defaults to None.
+
+        Returns:
+            Optional[float]: The query's price, or None if a root field of the
+                query matches no statement.
+        """
+        priced_fields = self._price_query(query, variables)
+        if priced_fields is None:
+            return None
+        return sum(cost for _, cost in priced_fields)
+
+    def _price_query(
+        self, query: str, variables: Optional[Dict[str, Any]]
+    ) -> Optional[List[Tuple[_Statement, float]]]:
+        priced_fields = []
+        for query_field in _parse_query(query):
+            priced_field = self._price_field(query_field, variables or {})
+            if priced_field is None:
+                return None
+            priced_fields.append(priced_field)
+        return priced_fields
+
+    def replay(
+        self, queries: Iterable[Tuple[str, Optional[Dict[str, Any]]]]
+    ) -> ReplayStats:
+        """Prices queries, and collects matching statistics.
+
+        Queries that fail to parse, or whose matching statement fails to evaluate,
+        are counted as unpriced.
+
+        Args:
+            queries (Iterable[Tuple[str, Optional[Dict[str, Any]]]]): Queries and
+                their variables, such as collected beforehand from the
+                asynchronous iterator `LogsDB.iter_logged_queries`.
+
+        Returns:
+            ReplayStats: Prices and matching statistics.
+        """
+        stats = ReplayStats()
+        for query, variables in queries:
+            stats.queries += 1
+            start = time.perf_counter()
+            try:
+                priced_fields = self._price_query(query, variables)
+            except (graphql.GraphQLError, ValueError, KeyError, ArithmeticError):
+                priced_fields = None
+            stats.evaluation_seconds += time.perf_counter() - start
+
+            if priced_fields is None:
+                stats.unpriced += 1
+                continue
+            for statement, _ in priced_fields:
+                stats.root_fields += 1
+                stats.statement_matches[statement.index] += 1
+                if statement.fields is None:
+                    stats.default_root_fields += 1
+            stats.costs.append(sum(cost for _, cost in priced_fields))
+        return stats
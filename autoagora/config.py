@@ -98,7 +98,69 @@ def init_config(argv: Optional[Sequence[str]] = None):
         type=int,
         env_var="POSTGRES_MAX_CONNECTIONS",
         required=False,
-        help="Maximum postgres connections (internal pool).",
+        help="Maximum postgres connections of the pool used by the price "
+        "multiplier save states (internal pool).",
+    )
+    argparser_database_group.add_argument(
+        "--postgres-analytics-max-connections",
+        default=1,
+        type=int,
+        env_var="POSTGRES_ANALYTICS_MAX_CONNECTIONS",
+        required=False,
+        help="Maximum postgres connections of the pool used by the relative query "
+        "costs model builds, separate from the price multiplier save states' pool so "
+        "that long query logs aggregations do not delay them. Each model build holds "
+        "a connection for its whole aggregation, which the rebuild checks and the "
+        "rollup updates wait for: allow a connection per concurrent build "
+        "(1 with --relative-query-costs-bulk, up to the number of allocated subgraphs "
+        "otherwise), plus one for the rebuild checks.",
+    )
+    argparser_database_group.add_argument(
+        "--postgres-maintenance-max-connections",
+        default=2,
+        type=int,
+        env_var="POSTGRES_MAINTENANCE_MAX_CONNECTIONS",
+        required=False,
+        help="Maximum postgres connections of the pool used by the query logs "
+        "ingestion, the query_logs partitions maintenance, the rollup compaction and "
+        "the index builds, separate from the model builds' pool so that neither "
+        "delays the other. The ingestion holds a connection while writing each "
+        "batch: allow one more for the maintenance tasks.",
+    )
+    argparser_database_group.add_argument(
+        "--postgres-max-idle",
+        default=600,
+        type=float,
+        env_var="POSTGRES_MAX_IDLE",
+        required=False,
+        help="Seconds after which idle postgres connections are closed, down to one "
+        "connection per pool. Connections are opened on demand, up to the pools' "
+        "maximum sizes.",
+    )
+    argparser_database_group.add_argument(
+        "--postgres-replica-host",
+        env_var="POSTGRES_REPLICA_HOST",
+        required=False,
+        help="Host of a read replica of the postgres instance, to run the relative "
+        "query costs query logs aggregations on. Uses the same database and "
+        "credentials. Defaults to none (primary only).",
+    )
+    argparser_database_group.add_argument(
+        "--postgres-replica-port",
+        env_var="POSTGRES_REPLICA_PORT",
+        required=False,
+        type=int,
+        help="Port of the postgres read replica. Defaults to --postgres-port.",
+    )
+    argparser_database_group.add_argument(
+        "--postgres-replica-max-lag",
+        env_var="POSTGRES_REPLICA_MAX_LAG",
+        required=False,
+        type=float,
+        default=300,
+        help="Replication lag, in seconds, above which the query logs aggregations "
+        "fall back to the primary. The aggregations also fall back to the primary "
+        "while the replica is unreachable.",
     )
 
     #
@@ -147,6 +209,18 @@ def init_config(argv: Optional[Sequence[str]] = None):
         Format: <scheme>://<service_name>:<pod_metrics_port>/<path>.
         """,
     )
+    argparser.add_argument(
+        "--indexer-service-metrics-k8s-endpoint-slices",
+        env_var="INDEXER_SERVICE_METRICS_K8S_ENDPOINT_SLICES",
+        required=False,
+        action="store_true",
+        help="""
+        Watch the EndpointSlices of the --indexer-service-metrics-k8s-service rather
+        than its Endpoints, which are truncated to 1000 addresses and shipped whole on
+        every change. Requires the list and watch permissions on the
+        discovery.k8s.io endpointslices.
+        """,
+    )
 
     #
     # Price multiplier (Absolute price)
@@ -189,6 +263,303 @@ def init_config(argv: Optional[Sequence[str]] = None):
         default=3600,
         help="(Seconds) Interval between rebuilds of the relative query costs models.",
     )
+    argparser_relative_query_costs.add_argument(
+        "--relative-query-costs-top-k",
+        env_var="RELATIVE_QUERY_COSTS_TOP_K",
+        required=False,
+        type=int,
+        default=None,
+        help="Maximum number of query skeletons, the most frequent ones, priced in each "
+        "relative query costs model. Defaults to no limit.",
+    )
+    argparser_relative_query_costs.add_argument(
+        "--relative-query-costs-coverage",
+        env_var="RELATIVE_QUERY_COSTS_COVERAGE",
+        required=False,
+        type=float,
+        default=None,
+        help="Only price the most frequent query skeletons needed to cover this "
+        "fraction (between 0 and 1) of a subgraph's queries in its relative query "
+        "costs model. Defaults to no limit.",
+    )
+    argparser_relative_query_costs.add_argument(
+        "--relative-query-costs-max-entries",
+        env_var="RELATIVE_QUERY_COSTS_MAX_ENTRIES",
+        required=False,
+        type=int,
+        default=None,
+        help="Maximum number of query skeleton statements in a relative query costs "
+        "model. The statements covering the most of the "
+        "--relative-query-costs-budget-objective are kept. Defaults to no limit.",
+    )
+    argparser_relative_query_costs.add_argument(
+        "--relative-query-costs-max-bytes",
+        env_var="RELATIVE_QUERY_COSTS_MAX_BYTES",
+        required=False,
+        type=int,
+        default=None,
+        help="(Bytes) Maximum total size of the query skeletons priced in a relative "
+        "query costs model. The statements covering the most of the "
+        "--relative-query-costs-budget-objective per byte are kept. Defaults to no "
+        "limit.",
+    )
+    argparser_relative_query_costs.add_argument(
+        "--relative-query-costs-budget-objective",
+        env_var="RELATIVE_QUERY_COSTS_BUDGET_OBJECTIVE",
+        required=False,
+        type=str,
+        choices=["count", "revenue"],
+        default="count",
+        help="What the statements kept within the relative query costs model budget "
+        "should cover the most of: the number of queries, or the revenue (number of "
+        "queries times priced query time).",
+    )
+    argparser_relative_query_costs.add_argument(
+        "--relative-query-costs-long-tail",
+        env_var="RELATIVE_QUERY_COSTS_LONG_TAIL",
+        action="store_true",
+        help="Also price the query skeletons too infrequent to get their own "
+        "statement, with a generic statement per root field whose cost is fitted to "
+        "their query times.",
+    )
+    argparser_relative_query_costs.add_argument(
+        "--relative-query-costs-long-tail-min-count",
+        env_var="RELATIVE_QUERY_COSTS_LONG_TAIL_MIN_COUNT",
+        required=False,
+        type=int,
+        default=10,
+        help="Minimum number of infrequent queries selecting a root field for it to "
+        "get a generic statement with --relative-query-costs-long-tail.",
+    )
+    argparser_relative_query_costs.add_argument(
+        "--relative-query-costs-bulk",
+        env_var="RELATIVE_QUERY_COSTS_BULK",
+        action="store_true",
+        help="Rebuild the relative query costs models of all the subgraphs at once, "
+        "from a single aggregation of the query logs, instead of one aggregation per "
+        "subgraph.",
+    )
+    argparser_relative_query_costs.add_argument(
+        "--relative-query-costs-rollup",
+        env_var="RELATIVE_QUERY_COSTS_ROLLUP",
+        action="store_true",
+        help="Maintain incremental per-query-hash statistics in the "
+        "query_stats_rollup table and build the models from it, instead of "
+        "aggregating the whole query_logs history on every rebuild.",
+    )
+    argparser_relative_query_costs.add_argument(
+        "--relative-query-costs-rollup-lag",
+        env_var="RELATIVE_QUERY_COSTS_ROLLUP_LAG",
+        required=False,
+        type=int,
+        default=300,
+        help="(Seconds) Only query logs older than this are folded into the rollup. "
+        "Must cover the query logs ingestion delay, as logs arriving later than that "
+        "are not counted.",
+    )
+    argparser_relative_query_costs.add_argument(
+        "--relative-query-costs-rollup-compaction-age",
+        env_var="RELATIVE_QUERY_COSTS_ROLLUP_COMPACTION_AGE",
+        required=False,
+        type=int,
+        default=7,
+        help="(Days) Fold the hourly query_stats_rollup buckets older than this (and "
+        "than --relative-query-costs-window) into daily buckets. The buckets older "
+        "than --query-logs-retention are deleted.",
+    )
+    argparser_relative_query_costs.add_argument(
+        "--relative-query-costs-quantiles",
+        env_var="RELATIVE_QUERY_COSTS_QUANTILES",
+        required=False,
+        type=str,
+        default=None,
+        help="Comma delimited list of query time quantiles (between 0 and 1). If set, "
+        "each query skeleton is priced on the mean of these quantiles of its query "
+        "time, instead of its average query time. Example: 0.5,0.9. Requires "
+        "--relative-query-costs-rollup.",
+    )
+    argparser_relative_query_costs.add_argument(
+        "--relative-query-costs-window",
+        env_var="RELATIVE_QUERY_COSTS_WINDOW",
+        required=False,
+        type=int,
+        default=None,
+        help="(Seconds) Only use the queries logged within that duration to build the "
+        "relative query costs models. Defaults to all the history.",
+    )
+    argparser_relative_query_costs.add_argument(
+        "--relative-query-costs-half-life",
+        env_var="RELATIVE_QUERY_COSTS_HALF_LIFE",
+        required=False,
+        type=int,
+        default=None,
+        help="(Seconds) Exponentially decay the weight of the logged queries with "
+        "their age in the relative query costs statistics, with this half-life. "
+        "Defaults to no decay.",
+    )
+    argparser_relative_query_costs.add_argument(
+        "--relative-query-costs-sample-size",
+        env_var="RELATIVE_QUERY_COSTS_SAMPLE_SIZE",
+        required=False,
+        type=int,
+        default=None,
+        help="Build the relative query costs model of the subgraphs with more query "
+        "logs than this from a random sample of about this many of them "
+        "(TABLESAMPLE), with scaled counts, rather than from all of them. The "
+        "subgraphs' number of query logs is estimated from the query_logs planner "
+        "statistics, which must be kept up to date by ANALYZE. The subgraphs with "
+        "too small a share of query_logs for the sample to read fewer pages than "
+        "their query logs are still aggregated exactly. Ignored with "
+        "--relative-query-costs-rollup. Defaults to exact aggregations.",
+    )
+    argparser_relative_query_costs.add_argument(
+        "--relative-query-costs-rebuild-threshold",
+        env_var="RELATIVE_QUERY_COSTS_REBUILD_THRESHOLD",
+        required=False,
+        type=int,
+        default=None,
+        help="Rebuild the relative query costs model of a subgraph once this many "
+        "query logs were logged since its last build, instead of every "
+        "--relative-query-costs-refresh-interval. The new query logs are counted "
+        "every --relative-query-costs-rebuild-check-interval, and as notified by "
+        "the query logs ingestion.",
+    )
+    argparser_relative_query_costs.add_argument(
+        "--relative-query-costs-rebuild-check-interval",
+        env_var="RELATIVE_QUERY_COSTS_REBUILD_CHECK_INTERVAL",
+        required=False,
+        type=int,
+        default=60,
+        help="(Seconds) Interval between the counts of the new query logs of "
+        "--relative-query-costs-rebuild-threshold.",
+    )
+    argparser_relative_query_costs.add_argument(
+        "--relative-query-costs-rebuild-max-interval",
+        env_var="RELATIVE_QUERY_COSTS_REBUILD_MAX_INTERVAL",
+        required=False,
+        type=int,
+        default=None,
+        help="(Seconds) With --relative-query-costs-rebuild-threshold, maximum "
+        "interval between the rebuilds of a model, whatever its number of new query "
+        "logs. Useful with --relative-query-costs-window or "
+        "--relative-query-costs-half-life, for the statistics to age. Defaults to no "
+        "maximum.",
+    )
+    #
+    # Optional query logs partitioning
+    #
+    argparser_query_logs_partitions = argparser.add_argument_group(
+        "Query logs partitioning settings"
+    )
+    argparser_query_logs_partitions.add_argument(
+        "--query-logs-partitioning",
+        env_var="QUERY_LOGS_PARTITIONING",
+        action="store_true",
+        help="Convert the query_logs table into a table partitioned by day, and "
+        "maintain its partitions. The conversion locks query_logs while the existing "
+        "rows are indexed. Speeds up the time windowed relative query costs "
+        "aggregations and the rollup updates, which only scan the partitions they "
+        "need.",
+    )
+    argparser_query_logs_partitions.add_argument(
+        "--query-logs-partitions-premake",
+        env_var="QUERY_LOGS_PARTITIONS_PREMAKE",
+        required=False,
+        type=int,
+        default=7,
+        help="(Days) How far ahead to create the query_logs partitions.",
+    )
+    argparser_query_logs_partitions.add_argument(
+        "--query-logs-partitions-interval",
+        env_var="QUERY_LOGS_PARTITIONS_INTERVAL",
+        required=False,
+        type=int,
+        default=3600,
+        help="(Seconds) Interval between the query_logs partitions maintenances.",
+    )
+    argparser_query_logs_partitions.add_argument(
+        "--query-logs-retention",
+        env_var="QUERY_LOGS_RETENTION",
+        required=False,
+        type=int,
+        default=None,
+        help="(Days) Expire the query_logs partitions older than that, and the "
+        "query_stats_rollup buckets with --relative-query-costs-rollup. Defaults to "
+        "keeping all the history.",
+    )
+    argparser_query_logs_partitions.add_argument(
+        "--query-logs-retention-archive",
+        env_var="QUERY_LOGS_RETENTION_ARCHIVE",
+        action="store_true",
+        help="Detach the expired query_logs partitions, keeping them as standalone "
+        "tables to be archived, instead of dropping them.",
+    )
+
+    #
+    # Optional query logs ingestion
+    #
+    argparser_query_logs_ingestion = argparser.add_argument_group(
+        "Query logs ingestion settings"
+    )
+    argparser_query_logs_ingestion.add_argument(
+        "--query-logs-ingestion-source",
+        env_var="QUERY_LOGS_INGESTION_SOURCE",
+        required=False,
+        type=str,
+        default=None,
+        help="Path of an indexer-service query logs file (JSON lines), or - for "
+        "stdin, to ingest into the query_skeletons and query_logs tables instead of "
+        "AutoAgora Processor. Defaults to no ingestion.",
+    )
+    argparser_query_logs_ingestion.add_argument(
+        "--query-logs-ingestion-batch-size",
+        env_var="QUERY_LOGS_INGESTION_BATCH_SIZE",
+        required=False,
+        type=int,
+        default=10_000,
+        help="Number of query logs written at once.",
+    )
+    argparser_query_logs_ingestion.add_argument(
+        "--query-logs-ingestion-flush-interval",
+        env_var="QUERY_LOGS_INGESTION_FLUSH_INTERVAL",
+        required=False,
+        type=float,
+        default=1,
+        help="(Seconds) Maximum time the ingested query logs are buffered before "
+        "being written.",
+    )
+
+    #
+    # Optional price history
+    #
+    argparser_price_history = argparser.add_argument_group("Price history settings")
+    argparser_price_history.add_argument(
+        "--price-history",
+        env_var="PRICE_HISTORY",
+        required=False,
+        action="store_true",
+        help="Record each step of the price bandits (price multiplier, queries per "
+        "second, reward, mean and stddev) in the price_history table.",
+    )
+    argparser_price_history.add_argument(
+        "--price-history-flush-interval",
+        env_var="PRICE_HISTORY_FLUSH_INTERVAL",
+        required=False,
+        type=float,
+        default=10,
+        help="(Seconds) Interval between the writes of the buffered price bandit "
+        "steps.",
+    )
+    argparser_price_history.add_argument(
+        "--price-history-retention",
+        env_var="PRICE_HISTORY_RETENTION",
+        required=False,
+        type=int,
+        default=None,
+        help="(Days) Delete the price history steps older than that. Defaults to "
+        "keeping all the history.",
+    )
+
     #
     # Manual agora entry values
     #
@@ -200,9 +571,27 @@ def init_config(argv: Optional[Sequence[str]] = None):
         default=None,
         help="Path to find manual agora entries, this expects Agora model files named {subgraph_hash}.agora",
     )
+    argparser.add_argument(
+        "--manual-entry-poll-interval",
+        env_var="MANUAL_ENTRY_POLL_INTERVAL",
+        required=False,
+        type=int,
+        default=10,
+        help="(Seconds) Interval between checks of the manual agora entry files for "
+        "modifications. The model of a subgraph whose entry file was modified is "
+        "rebuilt right away.",
+    )
 
+    # argparse only sets the defaults of the arguments missing from the namespace, so
+    # clear the values of any previous call.
+    vars(args).clear()
     argparser.parse_args(args=argv, namespace=args)
 
+    if args.relative_query_costs_quantiles and not args.relative_query_costs_rollup:
+        argparser.error(
+            "--relative-query-costs-quantiles requires --relative-query-costs-rollup."
+        )
+
     # Set the logs formatting
     if args.json_logs:
         logHandler = logging.StreamHandler()
@@ -0,0 +1,150 @@
+# Copyright 2023-, Semiotic AI, Inc.
+# SPDX-License-Identifier: Apache-2.0
+
+"""PostgreSQL connection pools instrumented with Prometheus metrics.
+
+AutoAgora uses separate pools, so that the long aggregations of the model builds
+cannot starve the short price save state reads and writes of the bandit loops:
+
+* `oltp`: the price save states, one short query per bandit step.
+* `analytics`: the query logs aggregations of the model builds, the rollup updates
+  and the rebuild checks.
+* `maintenance`: the query logs ingestion, the `query_logs` partitions maintenance,
+  the rollup compaction and the background schema migrations (index builds).
+* `replica`: the read-only query logs aggregations, if `--postgres-replica-host` is
+  set. The `analytics` pool then only runs the rollup writes, and the aggregations
+  while the replica lags (see `LogsDB`).
+
+Each pool opens connections on demand, up to its maximum size, and closes the
+connections idle for longer than `--postgres-max-idle` down to a single connection.
+"""
+
+from time import monotonic
+from typing import Dict, Optional
+
+import psycopg_pool
+from prometheus_client import Gauge, Histogram
+
+from autoagora.config import args
+
+pool_wait_histogram = Histogram(
+    "postgres_pool_wait_seconds",
+    "Time spent waiting for a connection from the PostgreSQL pool.",
+    ["pool"],
+)
+pool_checkout_histogram = Histogram(
+    "postgres_pool_checkout_seconds",
+    "Time a connection is held out of the PostgreSQL pool.",
+    ["pool"],
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300),
+)
+pool_size_gauge = Gauge(
+    "postgres_pool_size", "Open connections of the PostgreSQL pool.", ["pool"]
+)
+pool_waiting_gauge = Gauge(
+    "postgres_pool_requests_waiting",
+    "Requests waiting for a connection from the PostgreSQL pool.",
+    ["pool"],
+)
+pool_saturation_gauge = Gauge(
+    "postgres_pool_saturation",
+    "Share of the PostgreSQL pool's maximum size in use.",
+    ["pool"],
+)
+
+
+class InstrumentedAsyncConnectionPool(psycopg_pool.AsyncConnectionPool):
+    """`psycopg_pool.AsyncConnectionPool` exporting its wait times, checkout
+    durations, size and saturation, labeled with the pool's `name`."""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._checkout_times: Dict[int, float] = dict()
+        # Counted here, as the pool only drops its timed out requests lazily
+        self._waiting_requests = 0
+
+    async def getconn(self, timeout: Optional[float] = None):
+        start = monotonic()
+        self._waiting_requests += 1
+        self._update_gauges()
+        try:
+            connection = await super().getconn(timeout)
+            self._checkout_times[id(connection)] = monotonic()
+        finally:
+            pool_wait_histogram.labels(self.name).observe(monotonic() - start)
+            self._waiting_requests -= 1
+            self._update_gauges()
+        return connection
+
+    async def putconn(self, conn) -> None:
+        checkout_time = self._checkout_times.pop(id(conn), None)
+        if checkout_time is not None:
+            pool_checkout_histogram.labels(self.name).observe(
+                monotonic() - checkout_time
+            )
+        await super().putconn(conn)
+        self._update_gauges()
+
+    def _update_gauges(self) -> None:
+        pool_size_gauge.labels(self.name).set(self.get_stats().get("pool_size", 0))
+        pool_waiting_gauge.labels(self.name).set(self._waiting_requests)
+        pool_saturation_gauge.labels(self.name).set(
+            len(self._checkout_times) / self.max_size
+        )
+
+
+async def open_pools(
+    conninfo: str, replica_conninfo: Optional[str] = None
+) -> Dict[str, InstrumentedAsyncConnectionPool]:
+    """Opens the `oltp`, `analytics` and `maintenance` connection pools, and the
+    `replica` pool if `replica_conninfo` is set.
+
+    Args:
+        conninfo (str): libpq connection string.
+        replica_conninfo (Optional[str], optional): libpq connection string of the
+            read replica. Defaults to None.
+
+    Returns:
+        Dict[str, InstrumentedAsyncConnectionPool]: Opened pools, by name.
+    """
+    pools = {
+        "oltp": InstrumentedAsyncConnectionPool(
+            conninfo,
+            min_size=1,
+            max_size=args.postgres_max_connections,
+            max_idle=args.postgres_max_idle,
+            name="oltp",
+            open=False,
+        ),
+        "analytics": InstrumentedAsyncConnectionPool(
+            conninfo,
+            min_size=1,
+            max_size=args.postgres_analytics_max_connections,
+            max_idle=args.postgres_max_idle,
+            name="analytics",
+            open=False,
+        ),
+        "maintenance": InstrumentedAsyncConnectionPool(
+            conninfo,
+            min_size=1,
+            max_size=args.postgres_maintenance_max_connections,
+            max_idle=args.postgres_max_idle,
+            name="maintenance",
+            open=False,
+        ),
+    }
+    if replica_conninfo:
+        pools["replica"] = InstrumentedAsyncConnectionPool(
+            replica_conninfo,
+            min_size=1,
+            max_size=args.postgres_analytics_max_connections,
+            max_idle=args.postgres_max_idle,
+            name="replica",
+            open=False,
+        )
+    for name, pool in pools.items():
+        await pool.open()
+        # The aggregations fall back to the primary while the replica is unreachable
+        if name != "replica":
+            await pool.wait()
+    return pools
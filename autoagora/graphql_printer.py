@@ -0,0 +1,158 @@
+# Copyright 2023-, Semiotic AI, Inc.
+# SPDX-License-Identifier: Apache-2.0
+
+"""Canonical, whitespace-minimal GraphQL printer for the query bodies of the
+generated Agora models, and the ingested query skeletons.
+
+Unlike `graphql.print_ast`, no indentation or newline is printed, and a space is
+only inserted between two tokens that would otherwise merge (e.g. two names).
+Arguments, input object fields and selections are sorted, so that query shapes that
+only differ by their ordering are printed identically.
+"""
+
+from typing import List
+
+from graphql import language
+from graphql.language.print_string import print_string
+
+# Tokens that never need to be separated from their neighbours
+_PUNCTUATORS = frozenset(
+    ["!", "$", "&", "(", ")", "...", ":", "=", "@", "[", "]", "{", "|", "}"]
+)
+
+
+def _join(tokens: List[str]) -> str:
+    printed = []
+    previous_is_punctuator = True
+    for token in tokens:
+        is_punctuator = token in _PUNCTUATORS
+        if not previous_is_punctuator and not is_punctuator:
+            printed.append(" ")
+        printed.append(token)
+        previous_is_punctuator = is_punctuator
+    return "".join(printed)
+
+
+def _value_tokens(node: language.ValueNode) -> List[str]:
+    if isinstance(node, language.VariableNode):
+        return ["$", node.name.value]
+    if isinstance(node, (language.IntValueNode, language.FloatValueNode)):
+        return [node.value]
+    if isinstance(node, language.StringValueNode):
+        return [print_string(node.value)]
+    if isinstance(node, language.BooleanValueNode):
+        return ["true" if node.value else "false"]
+    if isinstance(node, language.NullValueNode):
+        return ["null"]
+    if isinstance(node, language.EnumValueNode):
+        return [node.value]
+    if isinstance(node, language.ListValueNode):
+        tokens = ["["]
+        for value in node.values:
+            tokens += _value_tokens(value)
+        return tokens + ["]"]
+    if isinstance(node, language.ObjectValueNode):
+        tokens = ["{"]
+        for field in sorted(node.fields, key=lambda field: field.name.value):
+            tokens += [field.name.value, ":"] + _value_tokens(field.value)
+        return tokens + ["}"]
+    raise TypeError(f"Unsupported GraphQL value node: {node.kind}")
+
+
+def _arguments_tokens(arguments) -> List[str]:
+    if not arguments:
+        return []
+    tokens = ["("]
+    for argument in sorted(arguments, key=lambda argument: argument.name.value):
+        tokens += [argument.name.value, ":"] + _value_tokens(argument.value)
+    return tokens + [")"]
+
+
+def _directives_tokens(directives) -> List[str]:
+    tokens = []
+    for directive in directives or ():
+        tokens += ["@", directive.name.value] + _arguments_tokens(directive.arguments)
+    return tokens
+
+
+def _selection_tokens(node: language.SelectionNode) -> List[str]:
+    if isinstance(node, language.FieldNode):
+        tokens = [node.alias.value, ":"] if node.alias else []
+        tokens += [node.name.value]
+        tokens += _arguments_tokens(node.arguments)
+        tokens += _directives_tokens(node.directives)
+        if node.selection_set:
+            tokens += _selection_set_tokens(node.selection_set)
+        return tokens
+    if isinstance(node, language.FragmentSpreadNode):
+        return ["...", node.name.value] + _directives_tokens(node.directives)
+    if isinstance(node, language.InlineFragmentNode):
+        tokens = ["..."]
+        if node.type_condition:
+            tokens += ["on", node.type_condition.name.value]
+        tokens += _directives_tokens(node.directives)
+        return tokens + _selection_set_tokens(node.selection_set)
+    raise TypeError(f"Unsupported GraphQL selection node: {node.kind}")
+
+
+def _selection_set_tokens(node: language.SelectionSetNode) -> List[str]:
+    selections = sorted(
+        (_selection_tokens(selection) for selection in node.selections), key=_join
+    )
+    tokens = ["{"]
+    for selection in selections:
+        tokens += selection
+    return tokens + ["}"]
+
+
+def _type_tokens(node: language.TypeNode) -> List[str]:
+    if isinstance(node, language.NonNullTypeNode):
+        return _type_tokens(node.type) + ["!"]
+    if isinstance(node, language.ListTypeNode):
+        return ["["] + _type_tokens(node.type) + ["]"]
+    if isinstance(node, language.NamedTypeNode):
+        return [node.name.value]
+    raise TypeError(f"Unsupported GraphQL type node: {node.kind}")
+
+
+def print_canonical_query_body(node: language.SelectionSetNode) -> str:
+    """Prints the root selection set of a query as a canonical, minified query
+    body.
+
+    Args:
+        node (language.SelectionSetNode): Root selection set of the query.
+
+    Returns:
+        str: The query body, such as `query{values(first:10 skip:$_0){id}}`.
+    """
+    return _join(["query"] + _selection_set_tokens(node))
+
+
+def print_canonical_operation(node: language.OperationDefinitionNode) -> str:
+    """Prints a whole operation, with its name and variable definitions, in the same
+    canonical, minified form as `print_canonical_query_body`.
+
+    Args:
+        node (language.OperationDefinitionNode): Operation, without fragment
+            spreads.
+
+    Returns:
+        str: The operation, such as `query getValues($_0:Int){values(first:$_0){id}}`.
+    """
+    tokens = [node.operation.value]
+    if node.name:
+        tokens.append(node.name.value)
+    if node.variable_definitions:
+        tokens.append("(")
+        for definition in sorted(
+            node.variable_definitions,
+            key=lambda definition: definition.variable.name.value,
+        ):
+            tokens += ["$", definition.variable.name.value, ":"]
+            tokens += _type_tokens(definition.type)
+            if definition.default_value:
+                tokens += ["="] + _value_tokens(definition.default_value)
+            tokens += _directives_tokens(definition.directives)
+        tokens.append(")")
+    tokens += _directives_tokens(node.directives)
+    return _join(tokens + _selection_set_tokens(node.selection_set))
@@ -11,9 +11,17 @@ import backoff
 from base58 import b58decode, b58encode
 from gql import Client, gql
 from gql.transport.aiohttp import AIOHTTPTransport
+from prometheus_client import Histogram
 
 from autoagora.config import args
 
+indexer_agent_request_histogram = Histogram(
+    "indexer_agent_request_seconds",
+    "Duration of the requests to the indexer-agent management API, retries included.",
+    ["operation"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+
 
 def ipfs_hash_to_hex(ipfs_hash: str) -> str:
     assert len(ipfs_hash) == 46
@@ -45,18 +53,21 @@ async def query_indexer_agent(query: str, variables: Optional[Mapping] = None):
 
 
 async def get_allocated_subgraphs() -> Set[str]:
-    result = await query_indexer_agent(
-        """
-        query ($protocolNetwork: String!) {
-            indexerAllocations (protocolNetwork: $protocolNetwork) {
-                subgraphDeployment
+    with indexer_agent_request_histogram.labels(
+        operation="get_allocated_subgraphs"
+    ).time():
+        result = await query_indexer_agent(
+            """
+            query ($protocolNetwork: String!) {
+                indexerAllocations (protocolNetwork: $protocolNetwork) {
+                    subgraphDeployment
+                }
             }
-        }
-        """,
-        variables={
-            "protocolNetwork": args.indexer_agent_protocol_network,
-        },
-    )
+            """,
+            variables={
+                "protocolNetwork": args.indexer_agent_protocol_network,
+            },
+        )
 
     return set(e["subgraphDeployment"] for e in result["indexerAllocations"])
 
@@ -89,40 +100,42 @@ async def set_cost_model(
         }
     variables_json = json.dumps(variables)
 
-    await query_indexer_agent(
-        """
-        mutation ($deployment: String!, $model: String, $variables: String) {
-            setCostModel(
-                costModel: {
-                    deployment: $deployment,
-                    model: $model,
-                    variables: $variables
+    with indexer_agent_request_histogram.labels(operation="set_cost_model").time():
+        await query_indexer_agent(
+            """
+            mutation ($deployment: String!, $model: String, $variables: String) {
+                setCostModel(
+                    costModel: {
+                        deployment: $deployment,
+                        model: $model,
+                        variables: $variables
+                    }
+                ) {
+                    __typename
                 }
-            ) {
-                __typename
             }
-        }
-        """,
-        variables={
-            "deployment": ipfs_hash_to_hex(subgraph),
-            "model": model,
-            "variables": variables_json,
-        },
-    )
+            """,
+            variables={
+                "deployment": ipfs_hash_to_hex(subgraph),
+                "model": model,
+                "variables": variables_json,
+            },
+        )
 
 
 async def get_cost_variables(subgraph: str) -> Dict[str, Any]:
-    result = await query_indexer_agent(
-        """
-        query ($deployment: String!){
-            costModel(deployment: $deployment) {
-                variables
+    with indexer_agent_request_histogram.labels(operation="get_cost_variables").time():
+        result = await query_indexer_agent(
+            """
+            query ($deployment: String!){
+                costModel(deployment: $deployment) {
+                    variables
+                }
             }
-        }
-        """,
-        variables={
-            "deployment": ipfs_hash_to_hex(subgraph),
-        },
-    )
+            """,
+            variables={
+                "deployment": ipfs_hash_to_hex(subgraph),
+            },
+        )
 
     return json.loads(result["costModel"]["variables"])
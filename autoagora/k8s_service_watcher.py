@@ -1,33 +1,73 @@
 # Copyright 2022-, Semiotic AI, Inc.
 # SPDX-License-Identifier: Apache-2.0
 
+"""Watch of the endpoints of a Kubernetes service, on the asyncio event loop.
+
+The Kubernetes API is requested directly with aiohttp, rather than through the
+blocking `kubernetes` client, which would tie up an executor thread for the whole
+life of the process. Only the in-cluster configuration (API server address, CA
+certificate and service account token) is loaded with the `kubernetes` package.
+
+The endpoints are listed once, then watched from the list's `resourceVersion`. The
+watch requests bookmarks, so the `resourceVersion` keeps up with the API server even
+when the endpoints do not change, and a watch that ends (server timeout, connection
+error) is resumed from it without listing again. They are only listed again when
+the API server no longer has the `resourceVersion` (410 Gone), or after an invalid
+or oversized watch event, as changes may have been missed.
+
+`K8SServiceEndpointsWatcher` watches the service's `Endpoints` object, which is
+truncated to 1000 addresses, and shipped whole on every change.
+`K8SServiceEndpointSlicesWatcher` watches its `EndpointSlice` objects instead, of at
+most 100 endpoints each, and only applies the slices that changed.
+"""
+
 import asyncio as aio
+import json
 import logging
+import ssl
+from abc import ABC, abstractmethod
+from datetime import timedelta
+from typing import Any, Dict, List, Optional, Tuple
 
-from kubernetes import client, config, watch
-from kubernetes.client.api_client import ApiClient
-from kubernetes.client.rest import ApiException
+import aiohttp
+from aiohttp.http_exceptions import HttpProcessingError
+from kubernetes import client, config
 
 from autoagora.misc import async_exit_on_exception
 
+HTTP_STATUS_GONE = 410
+
+
+class WatchError(Exception):
+    """The API server ended a watch with an error event."""
 
-class K8SServiceEndpointsWatcher:
-    def __init__(self, service_name: str) -> None:
-        """Maintains an automatically, asynchronously updated list of endpoints backing
-        a kubernetes service in the current namespace.
 
-        This is supposed to be run from within a Kubernetes pod. The pod will need a
-        role that grants it:
+class ResourceVersionGone(WatchError):
+    """The API server no longer has the resource version to watch from."""
 
-        ```
-            rules:
-            - apiGroups: [""]
-                resources: ["endpoints"]
-                verbs: ["watch"]
-        ```
+
+class K8SServiceWatcher(ABC):
+    # Duration of each watch request, after which the API server ends it
+    watch_timeout = timedelta(minutes=5)
+    # Delay before retrying after a failed request
+    retry_interval = timedelta(seconds=1)
+    # Maximum size of a watch event (one line of the response)
+    max_event_size = 2**20
+
+    def __init__(
+        self,
+        service_name: str,
+        api_configuration: Optional[client.Configuration] = None,
+    ) -> None:
+        """Maintains an automatically, asynchronously updated list of endpoints backing
+        a kubernetes service in the current namespace, from the Kubernetes objects
+        listed and watched by the subclass.
 
         Args:
             service_name (str): Kubernetes service name.
+            api_configuration (Optional[client.Configuration], optional): Kubernetes
+                API server address and credentials. Defaults to None (in-cluster
+                configuration).
 
         Raises:
             FileNotFoundError: couldn't find
@@ -36,6 +76,8 @@ class K8SServiceEndpointsWatcher:
         """
         self.endpoint_ips = []
         self._service_name = service_name
+        self._api_configuration = api_configuration
+        self._resource_version: Optional[str] = None
 
         try:
             with open(
@@ -49,45 +91,299 @@ class K8SServiceEndpointsWatcher:
         # Starts the async _loop immediately
         self._future = aio.ensure_future(self._watch_loop())
 
+    @property
+    @abstractmethod
+    def _path(self) -> str:
+        """API path of the watched objects."""
+        pass
+
+    @property
+    @abstractmethod
+    def _selector(self) -> Dict[str, str]:
+        """Query parameters selecting the service's objects."""
+        pass
+
+    @abstractmethod
+    def _on_list(self, items: List[Dict[str, Any]]) -> None:
+        """Replaces the endpoints with the ones of the listed objects."""
+        pass
+
+    @abstractmethod
+    def _on_change(self, event_type: str, obj: Dict[str, Any]) -> None:
+        """Applies an "ADDED", "MODIFIED" or "DELETED" watch event."""
+        pass
+
     @async_exit_on_exception()
     async def _watch_loop(self) -> None:
-        """Restarts the k8s watch on expiration."""
-        while True:
-            try:
-                await self._watch()
-            except ApiException as api_exc:
-                if api_exc.status == watch.watch.HTTP_STATUS_GONE:
+        """Lists the endpoints, then watches them, resuming the watch when it ends and
+        listing them again when its resource version is gone."""
+        if self._api_configuration is None:
+            self._api_configuration = client.Configuration()
+            config.load_incluster_config(client_configuration=self._api_configuration)
+
+        ssl_context = None
+        if self._api_configuration.ssl_ca_cert:
+            ssl_context = ssl.create_default_context(
+                cafile=self._api_configuration.ssl_ca_cert
+            )
+
+        async with aiohttp.ClientSession(
+            base_url=self._api_configuration.host,
+            connector=aiohttp.TCPConnector(ssl=ssl_context or True),
+            read_bufsize=self.max_event_size // 2,
+        ) as session:
+            while True:
+                try:
+                    if self._resource_version is None:
+                        await self._list(session)
+                    await self._watch(session)
+                    logging.debug("k8s_service_watcher watch ended.")
+                except ResourceVersionGone:
                     logging.debug("k8s_service_watcher 410 timeout.")
-                else:
-                    raise
-            logging.debug("k8s_service_watcher restarted")
-
-    async def _watch(self) -> None:
-        """Watches for changes in k8s service endpoints."""
-        config.load_incluster_config()
-
-        api = ApiClient()
-        v1 = client.CoreV1Api(api)
-        w = watch.Watch()
-        event_stream = w.stream(
-            v1.list_namespaced_endpoints,
-            namespace=self._namespace,
-            field_selector=f"metadata.name={self._service_name}",
+                    self._resource_version = None
+                    continue
+                except (aiohttp.ClientError, aio.TimeoutError, WatchError):
+                    logging.exception(
+                        "Error while watching the endpoints of service %s.",
+                        self._service_name,
+                    )
+                    await aio.sleep(self.retry_interval.total_seconds())
+                except (ValueError, KeyError, HttpProcessingError):
+                    # Malformed or oversized object (aiohttp raises `ValueError` or
+                    # `LineTooLong` depending on its version): changes may have been
+                    # missed, list them again.
+                    logging.exception(
+                        "Invalid response while watching the endpoints of service %s.",
+                        self._service_name,
+                    )
+                    self._resource_version = None
+                    await aio.sleep(self.retry_interval.total_seconds())
+                logging.debug("k8s_service_watcher restarted")
+
+    def _request(
+        self, session: aiohttp.ClientSession, params: Dict[str, str], **kwargs
+    ):
+        assert self._api_configuration
+        return session.get(
+            self._path.format(namespace=self._namespace),
+            params={**self._selector, **params},
+            headers={
+                # Refreshes the service account token, which is rotated
+                "Authorization": self._api_configuration.get_api_key_with_prefix(
+                    "authorization"
+                )
+                or "",
+                "Accept": "application/json",
+            },
+            **kwargs,
         )
 
-        loop = aio.get_running_loop()
+    async def _list(self, session: aiohttp.ClientSession) -> None:
+        """Lists the service's objects, and the resource version to watch from."""
+        async with self._request(session, {}) as response:
+            response.raise_for_status()
+            object_list = await response.json()
 
-        while event := await loop.run_in_executor(None, next, event_stream):
-            result = event["object"]  # type: ignore
+        self._resource_version = object_list["metadata"]["resourceVersion"]
+        self._on_list(object_list["items"])
+        self._log_endpoint_ips()
 
-            self.endpoint_ips = [
-                address.ip
-                for subset in result.subsets  # type: ignore
-                for address in subset.addresses  # type: ignore
-            ]
+    async def _watch(self, session: aiohttp.ClientSession) -> None:
+        """Watches for changes in the service's objects, from the current resource
+        version, until the API server ends the watch.
 
-            logging.debug(
-                "Got endpoint IPs for service %s: %s",
-                self._service_name,
-                self.endpoint_ips,
-            )
+        Raises:
+            ResourceVersionGone: The resource version is too old to watch from.
+            WatchError: The API server ended the watch with another error.
+        """
+        assert self._resource_version is not None
+        async with self._request(
+            session,
+            {
+                "watch": "1",
+                "resourceVersion": self._resource_version,
+                "allowWatchBookmarks": "true",
+                "timeoutSeconds": str(int(self.watch_timeout.total_seconds())),
+            },
+            # The API server ends the watch by itself. A longer silence means that
+            # the connection was lost.
+            timeout=aiohttp.ClientTimeout(
+                total=None,
+                sock_read=(self.watch_timeout + timedelta(minutes=1)).total_seconds(),
+            ),
+        ) as response:
+            if response.status == HTTP_STATUS_GONE:
+                raise ResourceVersionGone()
+            response.raise_for_status()
+
+            async for line in response.content:
+                if not line.strip():
+                    continue
+                event = json.loads(line)
+                self._on_event(event["type"], event["object"])
+
+    def _on_event(self, event_type: str, obj: Dict[str, Any]) -> None:
+        if event_type == "ERROR":
+            # A `Status` object
+            if obj.get("code") == HTTP_STATUS_GONE:
+                raise ResourceVersionGone()
+            raise WatchError(obj.get("message"))
+
+        self._resource_version = obj["metadata"]["resourceVersion"]
+        if event_type in ("ADDED", "MODIFIED", "DELETED"):
+            self._on_change(event_type, obj)
+            self._log_endpoint_ips()
+        # Nothing else to do on "BOOKMARK"
+
+    def _log_endpoint_ips(self) -> None:
+        logging.debug(
+            "Got endpoint IPs for service %s: %s",
+            self._service_name,
+            self.endpoint_ips,
+        )
+
+
+class K8SServiceEndpointsWatcher(K8SServiceWatcher):
+    """Maintains the endpoints of a Kubernetes service from its `Endpoints` object.
+
+    The pod will need a role that grants it:
+
+    ```
+        rules:
+        - apiGroups: [""]
+            resources: ["endpoints"]
+            verbs: ["list", "watch"]
+    ```
+    """
+
+    @property
+    def _path(self) -> str:
+        return "/api/v1/namespaces/{namespace}/endpoints"
+
+    @property
+    def _selector(self) -> Dict[str, str]:
+        return {"fieldSelector": f"metadata.name={self._service_name}"}
+
+    def _on_list(self, items: List[Dict[str, Any]]) -> None:
+        self.endpoint_ips = endpoint_ips(items[0] if items else None)
+
+    def _on_change(self, event_type: str, obj: Dict[str, Any]) -> None:
+        self.endpoint_ips = endpoint_ips(obj if event_type != "DELETED" else None)
+
+
+class K8SServiceEndpointSlicesWatcher(K8SServiceWatcher):
+    """Maintains the endpoints of a Kubernetes service from its `EndpointSlice`
+    objects, keeping the ready addresses of each slice, and only updating the ones of
+    the slices that changed.
+
+    A dual-stack service has IPv4 and IPv6 slices for the same pods, which must only
+    be scraped once: the addresses of the first of `address_types` that the service
+    has slices of are kept.
+
+    The pod will need a role that grants it:
+
+    ```
+        rules:
+        - apiGroups: ["discovery.k8s.io"]
+            resources: ["endpointslices"]
+            verbs: ["list", "watch"]
+    ```
+    """
+
+    # Address types of the slices watched, by order of preference
+    address_types = ("IPv4", "IPv6")
+
+    def __init__(
+        self,
+        service_name: str,
+        api_configuration: Optional[client.Configuration] = None,
+    ) -> None:
+        # Address type and ready addresses of each slice, by slice name
+        self._slices: Dict[str, Tuple[str, List[str]]] = {}
+        super().__init__(service_name, api_configuration)
+
+    @property
+    def _path(self) -> str:
+        return "/apis/discovery.k8s.io/v1/namespaces/{namespace}/endpointslices"
+
+    @property
+    def _selector(self) -> Dict[str, str]:
+        return {"labelSelector": f"kubernetes.io/service-name={self._service_name}"}
+
+    def _on_list(self, items: List[Dict[str, Any]]) -> None:
+        self._slices = {
+            item["metadata"]["name"]: (item["addressType"], endpoint_slice_ips(item))
+            for item in items
+            if item.get("addressType") in self.address_types
+        }
+        self._update()
+
+    def _on_change(self, event_type: str, obj: Dict[str, Any]) -> None:
+        address_type = obj.get("addressType")
+        if address_type not in self.address_types:
+            return
+
+        name = obj["metadata"]["name"]
+        if event_type == "DELETED":
+            if self._slices.pop(name, None) is not None:
+                self._update()
+            return
+
+        slice_ips = (address_type, endpoint_slice_ips(obj))
+        # Most slice changes (ports, hints, conditions of not-ready endpoints, ...)
+        # leave its ready addresses unchanged
+        if self._slices.get(name) != slice_ips:
+            self._slices[name] = slice_ips
+            self._update()
+
+    def _update(self) -> None:
+        slice_address_types = {
+            address_type for address_type, _ in self._slices.values()
+        }
+        address_type = next(
+            (
+                address_type
+                for address_type in self.address_types
+                if address_type in slice_address_types
+            ),
+            None,
+        )
+        self.endpoint_ips = [
+            ip
+            for slice_address_type, ips in self._slices.values()
+            if slice_address_type == address_type
+            for ip in ips
+        ]
+
+
+def endpoint_ips(endpoints: Optional[Dict[str, Any]]) -> List[str]:
+    """Returns the ready IP addresses of an `Endpoints` object.
+
+    Args:
+        endpoints (Optional[Dict[str, Any]]): `Endpoints` object, as returned by the
+            Kubernetes API. None if the service has no `Endpoints` object.
+    """
+    if endpoints is None:
+        return []
+    return [
+        address["ip"]
+        for subset in endpoints.get("subsets") or []
+        for address in subset.get("addresses") or []
+    ]
+
+
+def endpoint_slice_ips(endpoint_slice: Dict[str, Any]) -> List[str]:
+    """Returns the ready IP addresses of an `EndpointSlice` object.
+
+    Args:
+        endpoint_slice (Dict[str, Any]): `EndpointSlice` object, as returned by the
+            Kubernetes API.
+    """
+    return [
+        address
+        for endpoint in endpoint_slice.get("endpoints") or []
+        # An unknown readiness is to be interpreted as ready
+        if (endpoint.get("conditions") or {}).get("ready") is not False
+        # The addresses of an endpoint are fungible: only its first one is scraped
+        for address in endpoint["addresses"][:1]
+    ]
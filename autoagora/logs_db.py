@@ -1,13 +1,33 @@
 # Copyright 2022-, Semiotic AI, Inc.
 # SPDX-License-Identifier: Apache-2.0
+import asyncio as aio
+import json
+import logging
+import math
+from collections import OrderedDict
 from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Any, AsyncIterator, Collection, Dict, List, Optional, Sequence, Tuple
 
 import graphql
+import psycopg
 import psycopg_pool
+from prometheus_client import Gauge
 from psycopg import sql
 
+from autoagora.graphql_printer import print_canonical_query_body
+
+replica_lag_gauge = Gauge(
+    "postgres_replica_lag_seconds",
+    "Replication lag of the PostgreSQL read replica the query logs aggregations are "
+    "routed to.",
+)
+
 
 class LogsDB:
+    # Timeout of the read replica lag check, before each aggregation
+    replica_lag_timeout = timedelta(seconds=2)
+
     @dataclass
     class QueryStats:
         query: str
@@ -16,72 +36,1329 @@ class LogsDB:
         max_time: int
         avg_time: float
         stddev_time: float
+        # Estimated query time of each requested quantile
+        quantile_times: Optional[Dict[float, float]] = None
+        # Standard error of the count, if estimated from a sample of the query logs
+        count_stderr: Optional[float] = None
+
+        @property
+        def price_time(self) -> float:
+            """Query time the skeleton's price is based on: the mean of the quantile
+            times if any, the average time otherwise."""
+            if self.quantile_times:
+                return sum(self.quantile_times.values()) / len(self.quantile_times)
+            return self.avg_time
 
-    def __init__(self, pgpool: psycopg_pool.AsyncConnectionPool) -> None:
+    # Relative accuracy of the query time quantiles. The query time sketches are
+    # DDSketches: histograms of the query times over logarithmic bins, so that any
+    # quantile is estimated within that relative error, and sketches are merged by
+    # adding up the bin counts.
+    sketch_relative_accuracy = 0.01
+
+    # Maximum number of normalized query bodies kept in the cache.
+    query_bodies_cache_size = 100_000
+    # Normalized query bodies by query skeleton hash, least recently used first.
+    # Shared by all the instances, since query skeletons are immutable for a given
+    # hash.
+    _query_bodies: "OrderedDict[bytes, str]" = OrderedDict()
+
+    def __init__(
+        self,
+        pgpool: psycopg_pool.AsyncConnectionPool,
+        replica_pgpool: Optional[psycopg_pool.AsyncConnectionPool] = None,
+        replica_max_lag: timedelta = timedelta(minutes=5),
+    ) -> None:
+        """
+        Args:
+            pgpool (psycopg_pool.AsyncConnectionPool): Connection pool to the primary
+                logs database.
+            replica_pgpool (Optional[psycopg_pool.AsyncConnectionPool], optional):
+                Connection pool to a read replica of the logs database, to run the
+                read-only query logs aggregations on. Defaults to None (primary
+                only).
+            replica_max_lag (timedelta, optional): Replication lag above which the
+                aggregations fall back to the primary. Defaults to 5 minutes.
+        """
         self.pgpool = pgpool
+        self.replica_pgpool = replica_pgpool
+        self.replica_max_lag = replica_max_lag
 
     def return_query_body(self, query):
         # Keep only query body -- ie. no var defs
         query = graphql.parse(query)
         assert len(query.definitions) == 1  # Should be single root query
         query = query.definitions[0].selection_set  # type: ignore
-        query = "query " + graphql.print_ast(query)
+        query = print_canonical_query_body(query)
         return query
 
-    async def get_most_frequent_queries(
-        self, subgraph_ipfs_hash: str, min_count: int = 100
-    ):
+    def _cached_query_body(self, query_hash: bytes, query: str) -> str:
+        """`return_query_body`, memoized by query skeleton hash in a bounded LRU cache
+        so that each skeleton is parsed only once."""
+        query_bodies = LogsDB._query_bodies
+        body = query_bodies.get(query_hash)
+        if body is not None:
+            query_bodies.move_to_end(query_hash)
+            return body
 
+        body = self.return_query_body(query) or "null"
+        query_bodies[query_hash] = body
+        if len(query_bodies) > LogsDB.query_bodies_cache_size:
+            query_bodies.popitem(last=False)
+        return body
+
+    @staticmethod
+    def clear_query_bodies_cache() -> None:
+        LogsDB._query_bodies.clear()
+
+    async def update_query_stats_rollup(
+        self, lag: timedelta = timedelta(minutes=5)
+    ) -> None:
+        """Folds the `query_logs` rows ingested since the last update into the
+        per-(subgraph, query_hash, hour) `query_stats_rollup` and `query_stats_sketch`
+        tables.
+
+        Only the rows with a timestamp between the stored high-water mark and
+        `now() - lag` are aggregated, so each call scans only the newly ingested logs.
+        Rows inserted later with a timestamp older than the high-water mark are never
+        counted, hence `lag` should cover the ingestion delay of the query logs.
+
+        Concurrent calls are serialized on the high-water mark row.
+
+        Args:
+            lag (timedelta, optional): Safety margin between the newest aggregated
+                log timestamp and the current time. Defaults to 5 minutes.
+        """
         async with self.pgpool.connection() as connection:
-            rows = await connection.execute(
-                sql.SQL(
+            async with connection.transaction():
+                await connection.execute(
                     """
+                    INSERT INTO query_stats_rollup_watermark (high_water_mark)
+                        VALUES ('epoch')
+                    ON CONFLICT (id) DO NOTHING
+                    """,
+                    prepare=True,
+                )
+                row = await connection.execute(
+                    """
+                    SELECT
+                        high_water_mark,
+                        now() - %(lag)s
+                    FROM
+                        query_stats_rollup_watermark
+                    FOR UPDATE
+                    """,
+                    {"lag": lag},
+                    prepare=True,
+                    binary=True,
+                )
+                high_water_mark, new_high_water_mark = await row.fetchone()  # type: ignore
+                if new_high_water_mark <= high_water_mark:
+                    return
+
+                await connection.execute(
+                    """
+                    INSERT INTO query_stats_rollup AS rollup (
+                        subgraph,
+                        query_hash,
+                        bucket,
+                        count,
+                        sum_time,
+                        sum_sq_time,
+                        min_time,
+                        max_time
+                    )
+                    SELECT
+                        subgraph,
+                        query_hash,
+                        date_trunc('hour', timestamp, 'UTC'),
+                        count(id),
+                        Sum(query_time_ms::double precision),
+                        Sum(query_time_ms::double precision ^ 2),
+                        Min(query_time_ms),
+                        Max(query_time_ms)
+                    FROM
+                        query_logs
+                    WHERE
+                        timestamp > %(high_water_mark)s
+                        AND timestamp <= %(new_high_water_mark)s
+                        AND query_hash IS NOT NULL
+                        AND query_time_ms IS NOT NULL
+                    GROUP BY
+                        subgraph,
+                        query_hash,
+                        date_trunc('hour', timestamp, 'UTC')
+                    ON CONFLICT (subgraph, query_hash, bucket)
+                        DO
+                        UPDATE SET
+                            count       = rollup.count + EXCLUDED.count,
+                            sum_time    = rollup.sum_time + EXCLUDED.sum_time,
+                            sum_sq_time = rollup.sum_sq_time + EXCLUDED.sum_sq_time,
+                            min_time    = LEAST(rollup.min_time, EXCLUDED.min_time),
+                            max_time    = GREATEST(rollup.max_time, EXCLUDED.max_time)
+                    """,
+                    {
+                        "high_water_mark": high_water_mark,
+                        "new_high_water_mark": new_high_water_mark,
+                    },
+                    prepare=True,
+                    binary=True,
+                )
+                await connection.execute(
+                    """
+                    INSERT INTO query_stats_sketch AS sketch (
+                        subgraph,
+                        query_hash,
+                        bucket,
+                        bin,
+                        count
+                    )
+                    SELECT
+                        subgraph,
+                        query_hash,
+                        date_trunc('hour', timestamp, 'UTC'),
+                        CASE WHEN query_time_ms > 0 THEN
+                            ceil(ln(query_time_ms) / ln(%(sketch_gamma)s))
+                        ELSE
+                            -1
+                        END,
+                        count(id)
+                    FROM
+                        query_logs
+                    WHERE
+                        timestamp > %(high_water_mark)s
+                        AND timestamp <= %(new_high_water_mark)s
+                        AND query_hash IS NOT NULL
+                        AND query_time_ms IS NOT NULL
+                    GROUP BY
+                        1, 2, 3, 4
+                    ON CONFLICT (subgraph, query_hash, bucket, bin)
+                        DO
+                        UPDATE SET
+                            count = sketch.count + EXCLUDED.count
+                    """,
+                    {
+                        "high_water_mark": high_water_mark,
+                        "new_high_water_mark": new_high_water_mark,
+                        "sketch_gamma": LogsDB._sketch_gamma(),
+                    },
+                    prepare=True,
+                    binary=True,
+                )
+                await connection.execute(
+                    """
+                    UPDATE query_stats_rollup_watermark
+                    SET high_water_mark = %(new_high_water_mark)s
+                    """,
+                    {"new_high_water_mark": new_high_water_mark},
+                    prepare=True,
+                    binary=True,
+                )
+
+    async def compact_query_stats_rollup(
+        self, compact_before: datetime, expire_before: Optional[datetime] = None
+    ) -> None:
+        """Folds the hourly `query_stats_rollup` and `query_stats_sketch` buckets of
+        the days before `compact_before` into daily buckets, and deletes the buckets
+        before `expire_before`, so that the rollup does not grow by an hour of rows
+        per query skeleton forever.
+
+        The daily buckets keep the sums, minimums, maximums and sketch bins of their
+        hours, at the timestamp of the start of their day: the time windows then
+        select them whole, and the decay weighs them as of the start of the day.
+
+        Serialized with `update_query_stats_rollup` on the high-water mark row.
+
+        Args:
+            compact_before (datetime): Only the days entirely before this are folded.
+                It should be older than the time window the models are built from,
+                for the window to only select whole days.
+            expire_before (Optional[datetime], optional): Delete the buckets before
+                this. Defaults to None (keep all the history).
+        """
+        async with self.pgpool.connection() as connection:
+            async with connection.transaction():
+                await connection.execute(
+                    "SELECT FROM query_stats_rollup_watermark FOR UPDATE",
+                    prepare=True,
+                )
+                params = {
+                    "compact_before": compact_before,
+                    "expire_before": expire_before,
+                }
+                if expire_before is not None:
+                    for table in ("query_stats_rollup", "query_stats_sketch"):
+                        await connection.execute(
+                            sql.SQL(
+                                "DELETE FROM {} WHERE bucket < %(expire_before)s"
+                            ).format(sql.Identifier(table)),
+                            params,
+                        )
+
+                # The first hour of each day becomes the daily bucket, which the
+                # other hours are merged into.
+                await connection.execute(
+                    """
+                    WITH hours AS (
+                        DELETE FROM
+                            query_stats_rollup
+                        WHERE
+                            bucket < date_trunc('day', %(compact_before)s, 'UTC')
+                            AND bucket <> date_trunc('day', bucket, 'UTC')
+                        RETURNING
+                            *
+                    )
+                    INSERT INTO query_stats_rollup AS rollup (
+                        subgraph,
+                        query_hash,
+                        bucket,
+                        count,
+                        sum_time,
+                        sum_sq_time,
+                        min_time,
+                        max_time
+                    )
+                    SELECT
+                        subgraph,
+                        query_hash,
+                        date_trunc('day', bucket, 'UTC'),
+                        Sum(count),
+                        Sum(sum_time),
+                        Sum(sum_sq_time),
+                        Min(min_time),
+                        Max(max_time)
+                    FROM
+                        hours
+                    GROUP BY
+                        1, 2, 3
+                    ON CONFLICT (subgraph, query_hash, bucket)
+                        DO
+                        UPDATE SET
+                            count       = rollup.count + EXCLUDED.count,
+                            sum_time    = rollup.sum_time + EXCLUDED.sum_time,
+                            sum_sq_time = rollup.sum_sq_time + EXCLUDED.sum_sq_time,
+                            min_time    = LEAST(rollup.min_time, EXCLUDED.min_time),
+                            max_time    = GREATEST(rollup.max_time, EXCLUDED.max_time)
+                    """,
+                    params,
+                )
+                await connection.execute(
+                    """
+                    WITH hours AS (
+                        DELETE FROM
+                            query_stats_sketch
+                        WHERE
+                            bucket < date_trunc('day', %(compact_before)s, 'UTC')
+                            AND bucket <> date_trunc('day', bucket, 'UTC')
+                        RETURNING
+                            *
+                    )
+                    INSERT INTO query_stats_sketch AS sketch (
+                        subgraph,
+                        query_hash,
+                        bucket,
+                        bin,
+                        count
+                    )
+                    SELECT
+                        subgraph,
+                        query_hash,
+                        date_trunc('day', bucket, 'UTC'),
+                        bin,
+                        Sum(count)
+                    FROM
+                        hours
+                    GROUP BY
+                        1, 2, 3, 4
+                    ON CONFLICT (subgraph, query_hash, bucket, bin)
+                        DO
+                        UPDATE SET
+                            count = sketch.count + EXCLUDED.count
+                    """,
+                    params,
+                )
+
+    async def _replica_lag(self) -> Optional[timedelta]:
+        """Replication lag of the read replica: the age of the last transaction it
+        replayed, or zero when it is not in recovery, or streaming from the primary
+        and has replayed all the WAL it received.
+
+        A replica disconnected from the primary replays all the WAL it received, but
+        falls behind: its lag then grows with the age of its last transaction.
+
+        Returns:
+            Optional[timedelta]: The replication lag, None if unknown (no transaction
+                replayed yet).
+        """
+        assert self.replica_pgpool
+        async with self.replica_pgpool.connection() as connection:
+            # The WAL receiver's status is only visible to the roles with the
+            # privileges of pg_read_all_stats. Otherwise the lag is always the age
+            # of the last replayed transaction.
+            cursor = await connection.execute(
+                """
                 SELECT
-                    query,
-                    count_id,
-                    min_time,
-                    max_time,
-                    avg_time,
-                    stddev_time
+                    CASE
+                        WHEN NOT pg_is_in_recovery()
+                        THEN interval '0'
+                        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn()
+                            AND EXISTS (
+                                SELECT FROM
+                                    pg_stat_wal_receiver
+                                WHERE
+                                    status = 'streaming'
+                            )
+                        THEN interval '0'
+                        ELSE now() - pg_last_xact_replay_timestamp()
+                    END
+                """,
+                prepare=True,
+            )
+            row = await cursor.fetchone()
+        return row[0] if row else None
+
+    async def _read_pgpool(self) -> psycopg_pool.AsyncConnectionPool:
+        """Pool to run the read-only aggregations on: the read replica if any,
+        reachable and lagging by at most `replica_max_lag`, the primary otherwise.
+
+        The writes (rollup) always go to the primary.
+        """
+        if self.replica_pgpool is None:
+            return self.pgpool
+
+        try:
+            # Not waiting for an unreachable replica up to the pool timeout, on
+            # every aggregation
+            lag = await aio.wait_for(
+                self._replica_lag(), self.replica_lag_timeout.total_seconds()
+            )
+        except aio.TimeoutError:
+            logging.warning("Read replica lag check timed out, using the primary.")
+            return self.pgpool
+        except psycopg.Error:
+            logging.exception(
+                "Error while checking the read replica lag, using the primary."
+            )
+            return self.pgpool
+
+        if lag is None:
+            logging.warning("Unknown read replica lag, using the primary.")
+            return self.pgpool
+        replica_lag_gauge.set(lag.total_seconds())
+        if lag > self.replica_max_lag:
+            logging.warning("Read replica lagging by %s, using the primary.", lag)
+            return self.pgpool
+        return self.replica_pgpool
+
+    @staticmethod
+    def _sketch_gamma() -> float:
+        return (1 + LogsDB.sketch_relative_accuracy) / (
+            1 - LogsDB.sketch_relative_accuracy
+        )
+
+    @staticmethod
+    def _weighted_stats(
+        count: sql.Composable, sum_time: sql.Composable, sum_sq_time: sql.Composable
+    ) -> sql.Composable:
+        """Count, average and sample standard deviation from (weighted) count, sum
+        and sum of squares aggregates."""
+        return sql.SQL(
+            """
+                        {count} as count_id,
+                        {sum_time} / {count} as avg_time,
+                        CASE WHEN {count} > 1 THEN
+                            sqrt(
+                                greatest(
+                                    {sum_sq_time} - {sum_time} ^ 2 / {count}, 0
+                                ) / ({count} - 1)
+                            )
+                        END as stddev_time"""
+        ).format(count=count, sum_time=sum_time, sum_sq_time=sum_sq_time)
+
+    async def _sample_fractions(
+        self, subgraph_ipfs_hashes: Collection[str], sample_size: Optional[int]
+    ) -> Dict[str, float]:
+        """Fraction of the query logs to sample for each subgraph estimated to have
+        more than `sample_size` of them, so that about `sample_size` are aggregated.
+
+        The query logs of each subgraph are estimated from the planner statistics
+        of `query_logs` (see `ANALYZE`): its number of rows, times the frequency of
+        the subgraph among its most common values. The other subgraphs, not among
+        the most common values or without statistics, are aggregated exactly.
+
+        The pages are sampled from the whole table, whatever the subgraph: sampling
+        a fraction of a subgraph's query logs reads that fraction of all the pages
+        of `query_logs`. The subgraphs with too small a share of the table to read
+        fewer pages than their query logs (which their exact aggregation reads at
+        most, with the `(subgraph, query_hash)` index) are aggregated exactly too.
+
+        Returns:
+            Dict[str, float]: Sample fraction of each subgraph to sample.
+        """
+        if sample_size is None:
+            return dict()
+
+        async with self.pgpool.connection() as connection:
+            cursor = await connection.execute(
+                """
+                SELECT
+                    mcv.subgraph::text,
+                    mcv.frequency * tables.rows,
+                    tables.pages
                 FROM
-                    query_skeletons
-                INNER JOIN
-                (
+                    (
+                        SELECT
+                            Sum(greatest(reltuples, 0)) AS rows,
+                            Sum(relpages) AS pages
+                        FROM
+                            pg_class
+                        WHERE
+                            relkind = 'r'
+                            AND (
+                                oid = 'query_logs'::regclass
+                                OR oid IN (
+                                    SELECT relid
+                                    FROM pg_partition_tree('query_logs'::regclass)
+                                )
+                            )
+                    ) AS tables,
+                    pg_stats,
+                    unnest(
+                        most_common_vals::text::char(46)[], most_common_freqs
+                    ) AS mcv(subgraph, frequency)
+                WHERE
+                    (quote_ident(schemaname) || '.' || quote_ident(tablename))::regclass
+                        = 'query_logs'::regclass
+                    AND attname = 'subgraph'
+                    AND inherited = (
+                        SELECT relkind = 'p'
+                        FROM pg_class
+                        WHERE oid = 'query_logs'::regclass
+                    )
+                    AND mcv.subgraph = ANY(%(subgraphs)s::char(46)[])
+                """,
+                {"subgraphs": list(subgraph_ipfs_hashes)},
+                prepare=True,
+            )
+            estimated_rows = await cursor.fetchall()
+
+        return {
+            subgraph: sample_size / rows
+            for subgraph, rows, pages in estimated_rows
+            if rows > sample_size and sample_size / rows * pages < rows
+        }
+
+    async def _most_frequent_queries_sql(
+        self,
+        subgraph_filter: sql.Composable,
+        subgraph_params: Dict[str, Any],
+        min_count: int,
+        from_rollup: bool,
+        window: Optional[timedelta],
+        half_life: Optional[timedelta],
+        top_k: Optional[int],
+        coverage: Optional[float],
+        quantiles: Sequence[float],
+        long_tail: bool = False,
+        sample_fractions: Optional[Dict[str, float]] = None,
+    ) -> Tuple[sql.Composed, Dict[str, Any]]:
+        """Builds the query returning the (subgraph, hash, query, count, min_time,
+        max_time, avg_time, stddev_time, count_stderr, *quantile_times) rows of the
+        skeletons seen at least `min_count` times (less than `min_count` times with
+        `long_tail`), grouped by subgraph and ordered by descending count (ties broken
+        by hash).
+
+        All the values are passed as parameters, so that the query text only depends
+        on the options used. `subgraph_filter` selects the subgraphs with the
+        `subgraph_params` parameters.
+
+        The query logs of the subgraphs of `sample_fractions` (see
+        `_sample_fractions`) are sampled with `TABLESAMPLE SYSTEM`, which only reads
+        the sampled pages: fewer than the query logs of the subgraph with the highest
+        fraction, which its exact aggregation would read. Their counts, averages and standard deviations are then
+        estimated, with the standard error of the counts, while their min and max
+        times are the sample's.
+
+        See `get_most_frequent_queries` for the other arguments.
+
+        Returns:
+            Tuple[sql.Composed, Dict[str, Any]]: The query and its parameters.
+        """
+
+        now = datetime.now(timezone.utc)
+        timestamp = sql.Identifier("bucket" if from_rollup else "timestamp")
+        params: Dict[str, Any] = dict(subgraph_params, min_count=min_count)
+
+        if window is not None:
+            window_filter = sql.SQL("AND {timestamp} >= {cutoff}").format(
+                timestamp=timestamp,
+                cutoff=sql.SQL("date_trunc('hour', %(cutoff)s, 'UTC')")
+                if from_rollup
+                else sql.SQL("%(cutoff)s"),
+            )
+            params["cutoff"] = now - window
+        else:
+            window_filter = sql.SQL("")
+
+        if half_life is not None:
+            # The exponent is clamped, as Postgres raises an error on float underflow
+            # instead of returning 0.
+            weight = sql.SQL(
+                """exp(
+                    greatest(
+                        %(decay_rate)s
+                        * extract(epoch from %(now)s - {timestamp})::double precision,
+                        -700
+                    )
+                )"""
+            ).format(timestamp=timestamp)
+            params["decay_rate"] = math.log(0.5) / half_life.total_seconds()
+            params["now"] = now
+        else:
+            weight = None
+
+        if from_rollup:
+            if weight is None:
+                stats = LogsDB._weighted_stats(
+                    sql.SQL("Sum(count)"),
+                    sql.SQL("Sum(sum_time)"),
+                    sql.SQL("Sum(sum_sq_time)"),
+                )
+            else:
+                stats = LogsDB._weighted_stats(
+                    sql.SQL("Sum({} * count)").format(weight),
+                    sql.SQL("Sum({} * sum_time)").format(weight),
+                    sql.SQL("Sum({} * sum_sq_time)").format(weight),
+                )
+            query_stats = sql.SQL(
+                """
                     SELECT
+                        subgraph,
+                        query_hash as qhash,
+                        Min(min_time) as min_time,
+                        Max(max_time) as max_time,
+                        {stats},
+                        NULL::double precision as count_stderr
+                    FROM
+                        query_stats_rollup
+                    WHERE
+                        {subgraph_filter}
+                        {window_filter}
+                    GROUP BY
+                        subgraph,
+                        qhash
+                """
+            )
+        else:
+            if weight is None:
+                stats = sql.SQL(
+                    """
+                        count(*) as count_id,
+                        Avg(query_time_ms) as avg_time,
+                        Stddev(query_time_ms) as stddev_time"""
+                )
+            else:
+                stats = LogsDB._weighted_stats(
+                    sql.SQL("Sum({})").format(weight),
+                    sql.SQL("Sum({} * query_time_ms)").format(weight),
+                    sql.SQL("Sum({} * query_time_ms::double precision ^ 2)").format(
+                        weight
+                    ),
+                )
+            if sample_fractions:
+                subgraph_filter = sql.SQL(
+                    "{} AND NOT subgraph = ANY(%(sampled_subgraphs)s::char(46)[])"
+                ).format(subgraph_filter)
+            query_stats = sql.SQL(
+                """
+                    SELECT
+                        subgraph,
                         query_hash as qhash,
-                        count(id) as count_id,
                         Min(query_time_ms) as min_time,
                         Max(query_time_ms) as max_time,
-                        Avg(query_time_ms) as avg_time,
-                        Stddev(query_time_ms) as stddev_time 
+                        {stats},
+                        NULL::double precision as count_stderr
                     FROM
                         query_logs
                     WHERE
-                        subgraph = {hash}
+                        {subgraph_filter}
                         AND query_time_ms IS NOT NULL
+                        {window_filter}
                     GROUP BY
+                        subgraph,
                         qhash
-                    HAVING
-                        Count(id) >= {min_count}
+                """
+            )
+
+        query_stats = query_stats.format(
+            stats=stats,
+            subgraph_filter=subgraph_filter,
+            window_filter=window_filter,
+        )
+
+        if sample_fractions and not from_rollup:
+            # Two-stage sampling: the pages are sampled at the highest fraction, then
+            # the rows of each subgraph thinned down to its own fraction. Each
+            # sampled row stands for 1 / fraction rows. The count variance is
+            # estimated (conservatively) from both the per-page totals, as the rows
+            # of a page are sampled together, and the thinning of each page's rows.
+            page_fraction = max(sample_fractions.values())
+            params["sampled_subgraphs"] = list(sample_fractions)
+            params["sample_row_fractions"] = [
+                fraction / page_fraction for fraction in sample_fractions.values()
+            ]
+            params["sample_page_fraction"] = page_fraction
+            params["sample_percent"] = 100 * page_fraction
+            # Weight of each row within its page, decayed if needed
+            row_weight = (
+                sql.SQL("(1 / row_fraction)")
+                if weight is None
+                else sql.SQL("({} / row_fraction)").format(weight)
+            )
+            sampled_query_stats = sql.SQL(
+                """
+                    SELECT
+                        subgraph,
+                        qhash,
+                        Min(min_time) as min_time,
+                        Max(max_time) as max_time,
+                        {stats},
+                        sqrt(
+                            Sum(
+                                (1 - %(sample_page_fraction)s) * page_count ^ 2
+                                + page_row_variance
+                            )
+                        ) / %(sample_page_fraction)s as count_stderr
+                    FROM
+                    (
+                        SELECT
+                            subgraph,
+                            query_hash as qhash,
+                            Min(query_time_ms) as min_time,
+                            Max(query_time_ms) as max_time,
+                            Sum({row_weight}) as page_count,
+                            Sum({row_weight} * query_time_ms) as page_sum_time,
+                            Sum(
+                                {row_weight} * query_time_ms::double precision ^ 2
+                            ) as page_sum_sq_time,
+                            Sum({row_weight} ^ 2 * (1 - row_fraction))
+                                as page_row_variance
+                        FROM
+                            query_logs TABLESAMPLE SYSTEM (%(sample_percent)s::real)
+                        INNER JOIN
+                            unnest(
+                                %(sampled_subgraphs)s::char(46)[],
+                                %(sample_row_fractions)s::double precision[]
+                            ) AS sampling(subgraph, row_fraction)
+                        USING
+                            (subgraph)
+                        WHERE
+                            random() < row_fraction
+                            AND query_time_ms IS NOT NULL
+                            {window_filter}
+                        GROUP BY
+                            subgraph,
+                            qhash,
+                            query_logs.tableoid,
+                            (query_logs.ctid::text::point)[0]
+                    ) as pages
+                    GROUP BY
+                        subgraph,
+                        qhash
+                """
+            ).format(
+                stats=LogsDB._weighted_stats(
+                    sql.SQL("(Sum(page_count) / %(sample_page_fraction)s)"),
+                    sql.SQL("(Sum(page_sum_time) / %(sample_page_fraction)s)"),
+                    sql.SQL("(Sum(page_sum_sq_time) / %(sample_page_fraction)s)"),
+                ),
+                row_weight=row_weight,
+                window_filter=window_filter,
+            )
+            query_stats = sql.SQL("{} UNION ALL {}").format(
+                query_stats, sampled_query_stats
+            )
+        most_frequent_queries = self._most_frequent_queries_cutoff_sql(
+            query_stats, top_k, coverage, long_tail
+        )
+        if top_k is not None:
+            params["top_k"] = top_k
+        if coverage is not None:
+            params["coverage"] = coverage
+
+        if not quantiles:
+            return most_frequent_queries, params
+
+        # Estimate the quantiles from the merged sketches of the selected skeletons
+        # only.
+        assert from_rollup, "Query time quantiles are only kept in the rollup."
+        quantile_columns = []
+        quantile_joins = []
+        for i, quantile in enumerate(quantiles):
+            quantile_alias = sql.Identifier(f"quantile_{i}")
+            quantile_columns.append(sql.SQL("{}.quantile_time").format(quantile_alias))
+            quantile_joins.append(
+                sql.SQL(
+                    """
+                LEFT JOIN LATERAL
+                (
+                    SELECT
+                        CASE WHEN bin < 0 THEN
+                            0
+                        ELSE
+                            2 * %(sketch_gamma)s ^ bin / (%(sketch_gamma)s + 1)
+                        END as quantile_time
+                    FROM
+                    (
+                        SELECT
+                            bin,
+                            Sum({count}) OVER (ORDER BY bin) as cumulative_count,
+                            Sum({count}) OVER () as total_count
+                        FROM
+                            query_stats_sketch
+                        WHERE
+                            subgraph = most_frequent_queries.subgraph
+                            AND query_hash = most_frequent_queries.hash
+                            {window_filter}
+                        GROUP BY
+                            bin
+                    ) as bins
+                    WHERE
+                        cumulative_count >= {quantile} * total_count
+                    ORDER BY
+                        bin
+                    LIMIT 1
+                ) as {quantile_alias}
+                ON TRUE"""
+                ).format(
+                    count=sql.SQL("Sum(count)")
+                    if weight is None
+                    else sql.SQL("Sum({} * count)").format(weight),
+                    window_filter=window_filter,
+                    quantile=sql.Placeholder(f"quantile_{i}"),
+                    quantile_alias=quantile_alias,
+                )
+            )
+            params[f"quantile_{i}"] = quantile
+        params["sketch_gamma"] = LogsDB._sketch_gamma()
+
+        query = sql.SQL(
+            """
+                SELECT
+                    most_frequent_queries.*,
+                    {quantile_columns}
+                FROM
+                (
+                    {most_frequent_queries}
+                ) as most_frequent_queries
+                {quantile_joins}
+                ORDER BY
+                    subgraph,
+                    count_id DESC,
+                    hash
+                """
+        ).format(
+            quantile_columns=sql.SQL(", ").join(quantile_columns),
+            most_frequent_queries=most_frequent_queries,
+            quantile_joins=sql.SQL("").join(quantile_joins),
+        )
+        return query, params
+
+    @staticmethod
+    def _most_frequent_queries_cutoff_sql(
+        query_stats: sql.Composable,
+        top_k: Optional[int],
+        coverage: Optional[float],
+        long_tail: bool = False,
+    ) -> sql.Composed:
+        """Joins the per-skeleton statistics to the skeletons, and applies the
+        `min_count`, `top_k` and `coverage` cutoffs, passed as the parameters of the
+        same names.
+
+        With `long_tail`, keeps the skeletons below `min_count` instead."""
+
+        if long_tail:
+            assert top_k is None and coverage is None
+        if top_k is None and coverage is None:
+            return sql.SQL(
+                """
+                SELECT
+                    subgraph,
+                    hash,
+                    query,
+                    count_id,
+                    min_time,
+                    max_time,
+                    avg_time,
+                    stddev_time,
+                    count_stderr
+                FROM
+                    query_skeletons
+                INNER JOIN
+                (
+                    {query_stats}
                 ) as query_logs
                 ON
                     qhash = hash
+                WHERE
+                    count_id {operator} %(min_count)s
                 ORDER BY
-                    count_id DESC
+                    subgraph,
+                    count_id DESC,
+                    hash
                 """
-                ).format(hash=subgraph_ipfs_hash, min_count=str(min_count)),
+            ).format(
+                query_stats=query_stats,
+                operator=sql.SQL("<" if long_tail else ">="),
             )
-        rows = await rows.fetchall()
+
+        # Rank the skeletons of each subgraph by count, and compute the share of the
+        # subgraph's queries covered by the more frequent skeletons (including the ones
+        # below min_count).
+        cutoffs = []
+        if top_k is not None:
+            cutoffs.append(sql.SQL("rank <= %(top_k)s"))
+        if coverage is not None:
+            cutoffs.append(sql.SQL("preceding_count < %(coverage)s * total_count"))
+        return sql.SQL(
+            """
+                SELECT
+                    subgraph,
+                    hash,
+                    query,
+                    count_id,
+                    min_time,
+                    max_time,
+                    avg_time,
+                    stddev_time,
+                    count_stderr
+                FROM
+                (
+                    SELECT
+                        subgraph,
+                        hash,
+                        query,
+                        count_id,
+                        min_time,
+                        max_time,
+                        avg_time,
+                        stddev_time,
+                        count_stderr,
+                        row_number() OVER ranking as rank,
+                        Sum(count_id) OVER ranking - count_id as preceding_count,
+                        Sum(count_id) OVER (PARTITION BY subgraph) as total_count
+                    FROM
+                        query_skeletons
+                    INNER JOIN
+                    (
+                        {query_stats}
+                    ) as query_logs
+                    ON
+                        qhash = hash
+                    WINDOW ranking AS (
+                        PARTITION BY subgraph ORDER BY count_id DESC, hash
+                    )
+                ) as ranked_query_logs
+                WHERE
+                    count_id >= %(min_count)s
+                    AND {cutoffs}
+                ORDER BY
+                    subgraph,
+                    count_id DESC,
+                    hash
+                """
+        ).format(
+            query_stats=query_stats,
+            cutoffs=sql.SQL(" AND ").join(cutoffs),
+        )
+
+    def _row_to_query_stats(
+        self, row, quantiles: Sequence[float] = ()
+    ) -> "LogsDB.QueryStats":
+        """Converts a (hash, query, count, min_time, max_time, avg_time, stddev_time,
+        count_stderr, *quantile_times) row."""
+        return LogsDB.QueryStats(
+            query=self._cached_query_body(row[0], row[1]),
+            # Weighted counts are fractional
+            count=round(row[2]),
+            min_time=row[3],
+            max_time=row[4],
+            avg_time=float(row[5]),
+            # Stddev is NULL for single-sample skeletons
+            stddev_time=float(row[6]) if row[6] is not None else 0.0,
+            # Quantile times are NULL without any query time sample (rollup rows
+            # of query logs without query time)
+            quantile_times={
+                quantile: float(quantile_time)
+                for quantile, quantile_time in zip(quantiles, row[8:])
+                if quantile_time is not None
+            }
+            if quantiles
+            else None,
+            count_stderr=float(row[7]) if row[7] is not None else None,
+        )
+
+    async def iter_most_frequent_queries(
+        self,
+        subgraph_ipfs_hash: str,
+        min_count: int = 100,
+        from_rollup: bool = False,
+        window: Optional[timedelta] = None,
+        half_life: Optional[timedelta] = None,
+        top_k: Optional[int] = None,
+        coverage: Optional[float] = None,
+        quantiles: Sequence[float] = (),
+        sample_size: Optional[int] = None,
+    ) -> AsyncIterator["LogsDB.QueryStats"]:
+        """Streams the statistics of the query skeletons seen at least `min_count`
+        times for a subgraph, most frequent first.
+
+        The rows are fetched in batches from a server-side cursor, so that the memory
+        usage does not depend on the number of skeletons.
+
+        Args:
+            subgraph_ipfs_hash (str): Subgraph IPFS hash.
+            min_count (int, optional): Minimum number of queries for a skeleton to be
+                returned. Defaults to 100.
+            from_rollup (bool, optional): Read the precomputed `query_stats_rollup`
+                (see `update_query_stats_rollup`) instead of aggregating the whole
+                `query_logs` history of the subgraph. Defaults to False.
+            window (Optional[timedelta], optional): Only take into account the queries
+                logged within that duration. With `from_rollup`, the window is rounded
+                up to the hour. Defaults to None (all history).
+            half_life (Optional[timedelta], optional): Exponentially decay the weight
+                of each logged query with its age, halving it every `half_life`. The
+                counts, averages and standard deviations are then weighted, while the
+                min and max times are not. Defaults to None (no decay).
+            top_k (Optional[int], optional): Only return the `top_k` most frequent
+                skeletons. Defaults to None (no limit).
+            coverage (Optional[float], optional): Only return the most frequent
+                skeletons needed to cover that fraction (between 0 and 1) of all the
+                subgraph's queries. Defaults to None (no limit).
+            quantiles (Sequence[float], optional): Query time quantiles (between 0 and
+                1) to estimate for each skeleton, within `sketch_relative_accuracy`.
+                Requires `from_rollup`. Defaults to none.
+            sample_size (Optional[int], optional): Aggregate a sample of about that
+                many query logs of the subgraph, if it has more, rather than all of
+                them, so that the aggregation cost does not grow with the query
+                logs. The counts are then scaled up, with their standard error in
+                `count_stderr`. Ignored with `from_rollup`, which is already bounded.
+                Defaults to None (exact aggregation).
+
+        Yields:
+            LogsDB.QueryStats: Query skeleton statistics.
+        """
+
+        query, params = await self._most_frequent_queries_sql(
+            subgraph_filter=sql.SQL("subgraph = %(subgraph)s"),
+            subgraph_params={"subgraph": subgraph_ipfs_hash},
+            min_count=min_count,
+            from_rollup=from_rollup,
+            window=window,
+            half_life=half_life,
+            top_k=top_k,
+            coverage=coverage,
+            quantiles=quantiles,
+            sample_fractions=await self._sample_fractions(
+                [subgraph_ipfs_hash], sample_size if not from_rollup else None
+            ),
+        )
+        async with (await self._read_pgpool()).connection() as connection:
+            async with connection.cursor(name="most_frequent_queries") as cursor:
+                await cursor.execute(query, params, binary=True)
+                async for row in cursor:
+                    yield self._row_to_query_stats(row[1:], quantiles)
+
+    async def get_most_frequent_queries(
+        self, subgraph_ipfs_hash: str, min_count: int = 100, **kwargs
+    ) -> List["LogsDB.QueryStats"]:
+        """Returns the statistics of the query skeletons seen at least `min_count`
+        times for a subgraph, most frequent first.
+
+        See `iter_most_frequent_queries` for the arguments.
+        """
         return [
-            LogsDB.QueryStats(
-                query=self.return_query_body(row[0])
-                if self.return_query_body(row[0])
-                else "null",
-                count=row[1],
-                min_time=row[2],
-                max_time=row[3],
-                avg_time=float(row[4]),
-                stddev_time=float(row[5]),
+            query_stats
+            async for query_stats in self.iter_most_frequent_queries(
+                subgraph_ipfs_hash, min_count, **kwargs
             )
-            for row in rows
         ]
+
+    async def get_most_frequent_queries_bulk(
+        self,
+        subgraph_ipfs_hashes: Collection[str],
+        min_count: int = 100,
+        from_rollup: bool = False,
+        window: Optional[timedelta] = None,
+        half_life: Optional[timedelta] = None,
+        top_k: Optional[int] = None,
+        coverage: Optional[float] = None,
+        quantiles: Sequence[float] = (),
+        sample_size: Optional[int] = None,
+    ) -> AsyncIterator[Tuple[str, "LogsDB.QueryStats"]]:
+        """Same as `iter_most_frequent_queries`, but for many subgraphs in a single
+        aggregation.
+
+        The rows are grouped by subgraph, most frequent first within each subgraph.
+        Subgraphs without any qualifying query skeleton do not appear. The `top_k` and
+        `coverage` limits apply to each subgraph.
+
+        Args:
+            subgraph_ipfs_hashes (Collection[str]): Subgraph IPFS hashes.
+
+        Yields:
+            Tuple[str, LogsDB.QueryStats]: Subgraph IPFS hash and query statistics.
+        """
+
+        query, params = await self._most_frequent_queries_sql(
+            subgraph_filter=sql.SQL("subgraph = ANY(%(subgraphs)s::char(46)[])"),
+            subgraph_params={"subgraphs": list(subgraph_ipfs_hashes)},
+            min_count=min_count,
+            from_rollup=from_rollup,
+            window=window,
+            half_life=half_life,
+            top_k=top_k,
+            coverage=coverage,
+            quantiles=quantiles,
+            sample_fractions=await self._sample_fractions(
+                subgraph_ipfs_hashes, sample_size if not from_rollup else None
+            ),
+        )
+        async with (await self._read_pgpool()).connection() as connection:
+            async with connection.cursor(name="most_frequent_queries_bulk") as cursor:
+                await cursor.execute(query, params, binary=True)
+                async for row in cursor:
+                    yield row[0], self._row_to_query_stats(row[1:], quantiles)
+
+    async def iter_logged_queries(
+        self,
+        subgraph_ipfs_hash: str,
+        window: Optional[timedelta] = None,
+        limit: Optional[int] = None,
+    ) -> AsyncIterator[Tuple[str, Optional[Dict[str, Any]]]]:
+        """Streams the logged queries of a subgraph, most recent first, to replay
+        them offline (see `agora_evaluator.AgoraModel.replay`).
+
+        Args:
+            subgraph_ipfs_hash (str): Subgraph IPFS hash.
+            window (Optional[timedelta], optional): Only return the queries logged
+                within that duration. Defaults to None (all history).
+            limit (Optional[int], optional): Maximum number of queries to return.
+                Defaults to None (no limit).
+
+        Yields:
+            Tuple[str, Optional[Dict[str, Any]]]: Query skeleton and query variables.
+        """
+
+        if window is not None:
+            window_filter = sql.SQL("AND timestamp >= %(cutoff)s")
+        else:
+            window_filter = sql.SQL("")
+        query = sql.SQL(
+            """
+            SELECT
+                query,
+                query_variables
+            FROM
+                query_logs
+            INNER JOIN
+                query_skeletons
+            ON
+                query_hash = hash
+            WHERE
+                subgraph = %(subgraph)s
+                {window_filter}
+            ORDER BY
+                timestamp DESC
+            {limit}
+            """
+        ).format(
+            window_filter=window_filter,
+            limit=sql.SQL("LIMIT %(limit)s") if limit is not None else sql.SQL(""),
+        )
+        params = {
+            "subgraph": subgraph_ipfs_hash,
+            "cutoff": datetime.now(timezone.utc) - window if window else None,
+            "limit": limit,
+        }
+        async with (await self._read_pgpool()).connection() as connection:
+            async with connection.cursor(name="logged_queries") as cursor:
+                await cursor.execute(query, params, binary=True)
+                async for query_text, query_variables in cursor:
+                    if query_variables:
+                        query_variables = json.loads(query_variables)
+                    yield query_text, query_variables or None
+
+    async def get_long_tail_queries_bulk(
+        self,
+        subgraph_ipfs_hashes: Collection[str],
+        min_count: int = 100,
+        from_rollup: bool = False,
+        window: Optional[timedelta] = None,
+        half_life: Optional[timedelta] = None,
+        sample_size: Optional[int] = None,
+    ) -> AsyncIterator[Tuple[str, str, float, float]]:
+        """Streams the query skeletons seen less than `min_count` times, which are
+        not priced individually, with their count and average time.
+
+        The rows are grouped by subgraph. The query skeletons are returned as
+        logged, without normalizing their body.
+
+        See `iter_most_frequent_queries` for the arguments.
+
+        Args:
+            subgraph_ipfs_hashes (Collection[str]): Subgraph IPFS hashes.
+
+        Yields:
+            Tuple[str, str, float, float]: Subgraph IPFS hash, query skeleton, count
+                and average query time.
+        """
+
+        query, params = await self._most_frequent_queries_sql(
+            subgraph_filter=sql.SQL("subgraph = ANY(%(subgraphs)s::char(46)[])"),
+            subgraph_params={"subgraphs": list(subgraph_ipfs_hashes)},
+            min_count=min_count,
+            from_rollup=from_rollup,
+            window=window,
+            half_life=half_life,
+            top_k=None,
+            coverage=None,
+            quantiles=(),
+            long_tail=True,
+            sample_fractions=await self._sample_fractions(
+                subgraph_ipfs_hashes, sample_size if not from_rollup else None
+            ),
+        )
+        async with (await self._read_pgpool()).connection() as connection:
+            async with connection.cursor(name="long_tail_queries") as cursor:
+                await cursor.execute(query, params, binary=True)
+                async for row in cursor:
+                    yield row[0], row[2], float(row[3]), float(row[6])
+
+    async def get_model_rebuild_watermarks(
+        self, subgraphs: Collection[str]
+    ) -> Dict[str, Tuple[Optional[datetime], datetime]]:
+        """Returns the persisted high-water mark and build time of the models of the
+        subgraphs (see `set_model_rebuild_watermarks`).
+
+        Args:
+            subgraphs (Collection[str]): Subgraph IPFS hashes.
+
+        Returns:
+            Dict[str, Tuple[Optional[datetime], datetime]]: High-water mark and
+                build time of the subgraphs whose model was built.
+        """
+        async with self.pgpool.connection() as connection:
+            cursor = await connection.execute(
+                """
+                SELECT
+                    subgraph::text,
+                    high_water_mark,
+                    built_at
+                FROM
+                    model_rebuild_watermark
+                WHERE
+                    subgraph = ANY(%s::char(46)[])
+                """,
+                [list(subgraphs)],
+                prepare=True,
+                binary=True,
+            )
+            return {
+                subgraph: (high_water_mark, built_at)
+                async for subgraph, high_water_mark, built_at in cursor
+            }
+
+    async def set_model_rebuild_watermarks(
+        self, watermarks: Dict[str, Tuple[Optional[datetime], datetime]]
+    ) -> None:
+        """Persists the high-water mark and build time of the models of subgraphs,
+        for `ModelRebuildTrigger` to resume from after a restart, rather than count
+        all their query logs again.
+
+        Args:
+            watermarks (Dict[str, Tuple[Optional[datetime], datetime]]): High-water
+                mark and build time of each subgraph IPFS hash.
+        """
+        if not watermarks:
+            return
+        async with self.pgpool.connection() as connection:
+            async with connection.cursor() as cursor:
+                await cursor.executemany(
+                    """
+                    INSERT INTO model_rebuild_watermark (
+                        subgraph,
+                        high_water_mark,
+                        built_at
+                    )
+                    VALUES (%s, %s, %s)
+                    ON CONFLICT (subgraph)
+                        DO
+                        UPDATE SET
+                            high_water_mark = EXCLUDED.high_water_mark,
+                            built_at = EXCLUDED.built_at
+                    """,
+                    [
+                        (subgraph, high_water_mark, built_at)
+                        for subgraph, (
+                            high_water_mark,
+                            built_at,
+                        ) in watermarks.items()
+                    ],
+                )
+
+    async def get_new_query_logs(
+        self, high_water_marks: Dict[str, Optional[datetime]]
+    ) -> Dict[str, Tuple[int, Optional[datetime]]]:
+        """Counts the query logs of each subgraph logged after its high-water mark,
+        typically the latest query log its model was built from.
+
+        Only the rows after the high-water marks are scanned, with the
+        `(subgraph, timestamp)` index.
+
+        Args:
+            high_water_marks (Dict[str, Optional[datetime]]): High-water mark of each
+                subgraph IPFS hash, None to count all its query logs.
+
+        Returns:
+            Dict[str, Tuple[int, Optional[datetime]]]: Number of new query logs of
+                each subgraph, and its new high-water mark (the latest timestamp
+                of its query logs).
+        """
+        subgraphs = list(high_water_marks)
+        async with (await self._read_pgpool()).connection() as connection:
+            cursor = await connection.execute(
+                """
+                SELECT
+                    marks.subgraph::text,
+                    new_logs.count,
+                    coalesce(new_logs.high_water_mark, marks.high_water_mark)
+                FROM
+                    unnest(
+                        %(subgraphs)s::char(46)[],
+                        %(high_water_marks)s::timestamptz[]
+                    ) AS marks(subgraph, high_water_mark)
+                CROSS JOIN LATERAL (
+                    SELECT
+                        count(*) AS count,
+                        max(timestamp) AS high_water_mark
+                    FROM
+                        query_logs
+                    WHERE
+                        query_logs.subgraph = marks.subgraph
+                        AND query_logs.timestamp
+                            > coalesce(marks.high_water_mark, '-infinity')
+                ) AS new_logs
+                """,
+                {
+                    "subgraphs": subgraphs,
+                    "high_water_marks": [
+                        high_water_marks[subgraph] for subgraph in subgraphs
+                    ],
+                },
+                prepare=True,
+                binary=True,
+            )
+            return {
+                subgraph: (count, high_water_mark)
+                async for subgraph, count, high_water_mark in cursor
+            }
@@ -0,0 +1,186 @@
+# Copyright 2023-, Semiotic AI, Inc.
+# SPDX-License-Identifier: Apache-2.0
+
+"""Per root field costs for the long tail of query skeletons, too infrequent to be
+priced individually.
+
+The average time of each long tail skeleton is modeled as the sum of a cost per root
+field it selects, fitted by least squares weighted by the skeletons' counts. Each
+fitted root field then gets a generic Agora statement such as
+`query { values } => 1.5 * $GLOBAL_COST_MULTIPLIER;`, which matches that root field
+whatever its arguments and sub-selections, since Agora prices each root field of a
+query separately.
+"""
+
+import logging
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Tuple
+
+import graphql
+import numpy as np
+from graphql import language
+
+# Number of skeletons whose features are densified at once
+_CHUNK_SIZE = 4096
+
+
+@dataclass
+class RootFieldCost:
+    root_field: str
+    # Number of long tail queries selecting the root field
+    count: int
+    # Fitted query time of the root field
+    time: float
+
+
+def root_fields(query: str) -> List[str]:
+    """Names of the root fields selected by a query, once per selection.
+
+    Args:
+        query (str): GraphQL query.
+
+    Returns:
+        List[str]: Root field names. `__typename` is left out, as it is free.
+    """
+    document = graphql.parse(query)
+    operation = next(
+        (
+            definition
+            for definition in document.definitions
+            if isinstance(definition, language.OperationDefinitionNode)
+        ),
+        None,
+    )
+    if operation is None:
+        return []
+    return [
+        selection.name.value
+        for selection in operation.selection_set.selections
+        if isinstance(selection, language.FieldNode)
+        and selection.name.value != "__typename"
+    ]
+
+
+def _normal_equations(
+    rows: np.ndarray,
+    columns: np.ndarray,
+    weights: np.ndarray,
+    times: np.ndarray,
+    n_columns: int,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Computes A^T W A and A^T W y, where A[i, j] is the number of selections of
+    root field j by skeleton i, given as the coordinates of each selection. A is
+    sparse, so it is only densified by chunks of rows."""
+    gram = np.zeros((n_columns, n_columns))
+    moments = np.zeros(n_columns)
+    order = np.argsort(rows, kind="stable")
+    rows, columns = rows[order], columns[order]
+    n_rows = len(weights)
+    for start in range(0, n_rows, _CHUNK_SIZE):
+        stop = min(start + _CHUNK_SIZE, n_rows)
+        begin, end = np.searchsorted(rows, [start, stop])
+        block = np.zeros((stop - start, n_columns))
+        np.add.at(block, (rows[begin:end] - start, columns[begin:end]), 1.0)
+        weighted_block = block * weights[start:stop, None]
+        gram += block.T @ weighted_block
+        moments += weighted_block.T @ times[start:stop]
+    return gram, moments
+
+
+def fit_root_field_costs(
+    long_tail_queries: Iterable[Tuple[str, float, float]], min_count: float = 10
+) -> List[RootFieldCost]:
+    """Fits a cost per root field to the average times of the long tail query
+    skeletons.
+
+    Root fields selected by less than `min_count` long tail queries are not fitted,
+    and neither are the skeletons selecting them. Root fields fitted with a
+    non-positive cost are left out, and the others fitted again, so that every
+    returned cost is positive.
+
+    Args:
+        long_tail_queries (Iterable[Tuple[str, float, float]]): Query skeletons with
+            their count and average time, such as returned by
+            `LogsDB.get_long_tail_queries_bulk`.
+        min_count (float, optional): Minimum number of long tail queries selecting a
+            root field for it to be fitted. Defaults to 10.
+
+    Returns:
+        List[RootFieldCost]: Fitted root field costs, most frequent first.
+    """
+    column_indices: Dict[str, int] = dict()
+    rows, columns = [], []
+    weights, times = [], []
+    for query, count, avg_time in long_tail_queries:
+        try:
+            fields = root_fields(query)
+        except graphql.GraphQLError:
+            logging.debug("Skipped unparsable long tail query skeleton: %s", query)
+            continue
+        if not fields:
+            continue
+        for field in fields:
+            rows.append(len(weights))
+            columns.append(column_indices.setdefault(field, len(column_indices)))
+        weights.append(count)
+        times.append(avg_time)
+
+    if not weights:
+        return []
+    names = np.array(list(column_indices.keys()))
+    rows = np.array(rows)
+    columns = np.array(columns)
+    weights = np.array(weights, dtype=float)
+    times = np.array(times, dtype=float)
+
+    # Number of queries selecting each root field, counting each skeleton once
+    # whatever the aliases
+    first_selection = np.unique(
+        rows * len(column_indices) + columns, return_index=True
+    )[1]
+    supports = np.bincount(
+        columns[first_selection],
+        weights=weights[rows[first_selection]],
+        minlength=len(column_indices),
+    )
+
+    # Leave out the skeletons selecting an infrequent root field
+    infrequent_rows = np.unique(rows[supports[columns] < min_count])
+    keep_rows = np.ones(len(weights), dtype=bool)
+    keep_rows[infrequent_rows] = False
+    selection_mask = keep_rows[rows]
+    row_renumbering = np.cumsum(keep_rows) - 1
+    rows = row_renumbering[rows[selection_mask]]
+    columns = columns[selection_mask]
+    weights = weights[keep_rows]
+    times = times[keep_rows]
+    if not len(weights):
+        return []
+
+    gram, moments = _normal_equations(
+        rows, columns, weights, times, len(column_indices)
+    )
+
+    active = supports >= min_count
+    costs = np.zeros(len(column_indices))
+    while active.any():
+        indices = np.flatnonzero(active)
+        solution = np.linalg.lstsq(
+            gram[np.ix_(indices, indices)], moments[indices], rcond=None
+        )[0]
+        costs[:] = 0
+        costs[indices] = solution
+        if (solution > 0).all():
+            break
+        active[indices[solution <= 0]] = False
+
+    fitted = np.flatnonzero(costs > 0)
+    fitted = fitted[np.argsort(-supports[fitted], kind="stable")]
+    return [
+        RootFieldCost(
+            root_field=str(names[i]),
+            count=round(float(supports[i])),
+            time=float(costs[i]),
+        )
+        for i in fitted
+    ]
@@ -10,13 +10,26 @@ import psycopg_pool
 from prometheus_async.aio.web import start_http_server
 
 from autoagora.config import args, init_config
+from autoagora.db_pools import open_pools
 from autoagora.indexer_utils import get_allocated_subgraphs, set_cost_model
-from autoagora.model_builder import apply_default_model, model_update_loop
+from autoagora.model_builder import (
+    apply_default_model,
+    bulk_model_update_loop,
+    manual_entries_watcher,
+    model_update_loop,
+    query_stats_rollup_compaction_loop,
+    update_model,
+)
+from autoagora.model_rebuild_trigger import model_rebuild_trigger
+from autoagora.price_history_db import price_history_db
 from autoagora.price_multiplier import price_bandit_loop
+from autoagora.query_logs_ingestion import query_logs_ingestion
+from autoagora.query_logs_partitions import query_logs_partitions_loop
 from autoagora.query_metrics import (
     K8SServiceWatcherMetricsEndpoints,
     StaticMetricsEndpoints,
 )
+from autoagora.schema_migrations import migrate
 from autoagora.utils.constants import DEFAULT_AGORA_VARIABLES
 
 
@@ -31,13 +44,25 @@ class SubgraphUpdateLoops:
                 future.cancel()
 
 
+async def background_migrations(
+    pgpool: psycopg_pool.AsyncConnectionPool, query_logs: bool
+):
+    try:
+        await migrate(pgpool, query_logs=query_logs, background=True)
+    except aio.CancelledError:
+        raise
+    except:
+        logging.exception("Error while applying the background schema migrations.")
+
+
 async def allocated_subgraph_watcher():
     update_loops: Dict[str, SubgraphUpdateLoops] = dict()
+    bulk_model_loop: Optional[aio.Future] = None
     excluded_subgraphs = set(
         (args.relative_query_costs_exclude_subgraphs or "").split(",")
     )
 
-    # Initialize connection pool to PG database
+    # Initialize connection pools to PG database
     try:
         conn_string = (
             f"host={args.postgres_host} "
@@ -47,18 +72,43 @@ async def allocated_subgraph_watcher():
             f"port={args.postgres_port}"
         )
 
-        pgpool = psycopg_pool.AsyncConnectionPool(
-            conn_string, min_size=1, max_size=args.postgres_max_connections, open=False
+        replica_conn_string = (
+            (
+                f"host={args.postgres_replica_host} "
+                f"dbname={args.postgres_database} "
+                f"user={args.postgres_username} "
+                f'password="{args.postgres_password}" '
+                f"port={args.postgres_replica_port or args.postgres_port}"
+            )
+            if args.postgres_replica_host
+            else None
         )
-        await pgpool.open()
-        await pgpool.wait()
-        assert pgpool
+
+        pools = await open_pools(conn_string, replica_conn_string)
+        oltp_pgpool, analytics_pgpool = pools["oltp"], pools["analytics"]
+        maintenance_pgpool = pools["maintenance"]
+        replica_pgpool = pools.get("replica")
     except:
         logging.exception(
-            "Error while creating connection pool to the PostgreSQL database."
+            "Error while creating connection pools to the PostgreSQL database."
         )
         raise
 
+    # Create or update the database schema once, before any loop uses it. The query
+    # logs are only used by the relative query costs, and their ingestion.
+    query_logs = bool(
+        args.relative_query_costs
+        or args.query_logs_ingestion_source
+        or args.query_logs_partitioning
+    )
+    try:
+        await migrate(oltp_pgpool, query_logs=query_logs, background=False)
+    except:
+        logging.exception("Error while migrating the database schema.")
+        raise
+    # The index builds must not hold back the pricing loops
+    aio.ensure_future(background_migrations(maintenance_pgpool, query_logs))
+
     # Initialize indexer-service metrics endpoints
     if args.indexer_service_metrics_endpoint:  # static list
         metrics_endpoints = StaticMetricsEndpoints(
@@ -66,7 +116,37 @@ async def allocated_subgraph_watcher():
         )
     else:  # auto from k8s
         metrics_endpoints = K8SServiceWatcherMetricsEndpoints(
-            args.indexer_service_metrics_k8s_service
+            args.indexer_service_metrics_k8s_service,
+            endpoint_slices=args.indexer_service_metrics_k8s_endpoint_slices,
+        )
+
+    history_db = price_history_db(oltp_pgpool)
+
+    # Rebuild the models as new query logs arrive, rather than at a fixed interval
+    rebuild_trigger = (
+        model_rebuild_trigger(analytics_pgpool, replica_pgpool)
+        if args.relative_query_costs
+        else None
+    )
+
+    if args.query_logs_ingestion_source:
+        aio.ensure_future(query_logs_ingestion(maintenance_pgpool))
+
+    if args.query_logs_partitioning:
+        aio.ensure_future(query_logs_partitions_loop(maintenance_pgpool))
+
+    if args.relative_query_costs and args.relative_query_costs_rollup:
+        aio.ensure_future(query_stats_rollup_compaction_loop(maintenance_pgpool))
+
+    # Rebuild the model of a subgraph as soon as its manual entry is modified
+    if args.manual_entry_path:
+        aio.ensure_future(
+            manual_entries_watcher(
+                update_loops.keys,
+                lambda subgraph: update_model(
+                    subgraph, analytics_pgpool, replica_pgpool
+                ),
+            )
         )
 
     while True:
@@ -91,10 +171,15 @@ async def allocated_subgraph_watcher():
 
                 await apply_default_model(new_subgraph)
 
-                if args.relative_query_costs:
+                if args.relative_query_costs and not args.relative_query_costs_bulk:
                     # Launch the model update loop for the new subgraph
                     update_loops[new_subgraph].model = aio.ensure_future(
-                        model_update_loop(new_subgraph, pgpool)
+                        model_update_loop(
+                            new_subgraph,
+                            analytics_pgpool,
+                            replica_pgpool,
+                            rebuild_trigger,
+                        )
                     )
                     logging.info(
                         "Added model update loop for subgraph %s", new_subgraph
@@ -102,7 +187,9 @@ async def allocated_subgraph_watcher():
 
                 # Launch the price multiplier update loop for the new subgraph
                 update_loops[new_subgraph].bandit = aio.ensure_future(
-                    price_bandit_loop(new_subgraph, pgpool, metrics_endpoints)
+                    price_bandit_loop(
+                        new_subgraph, oltp_pgpool, metrics_endpoints, history_db
+                    )
                 )
                 logging.info(
                     "Added price multiplier update loop for subgraph %s", new_subgraph
@@ -112,6 +199,24 @@ async def allocated_subgraph_watcher():
             for removed_subgraph in update_loops.keys() - allocated_subgraphs:
                 del update_loops[removed_subgraph]
 
+            # Launch the single model update loop for all the subgraphs, once there
+            # are subgraphs to build models for.
+            if (
+                args.relative_query_costs
+                and args.relative_query_costs_bulk
+                and bulk_model_loop is None
+                and update_loops
+            ):
+                bulk_model_loop = aio.ensure_future(
+                    bulk_model_update_loop(
+                        update_loops.keys,
+                        analytics_pgpool,
+                        replica_pgpool,
+                        rebuild_trigger,
+                    )
+                )
+                logging.info("Added bulk model update loop")
+
         await aio.sleep(30)
 
 
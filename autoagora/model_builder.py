@@ -3,48 +3,544 @@
 
 import asyncio as aio
 import logging
+import math
 import os
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 from importlib.metadata import version
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Collection,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
 
 import psycopg_pool
-from jinja2 import Template
+from jinja2 import Environment, Template
+from prometheus_client import Gauge
 
 from autoagora.config import args
 from autoagora.indexer_utils import set_cost_model
 from autoagora.logs_db import LogsDB
+from autoagora.long_tail_costs import RootFieldCost, fit_root_field_costs
+from autoagora.model_rebuild_trigger import ModelRebuildTrigger
 from autoagora.utils.constants import AGORA_ENTRY_TEMPLATE
 
+model_coverage_gauge = Gauge(
+    "relative_query_costs_model_coverage",
+    "Share of the frequent query skeletons' volume (or revenue, see "
+    "--relative-query-costs-budget-objective) covered by the relative query costs "
+    "model's statements.",
+    ["subgraph"],
+)
 
-async def model_builder(subgraph: str, pgpool: psycopg_pool.AsyncConnectionPool) -> str:
+
+def _query_stats_options() -> Dict[str, Any]:
+    """`LogsDB.get_most_frequent_queries*` options set by the configuration."""
+    return dict(
+        from_rollup=args.relative_query_costs_rollup,
+        window=timedelta(seconds=args.relative_query_costs_window)
+        if args.relative_query_costs_window
+        else None,
+        half_life=timedelta(seconds=args.relative_query_costs_half_life)
+        if args.relative_query_costs_half_life
+        else None,
+        top_k=args.relative_query_costs_top_k,
+        coverage=args.relative_query_costs_coverage,
+        quantiles=[
+            float(quantile)
+            for quantile in args.relative_query_costs_quantiles.split(",")
+        ]
+        if args.relative_query_costs_quantiles
+        else (),
+        sample_size=args.relative_query_costs_sample_size,
+    )
+
+
+async def _long_tail_costs(
+    logs_db: LogsDB, subgraphs: Collection[str]
+) -> Dict[str, List[RootFieldCost]]:
+    """Fits the root field costs of the long tail queries of each subgraph, if
+    enabled."""
+    if not args.relative_query_costs_long_tail:
+        return dict()
+
+    options = _query_stats_options()
+    long_tail_queries: Dict[str, List[Tuple[str, float, float]]] = defaultdict(list)
+    async for subgraph, query, count, avg_time in logs_db.get_long_tail_queries_bulk(
+        subgraphs,
+        from_rollup=options["from_rollup"],
+        window=options["window"],
+        half_life=options["half_life"],
+        sample_size=options["sample_size"],
+    ):
+        long_tail_queries[subgraph].append((query, count, avg_time))
+
+    # The fit parses every long tail skeleton, so keep it off the event loop
+    loop = aio.get_running_loop()
+    return {
+        subgraph: await loop.run_in_executor(
+            None,
+            fit_root_field_costs,
+            queries,
+            args.relative_query_costs_long_tail_min_count,
+        )
+        for subgraph, queries in long_tail_queries.items()
+    }
+
+
+def _logs_db(
+    pgpool: psycopg_pool.AsyncConnectionPool,
+    replica_pgpool: Optional[psycopg_pool.AsyncConnectionPool],
+) -> LogsDB:
+    return LogsDB(
+        pgpool,
+        replica_pgpool,
+        replica_max_lag=timedelta(seconds=args.postgres_replica_max_lag),
+    )
+
+
+async def _update_rollup_if_enabled(logs_db: LogsDB):
+    if args.relative_query_costs_rollup:
+        await logs_db.update_query_stats_rollup(
+            lag=timedelta(seconds=args.relative_query_costs_rollup_lag)
+        )
+
+
+async def query_stats_rollup_compaction_loop(
+    pgpool: psycopg_pool.AsyncConnectionPool,
+    interval: timedelta = timedelta(hours=1),
+):
+    """Periodically folds the hourly query stats rollup buckets older than
+    --relative-query-costs-rollup-compaction-age into daily buckets, and deletes the
+    ones older than --query-logs-retention.
+
+    Args:
+        pgpool (psycopg_pool.AsyncConnectionPool): Logs database connection pool.
+        interval (timedelta, optional): Interval between the compactions. Defaults
+            to 1 hour.
+    """
     logs_db = LogsDB(pgpool)
-    most_frequent_queries = await logs_db.get_most_frequent_queries(subgraph)
-    model = build_template(subgraph, most_frequent_queries)
+    compaction_age = timedelta(days=args.relative_query_costs_rollup_compaction_age)
+    # The time windows must only select whole days
+    if args.relative_query_costs_window:
+        compaction_age = max(
+            compaction_age, timedelta(seconds=args.relative_query_costs_window)
+        )
+    while True:
+        now = datetime.now(timezone.utc)
+        try:
+            await logs_db.compact_query_stats_rollup(
+                now - compaction_age,
+                now - timedelta(days=args.query_logs_retention)
+                if args.query_logs_retention is not None
+                else None,
+            )
+        except aio.CancelledError:
+            raise
+        except:
+            logging.exception("Exception occurred while compacting the rollup")
+        await aio.sleep(interval.total_seconds())
+
+
+def dedupe_model_entries(
+    most_frequent_queries: List[LogsDB.QueryStats],
+) -> List[LogsDB.QueryStats]:
+    """Merges the skeletons with the same query body into a single model entry.
+
+    Skeletons that differ (such as by their variable definitions) can have the same
+    canonical query body. The indexer-service would only ever match the first of
+    their model entries, which then prices the queries of all of them.
+
+    The counts are added up, the average and standard deviation of the query times
+    pooled, and their quantiles averaged weighted by count (an approximation).
+
+    Args:
+        most_frequent_queries (List[LogsDB.QueryStats]): Candidate query skeletons.
+
+    Returns:
+        List[LogsDB.QueryStats]: The candidates with distinct query bodies, by
+            decreasing count, then in their original order.
+    """
+    merged: Dict[str, LogsDB.QueryStats] = {}
+    for query_stats in most_frequent_queries:
+        other = merged.get(query_stats.query)
+        merged[query_stats.query] = (
+            query_stats if other is None else _merge_query_stats(other, query_stats)
+        )
+    return sorted(merged.values(), key=lambda query_stats: -query_stats.count)
+
+
+def _merge_query_stats(
+    first: LogsDB.QueryStats, second: LogsDB.QueryStats
+) -> LogsDB.QueryStats:
+    """Statistics of the union of the query times of two skeletons."""
+    count = first.count + second.count
+    if count <= 0:
+        return first
+    avg_time = (first.count * first.avg_time + second.count * second.avg_time) / count
+    # Sum of the squared deviations from the pooled average (sample stddevs)
+    squared_deviations = sum(
+        max(query_stats.count - 1, 0) * query_stats.stddev_time**2
+        + query_stats.count * (query_stats.avg_time - avg_time) ** 2
+        for query_stats in (first, second)
+    )
+
+    quantile_times = first.quantile_times
+    if quantile_times and second.quantile_times:
+        quantile_times = {
+            quantile: (
+                first.count * time + second.count * second.quantile_times[quantile]
+            )
+            / count
+            for quantile, time in quantile_times.items()
+            if quantile in second.quantile_times
+        }
+
+    count_stderr = None
+    if first.count_stderr is not None or second.count_stderr is not None:
+        count_stderr = math.sqrt(
+            (first.count_stderr or 0) ** 2 + (second.count_stderr or 0) ** 2
+        )
+
+    return LogsDB.QueryStats(
+        query=first.query,
+        count=count,
+        min_time=min(first.min_time, second.min_time),
+        max_time=max(first.max_time, second.max_time),
+        avg_time=avg_time,
+        stddev_time=math.sqrt(squared_deviations / (count - 1)) if count > 1 else 0.0,
+        quantile_times=quantile_times,
+        count_stderr=count_stderr,
+    )
+
+
+def select_model_entries(
+    most_frequent_queries: List[LogsDB.QueryStats],
+    max_entries: Optional[int] = None,
+    max_bytes: Optional[int] = None,
+    objective: str = "count",
+) -> Tuple[List[LogsDB.QueryStats], float]:
+    """Selects the query skeletons to price within a model size budget, so that
+    they cover as much of the objective as possible.
+
+    Within an entries budget, the skeletons with the highest objective are kept.
+    Within a bytes budget, the skeletons are greedily kept by decreasing objective
+    per byte of query body, skipping the ones that do not fit anymore.
+
+    Args:
+        most_frequent_queries (List[LogsDB.QueryStats]): Candidate query skeletons.
+        max_entries (Optional[int], optional): Maximum number of skeletons. Defaults
+            to None (no limit).
+        max_bytes (Optional[int], optional): Maximum total size of the skeletons'
+            query bodies, in UTF-8 bytes. Defaults to None (no limit).
+        objective (str, optional): "count" to cover the most queries, "revenue" to
+            cover the most queries times priced query time. Defaults to "count".
+
+    Returns:
+        Tuple[List[LogsDB.QueryStats], float]: The selected skeletons, most frequent
+            first so that the indexer-service matches them first, and the share of
+            the candidates' objective they cover.
+    """
+    if objective == "count":
+        weights = [query_stats.count for query_stats in most_frequent_queries]
+    elif objective == "revenue":
+        weights = [
+            query_stats.count * query_stats.price_time
+            for query_stats in most_frequent_queries
+        ]
+    else:
+        raise ValueError(f"Unknown model budget objective: {objective}")
+    sizes = [len(query_stats.query.encode()) for query_stats in most_frequent_queries]
+
+    candidates = range(len(most_frequent_queries))
+    if max_bytes is None:
+        candidates = sorted(candidates, key=lambda i: -weights[i])
+    else:
+        candidates = sorted(candidates, key=lambda i: -weights[i] / max(sizes[i], 1))
+
+    selected = []
+    selected_bytes = 0
+    for i in candidates:
+        if max_entries is not None and len(selected) >= max_entries:
+            break
+        if max_bytes is not None and selected_bytes + sizes[i] > max_bytes:
+            continue
+        selected.append(i)
+        selected_bytes += sizes[i]
+
+    total_weight = sum(weights)
+    coverage = (
+        sum(weights[i] for i in selected) / total_weight if total_weight > 0 else 1.0
+    )
+    selected.sort(key=lambda i: (-most_frequent_queries[i].count, i))
+    return [most_frequent_queries[i] for i in selected], coverage
+
+
+def _apply_model_budget(
+    subgraph: str, most_frequent_queries: List[LogsDB.QueryStats]
+) -> List[LogsDB.QueryStats]:
+    """Applies the configured model size budget, and reports the resulting
+    coverage."""
+    selected_queries, coverage = select_model_entries(
+        dedupe_model_entries(most_frequent_queries),
+        max_entries=args.relative_query_costs_max_entries,
+        max_bytes=args.relative_query_costs_max_bytes,
+        objective=args.relative_query_costs_budget_objective,
+    )
+    model_coverage_gauge.labels(subgraph=subgraph).set(coverage)
+    return selected_queries
+
+
+async def model_builder(
+    subgraph: str,
+    pgpool: psycopg_pool.AsyncConnectionPool,
+    replica_pgpool: Optional[psycopg_pool.AsyncConnectionPool] = None,
+) -> str:
+    logs_db = _logs_db(pgpool, replica_pgpool)
+    await _update_rollup_if_enabled(logs_db)
+    await manual_entries.refresh([subgraph])
+    most_frequent_queries = await logs_db.get_most_frequent_queries(
+        subgraph, **_query_stats_options()
+    )
+    long_tail_costs = await _long_tail_costs(logs_db, [subgraph])
+    model = build_template(
+        subgraph,
+        _apply_model_budget(subgraph, most_frequent_queries),
+        long_tail_costs.get(subgraph),
+    )
     return model
 
 
+async def bulk_model_builder(
+    subgraphs: Collection[str],
+    pgpool: psycopg_pool.AsyncConnectionPool,
+    replica_pgpool: Optional[psycopg_pool.AsyncConnectionPool] = None,
+) -> Dict[str, str]:
+    """Builds the models of many subgraphs from a single aggregation of the query
+    logs.
+
+    Args:
+        subgraphs (Collection[str]): Subgraph IPFS hashes.
+        pgpool (psycopg_pool.AsyncConnectionPool): Logs database connection pool.
+        replica_pgpool (Optional[psycopg_pool.AsyncConnectionPool], optional): Logs
+            database read replica connection pool. Defaults to None.
+
+    Returns:
+        Dict[str, str]: Agora model of each subgraph.
+    """
+    logs_db = _logs_db(pgpool, replica_pgpool)
+    await _update_rollup_if_enabled(logs_db)
+    await manual_entries.refresh(subgraphs)
+    long_tail_costs = await _long_tail_costs(logs_db, subgraphs)
+
+    models = dict()
+    # The rows are grouped by subgraph, so each model is rendered as soon as the next
+    # subgraph's rows start.
+    current_subgraph = None
+    current_queries = []
+    async for subgraph, query_stats in logs_db.get_most_frequent_queries_bulk(
+        subgraphs, **_query_stats_options()
+    ):
+        if subgraph != current_subgraph:
+            if current_subgraph is not None:
+                models[current_subgraph] = build_template(
+                    current_subgraph,
+                    _apply_model_budget(current_subgraph, current_queries),
+                    long_tail_costs.get(current_subgraph),
+                )
+            current_subgraph = subgraph
+            current_queries = []
+        current_queries.append(query_stats)
+    if current_subgraph is not None:
+        models[current_subgraph] = build_template(
+            current_subgraph,
+            _apply_model_budget(current_subgraph, current_queries),
+            long_tail_costs.get(current_subgraph),
+        )
+
+    # Subgraphs without any frequent query
+    for subgraph in subgraphs:
+        if subgraph not in models:
+            models[subgraph] = build_template(
+                subgraph,
+                _apply_model_budget(subgraph, []),
+                long_tail_costs.get(subgraph),
+            )
+
+    return models
+
+
 async def apply_default_model(subgraph: str):
+    await manual_entries.refresh([subgraph])
     model = build_template(subgraph)
     await set_cost_model(subgraph, model)
 
 
-async def model_update_loop(subgraph: str, pgpool):
-    while True:
-        model = await model_builder(subgraph, pgpool)
+async def update_model(
+    subgraph: str,
+    pgpool: psycopg_pool.AsyncConnectionPool,
+    replica_pgpool: Optional[psycopg_pool.AsyncConnectionPool] = None,
+):
+    """Rebuilds and applies the model of a single subgraph, with the relative query
+    costs if they are enabled.
+
+    Args:
+        subgraph (str): Subgraph IPFS hash.
+        pgpool (psycopg_pool.AsyncConnectionPool): Logs database connection pool.
+        replica_pgpool (Optional[psycopg_pool.AsyncConnectionPool], optional): Logs
+            database read replica connection pool. Defaults to None.
+    """
+    if args.relative_query_costs:
+        model = await model_builder(subgraph, pgpool, replica_pgpool)
         await set_cost_model(subgraph, model)
-        await aio.sleep(args.relative_query_costs_refresh_interval)
-
-
-def build_template(subgraph: str, most_frequent_queries=None):
-    if most_frequent_queries is None:
-        most_frequent_queries = []
-    aa_version = version("autoagora")
-    manual_agora_entry = obtain_manual_entries(subgraph)
-    template = Template(AGORA_ENTRY_TEMPLATE)
-    model = template.render(
-        aa_version=aa_version,
-        most_frequent_queries=most_frequent_queries,
-        manual_entry=manual_agora_entry,
+    else:
+        await apply_default_model(subgraph)
+
+
+async def model_update_loop(
+    subgraph: str,
+    pgpool,
+    replica_pgpool=None,
+    rebuild_trigger: Optional[ModelRebuildTrigger] = None,
+):
+    while True:
+        try:
+            if rebuild_trigger is not None:
+                await rebuild_trigger.wait(lambda: [subgraph])
+            await update_model(subgraph, pgpool, replica_pgpool)
+            if rebuild_trigger is not None:
+                await rebuild_trigger.commit([subgraph])
+        except aio.CancelledError:
+            raise
+        except:
+            logging.exception(
+                "Exception occurred while updating the model of subgraph %s", subgraph
+            )
+            if rebuild_trigger is not None:
+                # Still due: retried at the next check rather than right away
+                await aio.sleep(rebuild_trigger.check_interval.total_seconds())
+        if rebuild_trigger is None:
+            await aio.sleep(args.relative_query_costs_refresh_interval)
+
+
+async def bulk_model_update_loop(
+    get_subgraphs: Callable[[], Collection[str]],
+    pgpool: psycopg_pool.AsyncConnectionPool,
+    replica_pgpool: Optional[psycopg_pool.AsyncConnectionPool] = None,
+    rebuild_trigger: Optional[ModelRebuildTrigger] = None,
+):
+    """Periodically rebuilds the models of all the subgraphs returned by
+    `get_subgraphs` at once, using `bulk_model_builder`.
+
+    Args:
+        get_subgraphs (Callable[[], Collection[str]]): Returns the subgraphs whose
+            model should currently be updated.
+        pgpool (psycopg_pool.AsyncConnectionPool): Logs database connection pool.
+        replica_pgpool (Optional[psycopg_pool.AsyncConnectionPool], optional): Logs
+            database read replica connection pool. Defaults to None.
+        rebuild_trigger (Optional[ModelRebuildTrigger], optional): Only rebuild the
+            models due according to this trigger, as soon as they are due. Defaults
+            to None (rebuild all the models every
+            --relative-query-costs-refresh-interval).
+    """
+    while True:
+        models = dict()
+        failed = False
+        try:
+            if rebuild_trigger is not None:
+                subgraphs = await rebuild_trigger.wait(get_subgraphs)
+            else:
+                subgraphs = set(get_subgraphs())
+            if subgraphs:
+                models = await bulk_model_builder(subgraphs, pgpool, replica_pgpool)
+        except aio.CancelledError:
+            raise
+        except:
+            logging.exception("Exception occurred while building the models")
+            failed = True
+        applied = []
+        for subgraph, model in models.items():
+            # Skip the subgraphs that were removed during the build
+            if subgraph not in get_subgraphs():
+                continue
+            try:
+                await set_cost_model(subgraph, model)
+                applied.append(subgraph)
+            except aio.CancelledError:
+                raise
+            except:
+                logging.exception(
+                    "Exception occurred while applying the model of subgraph %s",
+                    subgraph,
+                )
+                failed = True
+        if rebuild_trigger is not None:
+            try:
+                await rebuild_trigger.commit(applied)
+            except aio.CancelledError:
+                raise
+            except:
+                logging.exception("Exception occurred while committing the models")
+                failed = True
+            if failed:
+                # Still due: retried at the next check rather than right away
+                await aio.sleep(rebuild_trigger.check_interval.total_seconds())
+        else:
+            await aio.sleep(args.relative_query_costs_refresh_interval)
+
+
+@lru_cache(maxsize=None)
+def agora_entry_template() -> Template:
+    """Compiles the Agora model template once, with the AutoAgora version resolved
+    at the first call.
+
+    Returns:
+        Template: The compiled `AGORA_ENTRY_TEMPLATE`.
+    """
+    environment = Environment()
+    return environment.from_string(
+        AGORA_ENTRY_TEMPLATE, globals={"aa_version": version("autoagora")}
     )
+
+
+def generate_model(
+    subgraph: str,
+    most_frequent_queries: Optional[Iterable[LogsDB.QueryStats]] = None,
+    long_tail_costs: Optional[Iterable[RootFieldCost]] = None,
+) -> Iterator[str]:
+    """Renders the Agora model of a subgraph as a stream of text chunks.
+
+    `most_frequent_queries` is only iterated as the chunks are consumed, so it can
+    itself be a generator.
+
+    Args:
+        subgraph (str): Subgraph IPFS hash.
+        most_frequent_queries (Optional[Iterable[LogsDB.QueryStats]], optional):
+            Query skeletons to price. Defaults to None.
+        long_tail_costs (Optional[Iterable[RootFieldCost]], optional): Root field
+            costs of the other query skeletons. Defaults to None.
+
+    Returns:
+        Iterator[str]: Chunks of the Agora model.
+    """
+    return agora_entry_template().generate(
+        most_frequent_queries=most_frequent_queries or (),
+        long_tail_costs=long_tail_costs or (),
+        manual_entry=manual_entries.get(subgraph),
+    )
+
+
+def build_template(subgraph: str, most_frequent_queries=None, long_tail_costs=None):
+    model = "".join(generate_model(subgraph, most_frequent_queries, long_tail_costs))
     logging.debug("Generated Agora model: \n%s", model)
     return model
 
@@ -67,3 +563,114 @@ def obtain_manual_entries(subgraph: str):
         "No path for manual agora entries was given for subgraph %s", subgraph
     )
     return None
+
+
+class ManualEntries:
+    """In-memory cache of the manual Agora entries of `args.manual_entry_path`.
+
+    An entry file is only read again once its modification time changed, and
+    `refresh` does the file system accesses in a worker thread rather than on the
+    event loop.
+    """
+
+    def __init__(self):
+        # Entry file path -> (modification time, entry)
+        self._entries: Dict[str, Tuple[Optional[int], Optional[str]]] = dict()
+
+    @staticmethod
+    def _path(subgraph: str) -> Optional[str]:
+        if args.manual_entry_path is None:
+            return None
+        return os.path.join(args.manual_entry_path, subgraph + ".agora")
+
+    def _load(self, subgraph: str) -> bool:
+        """Reads the entry of the subgraph again if its file was modified since it was
+        last read. Blocking.
+
+        Returns:
+            bool: Whether a previously read entry changed.
+        """
+        path = self._path(subgraph)
+        if path is None:
+            return False
+
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+
+        cached = self._entries.get(path)
+        if cached is not None and cached[0] == mtime:
+            return False
+
+        entry = obtain_manual_entries(subgraph) if mtime is not None else None
+        self._entries[path] = (mtime, entry)
+        return cached is not None and cached[1] != entry
+
+    def get(self, subgraph: str) -> Optional[str]:
+        """Returns the cached manual entry of a subgraph. The entry file is only read,
+        on the calling thread, if the subgraph was never refreshed.
+
+        Args:
+            subgraph (str): Subgraph IPFS hash.
+
+        Returns:
+            Optional[str]: The manual Agora entry, if any.
+        """
+        path = self._path(subgraph)
+        if path is None:
+            return None
+        if path not in self._entries:
+            self._load(subgraph)
+        return self._entries[path][1]
+
+    async def refresh(self, subgraphs: Iterable[str]) -> Set[str]:
+        """Reads, in a worker thread, the entries of the subgraphs whose file was
+        modified since they were last read.
+
+        Args:
+            subgraphs (Iterable[str]): Subgraph IPFS hashes.
+
+        Returns:
+            Set[str]: The subgraphs whose previously read entry changed.
+        """
+        subgraphs = list(subgraphs)
+        loop = aio.get_running_loop()
+        return await loop.run_in_executor(
+            None, lambda: {subgraph for subgraph in subgraphs if self._load(subgraph)}
+        )
+
+
+manual_entries = ManualEntries()
+
+
+async def manual_entries_watcher(
+    get_subgraphs: Callable[[], Collection[str]],
+    on_change: Callable[[str], Awaitable[Any]],
+):
+    """Periodically checks the manual entry files of the subgraphs returned by
+    `get_subgraphs` for modifications, and awaits `on_change` for each subgraph whose
+    entry changed.
+
+    Args:
+        get_subgraphs (Callable[[], Collection[str]]): Returns the subgraphs whose
+            manual entry should currently be watched.
+        on_change (Callable[[str], Awaitable[Any]]): Called with the subgraphs whose
+            manual entry changed, typically to rebuild their model.
+    """
+    while True:
+        await aio.sleep(args.manual_entry_poll_interval)
+        try:
+            changed_subgraphs = await manual_entries.refresh(get_subgraphs())
+        except:
+            logging.exception("Exception occurred while refreshing manual entries.")
+            continue
+        for subgraph in changed_subgraphs:
+            logging.info("Manual entry of subgraph %s changed", subgraph)
+            try:
+                await on_change(subgraph)
+            except:
+                logging.exception(
+                    "Exception occurred while rebuilding the model of subgraph %s",
+                    subgraph,
+                )
@@ -0,0 +1,274 @@
+# Copyright 2023-, Semiotic AI, Inc.
+# SPDX-License-Identifier: Apache-2.0
+
+"""Rebuilds of the relative query costs models triggered by new query logs, rather
+than at a fixed interval.
+
+The model of a subgraph is rebuilt once at least a threshold of query logs were
+logged since its last build, so that the quiet subgraphs are not aggregated again
+for nothing, and the busy ones pick up their new query shapes sooner.
+
+The new query logs are counted from a high-water mark per subgraph: the latest
+timestamp of the query logs its model was built from. The counts are checked
+periodically, which only scans the query logs after the high-water marks, and as
+soon as the `NOTIFY`s sent by the query logs ingestion (see `query_logs_ingestion`)
+add up to the threshold. Other query logs writers can send them too, on
+`QUERY_LOGS_NOTIFY_CHANNEL`, or only rely on the periodic checks.
+
+The query logs logged with a timestamp older than the high-water mark of their
+subgraph are not counted.
+
+The high-water marks and build times are persisted in the `model_rebuild_watermark`
+table, so that a restart resumes from them, rather than counting all the query logs
+of every subgraph and rebuilding all the models.
+"""
+
+import asyncio as aio
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Collection, Dict, Optional, Set, Tuple
+
+import psycopg
+import psycopg_pool
+from prometheus_client import Gauge
+from psycopg import sql
+
+from autoagora.config import args
+from autoagora.logs_db import LogsDB
+from autoagora.utils.constants import QUERY_LOGS_NOTIFY_CHANNEL
+
+new_query_logs_gauge = Gauge(
+    "relative_query_costs_new_query_logs",
+    "Number of query logs since the last relative query costs model build.",
+    ["subgraph"],
+)
+
+
+class ModelRebuildTrigger:
+    def __init__(
+        self,
+        logs_db: LogsDB,
+        threshold: int,
+        check_interval: timedelta = timedelta(minutes=1),
+        max_interval: Optional[timedelta] = None,
+    ) -> None:
+        """
+        Args:
+            logs_db (LogsDB): Query logs database.
+            threshold (int): Number of new query logs of a subgraph that triggers
+                the rebuild of its model.
+            check_interval (timedelta, optional): Interval between the checks of the
+                number of new query logs. Defaults to 1 minute.
+            max_interval (Optional[timedelta], optional): Maximum interval between
+                the builds of a model, whatever the number of new query logs, for
+                the time windowed or decayed statistics to age. Defaults to None (no
+                maximum).
+        """
+        self.logs_db = logs_db
+        self.threshold = threshold
+        self.check_interval = check_interval
+        self.max_interval = max_interval
+        # High-water mark of the query logs each model was last built from
+        self._high_water_marks: Dict[str, Optional[datetime]] = dict()
+        # Time of each model's last build
+        self._built_at: Dict[str, datetime] = dict()
+        # Subgraphs whose persisted high-water mark and build time were loaded
+        self._loaded: Set[str] = set()
+        # New query logs of each subgraph, as last checked plus as notified since
+        self._new_query_logs: Dict[str, int] = defaultdict(int)
+        # High-water mark, time and new query logs of each due subgraph when it was
+        # last checked, committed once its model is rebuilt
+        self._due: Dict[str, Tuple[Optional[datetime], datetime, int]] = dict()
+        # Events of the `wait` calls, by subgraph
+        self._waiters: Dict[str, Set[aio.Event]] = defaultdict(set)
+
+    def _is_due(self, subgraph: str, now: datetime) -> bool:
+        if subgraph not in self._built_at:
+            return True
+        if self._new_query_logs[subgraph] >= self.threshold:
+            return True
+        return (
+            self.max_interval is not None
+            and now - self._built_at[subgraph] >= self.max_interval
+        )
+
+    async def check(self, subgraphs: Collection[str]) -> Set[str]:
+        """Counts the new query logs of the subgraphs.
+
+        The high-water marks and build times persisted by `commit` are loaded on the
+        first check of each subgraph, so that a restart does not count all its
+        query logs again.
+
+        Returns:
+            Set[str]: The subgraphs whose model is due for a rebuild.
+        """
+        not_loaded = set(subgraphs) - self._loaded
+        if not_loaded:
+            watermarks = await self.logs_db.get_model_rebuild_watermarks(not_loaded)
+            for subgraph, (high_water_mark, built_at) in watermarks.items():
+                self._high_water_marks[subgraph] = high_water_mark
+                self._built_at[subgraph] = built_at
+            self._loaded |= not_loaded
+
+        new_query_logs = await self.logs_db.get_new_query_logs(
+            {subgraph: self._high_water_marks.get(subgraph) for subgraph in subgraphs}
+        )
+        now = datetime.now(timezone.utc)
+        due = set()
+        for subgraph, (count, high_water_mark) in new_query_logs.items():
+            self._new_query_logs[subgraph] = count
+            if self._is_due(subgraph, now):
+                due.add(subgraph)
+                # Rebuilt by the caller from the query logs up to now
+                self._due[subgraph] = (high_water_mark, now, count)
+            new_query_logs_gauge.labels(subgraph=subgraph).set(
+                self._new_query_logs[subgraph]
+            )
+        return due
+
+    async def commit(self, subgraphs: Collection[str]) -> None:
+        """Records and persists the rebuild of the models of due subgraphs, once
+        they are built and applied. The subgraphs whose rebuild failed are not
+        committed, and stay due.
+
+        Args:
+            subgraphs (Collection[str]): Subgraphs returned by `check` or `wait`,
+                whose model was rebuilt.
+        """
+        committed = {
+            subgraph: self._due[subgraph]
+            for subgraph in subgraphs
+            if subgraph in self._due
+        }
+        await self.logs_db.set_model_rebuild_watermarks(
+            {
+                subgraph: (high_water_mark, checked_at)
+                for subgraph, (high_water_mark, checked_at, _) in committed.items()
+            }
+        )
+        for subgraph, (high_water_mark, checked_at, count) in committed.items():
+            del self._due[subgraph]
+            self._high_water_marks[subgraph] = high_water_mark
+            self._built_at[subgraph] = checked_at
+            # Keeping the query logs notified since the check
+            self._new_query_logs[subgraph] = max(
+                self._new_query_logs[subgraph] - count, 0
+            )
+            new_query_logs_gauge.labels(subgraph=subgraph).set(
+                self._new_query_logs[subgraph]
+            )
+
+    async def wait(self, get_subgraphs: Callable[[], Collection[str]]) -> Set[str]:
+        """Waits until the model of some of the subgraphs returned by
+        `get_subgraphs` is due for a rebuild: never built, with at least `threshold`
+        new query logs, or built more than `max_interval` ago.
+
+        The caller is expected to rebuild the models of the due subgraphs, and to
+        `commit` the ones it rebuilt. The others stay due.
+
+        Args:
+            get_subgraphs (Callable[[], Collection[str]]): Returns the subgraphs
+                whose model should currently be updated.
+
+        Returns:
+            Set[str]: The subgraphs whose model is due for a rebuild.
+        """
+        while True:
+            subgraphs = set(get_subgraphs())
+            if subgraphs:
+                due = await self.check(subgraphs)
+                if due:
+                    return due
+
+            event = aio.Event()
+            for subgraph in subgraphs:
+                self._waiters[subgraph].add(event)
+            try:
+                await aio.wait_for(event.wait(), self.check_interval.total_seconds())
+            except aio.TimeoutError:
+                pass
+            finally:
+                for subgraph in subgraphs:
+                    self._waiters[subgraph].discard(event)
+                    if not self._waiters[subgraph]:
+                        del self._waiters[subgraph]
+
+    def notify(self, subgraph: str, count: int) -> None:
+        """Adds notified new query logs to a subgraph's count, and wakes up its
+        `wait` calls if they reach the threshold."""
+        self._new_query_logs[subgraph] += count
+        if self._new_query_logs[subgraph] >= self.threshold:
+            for event in self._waiters.get(subgraph, ()):
+                event.set()
+
+    async def listen(self, retry_interval: timedelta = timedelta(seconds=30)):
+        """Listens to the query logs `NOTIFY`s, on a dedicated connection to the
+        primary logs database, reconnecting on errors."""
+        pgpool = self.logs_db.pgpool
+        # Static in the pools created by `db_pools.open_pools`
+        assert isinstance(pgpool.conninfo, str)
+        kwargs = pgpool.kwargs if isinstance(pgpool.kwargs, dict) else dict()
+        while True:
+            try:
+                connection = await psycopg.AsyncConnection.connect(
+                    pgpool.conninfo, autocommit=True, **kwargs
+                )
+                async with connection:
+                    await connection.execute(
+                        sql.SQL("LISTEN {}").format(
+                            sql.Identifier(QUERY_LOGS_NOTIFY_CHANNEL)
+                        )
+                    )
+                    async for notification in connection.notifies():
+                        try:
+                            subgraph, count = notification.payload.split()
+                            self.notify(subgraph, int(count))
+                        except ValueError:
+                            logging.warning(
+                                "Invalid query logs notification: %s",
+                                notification.payload,
+                            )
+            except aio.CancelledError:
+                raise
+            except:
+                logging.exception("Error while listening to the query logs.")
+            await aio.sleep(retry_interval.total_seconds())
+
+
+def model_rebuild_trigger(
+    pgpool: psycopg_pool.AsyncConnectionPool,
+    replica_pgpool: Optional[psycopg_pool.AsyncConnectionPool] = None,
+) -> Optional[ModelRebuildTrigger]:
+    """Creates the model rebuild trigger of the `--relative-query-costs-rebuild-*`
+    settings, listening to the query logs notifications, if enabled.
+
+    Args:
+        pgpool (psycopg_pool.AsyncConnectionPool): Logs database connection pool.
+        replica_pgpool (Optional[psycopg_pool.AsyncConnectionPool], optional): Logs
+            database read replica connection pool, which the models are built
+            from. Defaults to None.
+
+    Returns:
+        Optional[ModelRebuildTrigger]: The rebuild trigger, None if the models are
+            rebuilt at a fixed interval.
+    """
+    if args.relative_query_costs_rebuild_threshold is None:
+        return None
+
+    trigger = ModelRebuildTrigger(
+        LogsDB(
+            pgpool,
+            replica_pgpool,
+            replica_max_lag=timedelta(seconds=args.postgres_replica_max_lag),
+        ),
+        threshold=args.relative_query_costs_rebuild_threshold,
+        check_interval=timedelta(
+            seconds=args.relative_query_costs_rebuild_check_interval
+        ),
+        max_interval=timedelta(seconds=args.relative_query_costs_rebuild_max_interval)
+        if args.relative_query_costs_rebuild_max_interval
+        else None,
+    )
+    aio.ensure_future(trigger.listen())
+    return trigger
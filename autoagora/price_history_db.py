@@ -0,0 +1,217 @@
+# Copyright 2023-, Semiotic AI, Inc.
+# SPDX-License-Identifier: Apache-2.0
+
+"""Append-only history of the price bandits' steps, to tune them and investigate
+their behavior from the database rather than from the metrics dashboards.
+
+The steps are buffered in memory by `PriceHistoryDB.append`, which never waits on
+the database, and written in batches with `COPY` by `PriceHistoryDB.writer_loop`,
+which also deletes the steps older than the retention. The steps are appended in
+time order, so they are indexed with a BRIN index on their timestamp: a few pages
+for the whole table, enough to only scan the pages of a time range.
+"""
+
+import asyncio as aio
+import logging
+from collections import deque
+from dataclasses import astuple, dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Deque, Iterable, List, Optional
+
+import psycopg_pool
+from prometheus_client import Counter
+
+from autoagora.config import args
+
+dropped_steps_counter = Counter(
+    "price_history_dropped",
+    "Price bandit steps dropped from the price history, as the database could not "
+    "keep up.",
+)
+
+
+@dataclass
+class PriceHistoryStep:
+    timestamp: datetime
+    subgraph: str
+    price_multiplier: float
+    queries_per_second: float
+    reward: float
+    mean: float
+    stddev: float
+
+
+class PriceHistoryDB:
+    # Maximum number of steps buffered while the database is unavailable. The
+    # oldest steps are dropped beyond.
+    max_buffered_steps = 100_000
+
+    def __init__(self, pgpool: psycopg_pool.AsyncConnectionPool) -> None:
+        self.pgpool = pgpool
+        self._steps: Deque[PriceHistoryStep] = deque()
+        self._flush_lock = aio.Lock()
+
+    def append(
+        self,
+        subgraph: str,
+        price_multiplier: float,
+        queries_per_second: float,
+        reward: float,
+        mean: float,
+        stddev: float,
+    ) -> None:
+        """Buffers a price bandit step, timestamped now, to be written by the next
+        `flush`."""
+        self._steps.append(
+            PriceHistoryStep(
+                timestamp=datetime.now(timezone.utc),
+                subgraph=subgraph,
+                price_multiplier=price_multiplier,
+                queries_per_second=queries_per_second,
+                reward=reward,
+                mean=mean,
+                stddev=stddev,
+            )
+        )
+        self._drop_overflow()
+
+    def _drop_overflow(self) -> None:
+        while len(self._steps) > self.max_buffered_steps:
+            self._steps.popleft()
+            dropped_steps_counter.inc()
+
+    async def flush(self) -> int:
+        """Writes the buffered steps. They are buffered again if the write fails.
+
+        Returns:
+            int: Number of steps written.
+        """
+        async with self._flush_lock:
+            steps, self._steps = self._steps, deque()
+            if not steps:
+                return 0
+
+            try:
+                await self._write(steps)
+            except:
+                self._steps.extendleft(reversed(steps))
+                self._drop_overflow()
+                raise
+        return len(steps)
+
+    async def _write(self, steps: Iterable[PriceHistoryStep]) -> None:
+        async with self.pgpool.connection() as connection:
+            async with connection.cursor() as cursor:
+                async with cursor.copy(
+                    """
+                    COPY price_history (
+                        timestamp,
+                        subgraph,
+                        price_multiplier,
+                        queries_per_second,
+                        reward,
+                        mean,
+                        stddev
+                    ) FROM STDIN
+                    """
+                ) as copy:
+                    for step in steps:
+                        await copy.write_row(astuple(step))
+
+    async def expire(self, retention: timedelta) -> int:
+        """Deletes the steps older than `retention`.
+
+        Returns:
+            int: Number of steps deleted.
+        """
+        async with self.pgpool.connection() as connection:
+            cursor = await connection.execute(
+                "DELETE FROM price_history WHERE timestamp < %(cutoff)s",
+                {"cutoff": datetime.now(timezone.utc) - retention},
+                prepare=True,
+                binary=True,
+            )
+            return cursor.rowcount
+
+    async def get_history(
+        self, subgraph: str, start: datetime, end: Optional[datetime] = None
+    ) -> List[PriceHistoryStep]:
+        """Returns the steps of a subgraph's price bandit within a time range,
+        earliest first.
+
+        Args:
+            subgraph (str): Subgraph IPFS hash.
+            start (datetime): Start of the time range (inclusive).
+            end (Optional[datetime], optional): End of the time range (exclusive).
+                Defaults to None (until now).
+        """
+        async with self.pgpool.connection() as connection:
+            cursor = await connection.execute(
+                """
+                SELECT
+                    timestamp,
+                    subgraph::text,
+                    price_multiplier,
+                    queries_per_second,
+                    reward,
+                    mean,
+                    stddev
+                FROM
+                    price_history
+                WHERE
+                    subgraph = %(subgraph)s
+                    AND timestamp >= %(start)s
+                    AND timestamp < coalesce(%(end)s::timestamptz, 'infinity')
+                ORDER BY
+                    timestamp
+                """,
+                {"subgraph": subgraph, "start": start, "end": end},
+                prepare=True,
+                binary=True,
+            )
+            return [PriceHistoryStep(*row) async for row in cursor]
+
+    async def writer_loop(
+        self,
+        flush_interval: timedelta,
+        retention: Optional[timedelta] = None,
+        expire_interval: timedelta = timedelta(hours=1),
+    ):
+        """Writes the buffered steps every `flush_interval`, and deletes the steps
+        older than `retention` every `expire_interval`."""
+        loop = aio.get_running_loop()
+        expired_at = None
+        while True:
+            await aio.sleep(flush_interval.total_seconds())
+            try:
+                await self.flush()
+                if retention is not None and (
+                    expired_at is None
+                    or loop.time() - expired_at >= expire_interval.total_seconds()
+                ):
+                    expired_at = loop.time()
+                    await self.expire(retention)
+            except aio.CancelledError:
+                raise
+            except:
+                logging.exception("Error while writing the price history.")
+
+
+def price_history_db(
+    pgpool: psycopg_pool.AsyncConnectionPool,
+) -> Optional[PriceHistoryDB]:
+    """Creates the price history of the `--price-history-*` settings, and starts its
+    writer, if enabled."""
+    if not args.price_history:
+        return None
+
+    history_db = PriceHistoryDB(pgpool)
+    aio.ensure_future(
+        history_db.writer_loop(
+            flush_interval=timedelta(seconds=args.price_history_flush_interval),
+            retention=timedelta(days=args.price_history_retention)
+            if args.price_history_retention is not None
+            else None,
+        )
+    )
+    return history_db
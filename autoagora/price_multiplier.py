@@ -4,16 +4,17 @@
 import asyncio
 import logging
 from datetime import datetime, timedelta, timezone
-from typing import Tuple
+from typing import Optional, Tuple
 
 import psycopg_pool
 from autoagora_agents.agent_factory import AgentFactory
 from prometheus_client import Gauge
 
 from autoagora.config import args
+from autoagora.price_history_db import PriceHistoryDB
 from autoagora.price_save_state_db import PriceSaveStateDB
 from autoagora.query_metrics import MetricsEndpoints
-from autoagora.subgraph_wrapper import SubgraphWrapper
+from autoagora.subgraph_wrapper import SubgraphWrapper, cycle_stage_histogram
 
 reward_gauge = Gauge(
     "bandit_reward",
@@ -39,6 +40,7 @@ async def price_bandit_loop(
     subgraph: str,
     pgpool: psycopg_pool.AsyncConnectionPool,
     metrics_endpoints: MetricsEndpoints,
+    price_history_db: Optional[PriceHistoryDB] = None,
 ):
     try:
         # Instantiate environment.
@@ -91,14 +93,16 @@ async def price_bandit_loop(
             # Update the save state
             # NOTE: `bid_scale` is specific to "scaled_gaussian" agent action type
             logging.debug("Price bandit %s - Saving state to DB.", subgraph)
-            await save_state_db.save_state(
-                subgraph=subgraph,
-                mean=bandit.bid_scale(bandit.mean().item()),
-                stddev=bandit.stddev().item(),
-            )
+            with cycle_stage_histogram.labels(stage="save_state").time():
+                await save_state_db.save_state(
+                    subgraph=subgraph,
+                    mean=bandit.bid_scale(bandit.mean().item()),
+                    stddev=bandit.stddev().item(),
+                )
 
             # 1. Get bid from the agent (action)
-            scaled_bid = bandit.get_action()
+            with cycle_stage_histogram.labels(stage="get_action").time():
+                scaled_bid = bandit.get_action()
 
             logging.debug(
                 "Price bandit %s - Price multiplier: %s", subgraph, scaled_bid
@@ -129,11 +133,23 @@ async def price_bandit_loop(
                 "Price bandit %s - Total revenue: %s", subgraph, total_revenue
             )
 
+            # Buffered, written in the background
+            if price_history_db is not None:
+                price_history_db.append(
+                    subgraph,
+                    price_multiplier=scaled_bid,
+                    queries_per_second=queries_per_second,
+                    reward=revenue_per_second,
+                    mean=bandit.bid_scale(bandit.mean().item()),
+                    stddev=bandit.stddev().item(),
+                )
+
             # Add reward.
             bandit.add_reward(revenue_per_second)
 
             # 4. Update the policy.
-            loss = bandit.update_policy()
+            with cycle_stage_histogram.labels(stage="update_policy").time():
+                loss = bandit.update_policy()
             if loss is not None:
                 logging.debug("Price bandit %s - Training loss: %s", subgraph, loss)
 
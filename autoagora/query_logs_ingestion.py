@@ -0,0 +1,478 @@
+# Copyright 2023-, Semiotic AI, Inc.
+# SPDX-License-Identifier: Apache-2.0
+
+"""Bulk ingestion of indexer-service query logs into the `query_skeletons` and
+`query_logs` tables, as an alternative to AutoAgora Processor.
+
+The query logs are read as JSON lines, from a file or a stream (such as stdin).
+Each line is a JSON object with:
+
+- `subgraphDeployment`: subgraph IPFS hash,
+- `query`: GraphQL query,
+- `variables` (optional): query variables, as an object or a JSON string,
+- `operationName` (optional): operation to run, if the query has several,
+- `responseTime`: query time, in milliseconds,
+- `time` (optional): UNIX timestamp of the query, in milliseconds. Defaults to the
+  ingestion time.
+
+Other lines are skipped, so that the whole indexer-service log can be piped in, as
+are the query logs whose values do not fit the `query_logs` columns.
+
+Each query is normalized into a skeleton: its fragments are inlined, the literal
+argument values are replaced by `$_0`, `$_1`... variables, whose values are stored
+with the query's own variables, and it is printed canonically (see
+`graphql_printer`). The skeletons are identified by the SHA-256 hash of their text.
+
+The rows are written in batches with `COPY`. The normalization is memoized by query
+text, and the hashes of the skeletons already stored are cached, so that a batch
+usually only costs a JSON decoding per line and a single `COPY`.
+
+Each batch sends a `NOTIFY` on `QUERY_LOGS_NOTIFY_CHANNEL` with its number of rows
+per subgraph, for the model rebuilds to be triggered by new query logs (see
+`model_rebuild_trigger`).
+"""
+
+import asyncio as aio
+import hashlib
+import json
+import logging
+import os
+import stat
+import sys
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import Any, AsyncIterator, BinaryIO, Dict, List, Optional, Tuple
+
+import graphql
+import psycopg
+import psycopg_pool
+from graphql import language
+from prometheus_client import Counter
+
+from autoagora.config import args
+from autoagora.graphql_printer import print_canonical_operation
+from autoagora.utils.constants import QUERY_LOGS_NOTIFY_CHANNEL
+
+ingested_rows_counter = Counter(
+    "query_logs_ingested", "Query log rows ingested into query_logs."
+)
+skipped_lines_counter = Counter(
+    "query_logs_ingestion_skipped_lines",
+    "Query log lines skipped by the ingestion: not queries, or invalid.",
+)
+dropped_rows_counter = Counter(
+    "query_logs_ingestion_dropped_rows",
+    "Query log rows dropped by the ingestion, as their batch was rejected by the "
+    "database.",
+)
+
+# Length of the subgraph IPFS hashes (`query_logs.subgraph` is a `char(46)`)
+SUBGRAPH_LENGTH = 46
+# Maximum query time (`query_logs.query_time_ms` is an `integer`)
+MAX_QUERY_TIME_MS = 2**31 - 1
+
+
+def _inline_fragments(
+    selection_set: language.SelectionSetNode,
+    fragments: Dict[str, language.FragmentDefinitionNode],
+    spread_fragments: Tuple[str, ...] = (),
+) -> language.SelectionSetNode:
+    selections = []
+    for selection in selection_set.selections:
+        if isinstance(selection, language.FragmentSpreadNode):
+            name = selection.name.value
+            if name in spread_fragments or name not in fragments:
+                raise graphql.GraphQLError(f"Invalid fragment spread: {name}")
+            fragment = fragments[name]
+            selection = language.InlineFragmentNode(
+                type_condition=fragment.type_condition,
+                directives=selection.directives,
+                selection_set=_inline_fragments(
+                    fragment.selection_set, fragments, spread_fragments + (name,)
+                ),
+            )
+        elif isinstance(selection, language.FieldNode) and selection.selection_set:
+            selection = language.FieldNode(
+                alias=selection.alias,
+                name=selection.name,
+                arguments=selection.arguments,
+                directives=selection.directives,
+                selection_set=_inline_fragments(
+                    selection.selection_set, fragments, spread_fragments
+                ),
+            )
+        elif isinstance(selection, language.InlineFragmentNode):
+            selection = language.InlineFragmentNode(
+                type_condition=selection.type_condition,
+                directives=selection.directives,
+                selection_set=_inline_fragments(
+                    selection.selection_set, fragments, spread_fragments
+                ),
+            )
+        selections.append(selection)
+    return language.SelectionSetNode(selections=tuple(selections))
+
+
+def _contains_variable(node: language.ValueNode) -> bool:
+    if isinstance(node, language.VariableNode):
+        return True
+    if isinstance(node, language.ListValueNode):
+        return any(_contains_variable(value) for value in node.values)
+    if isinstance(node, language.ObjectValueNode):
+        return any(_contains_variable(field.value) for field in node.fields)
+    return False
+
+
+class _ParameterizeLiterals(language.Visitor):
+    """Replaces the literal argument values by `$_0`, `$_1`... variables, keeping
+    their values. Values mixing literals and variables are parameterized down to
+    their literal parts."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.literals: Dict[str, Any] = dict()
+
+    def _parameterize(self, node: language.ValueNode) -> language.ValueNode:
+        if not _contains_variable(node):
+            name = f"_{len(self.literals)}"
+            self.literals[name] = graphql.value_from_ast_untyped(node)
+            return language.VariableNode(name=language.NameNode(value=name))
+        if isinstance(node, language.ListValueNode):
+            return language.ListValueNode(
+                values=tuple(self._parameterize(value) for value in node.values)
+            )
+        if isinstance(node, language.ObjectValueNode):
+            return language.ObjectValueNode(
+                fields=tuple(
+                    language.ObjectFieldNode(
+                        name=field.name, value=self._parameterize(field.value)
+                    )
+                    for field in node.fields
+                )
+            )
+        return node
+
+    def enter_argument(self, node: language.ArgumentNode, *_):
+        return language.ArgumentNode(
+            name=node.name, value=self._parameterize(node.value)
+        )
+
+
+@lru_cache(maxsize=100_000)
+def normalize_query(
+    query: str, operation_name: Optional[str] = None
+) -> Tuple[str, bytes, Dict[str, Any]]:
+    """Normalizes a query into its skeleton.
+
+    Args:
+        query (str): GraphQL query.
+        operation_name (Optional[str], optional): Operation to normalize, if the
+            query has several. Defaults to None (first operation).
+
+    Raises:
+        graphql.GraphQLError: The query is invalid.
+
+    Returns:
+        Tuple[str, bytes, Dict[str, Any]]: The query skeleton, its hash, and the
+            values of the variables replacing its literals. Shared by the calls
+            with the same query, so not to be modified.
+    """
+    document = graphql.parse(query, no_location=True)
+    operations = [
+        definition
+        for definition in document.definitions
+        if isinstance(definition, language.OperationDefinitionNode)
+        and (
+            operation_name is None
+            or definition.name
+            and definition.name.value == operation_name
+        )
+    ]
+    if not operations:
+        raise graphql.GraphQLError(f"Operation not found: {operation_name}")
+    fragments = {
+        definition.name.value: definition
+        for definition in document.definitions
+        if isinstance(definition, language.FragmentDefinitionNode)
+    }
+
+    operation = operations[0]
+    operation = language.OperationDefinitionNode(
+        operation=operation.operation,
+        name=operation.name,
+        variable_definitions=operation.variable_definitions,
+        directives=operation.directives,
+        selection_set=_inline_fragments(operation.selection_set, fragments),
+    )
+    # Number the literals in canonical order
+    operation = graphql.parse(
+        print_canonical_operation(operation), no_location=True
+    ).definitions[0]
+    parameterize = _ParameterizeLiterals()
+    operation = language.visit(operation, parameterize)
+
+    skeleton = print_canonical_operation(operation)
+    return (
+        skeleton,
+        hashlib.sha256(skeleton.encode()).digest(),
+        parameterize.literals,
+    )
+
+
+def parse_log_line(
+    line: bytes,
+) -> Optional[Tuple[str, str, bytes, datetime, int, Optional[str]]]:
+    """Parses an indexer-service query log line.
+
+    Returns:
+        Optional[Tuple[str, str, bytes, datetime, int, Optional[str]]]: The
+            subgraph, query skeleton, skeleton hash, timestamp, query time and
+            variables (JSON) of the query, None if the line is not a valid query
+            log.
+    """
+    try:
+        log = json.loads(line)
+        subgraph = log["subgraphDeployment"]
+        # Validated here, as a single row rejected by the `COPY` fails its batch
+        if not isinstance(subgraph, str) or len(subgraph) != SUBGRAPH_LENGTH:
+            return None
+        skeleton, skeleton_hash, literals = normalize_query(
+            log["query"], log.get("operationName")
+        )
+        query_time_ms = int(log["responseTime"])
+        if not 0 <= query_time_ms <= MAX_QUERY_TIME_MS:
+            return None
+        timestamp = (
+            datetime.fromtimestamp(log["time"] / 1000, timezone.utc)
+            if "time" in log
+            else datetime.now(timezone.utc)
+        )
+        variables = log.get("variables") or None
+        # The variables logged as JSON are stored as is, unless they must be merged
+        # with the literals' values.
+        if literals:
+            if isinstance(variables, str):
+                variables = json.loads(variables)
+            variables = json.dumps(dict(literals, **(variables or {})))
+        elif variables is not None and not isinstance(variables, str):
+            variables = json.dumps(variables)
+    except (
+        ValueError,
+        KeyError,
+        TypeError,
+        OverflowError,
+        OSError,
+        graphql.GraphQLError,
+    ):
+        return None
+
+    return (subgraph, skeleton, skeleton_hash, timestamp, query_time_ms, variables)
+
+
+class QueryLogsIngestor:
+    # Maximum number of stored skeleton hashes kept in the cache.
+    known_skeletons_cache_size = 100_000
+
+    def __init__(
+        self, pgpool: psycopg_pool.AsyncConnectionPool, batch_size: int = 10_000
+    ) -> None:
+        self.pgpool = pgpool
+        self.batch_size = batch_size
+        # Hashes of the skeletons known to be stored, least recently used first
+        self._known_skeletons: "OrderedDict[bytes, None]" = OrderedDict()
+        self._new_skeletons: Dict[bytes, str] = dict()
+        self._rows: List[Tuple[bytes, str, datetime, int, Optional[str]]] = []
+        self._flush_lock = aio.Lock()
+        self.rows_written = 0
+
+    def add_line(self, line: bytes) -> bool:
+        """Parses a query log line and buffers its row, if valid.
+
+        Returns:
+            bool: Whether the buffered rows reached `batch_size` and should be
+                flushed.
+        """
+        row = parse_log_line(line)
+        if row is None:
+            skipped_lines_counter.inc()
+        else:
+            subgraph, skeleton, skeleton_hash, timestamp, query_time_ms, variables = row
+            if skeleton_hash in self._known_skeletons:
+                self._known_skeletons.move_to_end(skeleton_hash)
+            else:
+                self._new_skeletons[skeleton_hash] = skeleton
+            self._rows.append(
+                (skeleton_hash, subgraph, timestamp, query_time_ms, variables)
+            )
+        return len(self._rows) >= self.batch_size
+
+    async def flush(self) -> int:
+        """Writes the buffered rows. They are buffered again if the write fails,
+        unless the database rejected their data: they would then fail again, and
+        are dropped.
+
+        Returns:
+            int: Number of rows written.
+        """
+        async with self._flush_lock:
+            rows, self._rows = self._rows, []
+            new_skeletons, self._new_skeletons = self._new_skeletons, dict()
+            if not rows:
+                return 0
+
+            try:
+                await self._write(rows, new_skeletons)
+            except psycopg.DataError:
+                logging.exception(
+                    "Invalid query logs, dropping a batch of %s rows.", len(rows)
+                )
+                dropped_rows_counter.inc(len(rows))
+                return 0
+            except:
+                self._rows = rows + self._rows
+                self._new_skeletons.update(new_skeletons)
+                raise
+
+            for skeleton_hash in new_skeletons:
+                self._known_skeletons[skeleton_hash] = None
+            while len(self._known_skeletons) > self.known_skeletons_cache_size:
+                self._known_skeletons.popitem(last=False)
+
+        self.rows_written += len(rows)
+        ingested_rows_counter.inc(len(rows))
+        return len(rows)
+
+    async def _write(
+        self,
+        rows: List[Tuple[bytes, str, datetime, int, Optional[str]]],
+        new_skeletons: Dict[bytes, str],
+    ) -> None:
+        async with self.pgpool.connection() as connection:
+            if new_skeletons:
+                async with connection.cursor() as cursor:
+                    await cursor.executemany(
+                        """
+                        INSERT INTO query_skeletons (hash, query)
+                        VALUES (%s, %s)
+                        ON CONFLICT (hash) DO NOTHING
+                        """,
+                        list(new_skeletons.items()),
+                    )
+            async with connection.cursor() as cursor:
+                async with cursor.copy(
+                    """
+                    COPY query_logs (
+                        query_hash,
+                        subgraph,
+                        timestamp,
+                        query_time_ms,
+                        query_variables
+                    ) FROM STDIN
+                    """
+                ) as copy:
+                    for row in rows:
+                        await copy.write_row(row)
+            # Delivered on commit, along with the rows
+            new_logs: Dict[str, int] = defaultdict(int)
+            for row in rows:
+                new_logs[row[1]] += 1
+            await connection.execute(
+                """
+                SELECT
+                    pg_notify(%(channel)s, subgraph || ' ' || count)
+                FROM
+                    unnest(%(subgraphs)s::text[], %(counts)s::int[])
+                        AS new_logs(subgraph, count)
+                """,
+                {
+                    "channel": QUERY_LOGS_NOTIFY_CHANNEL,
+                    "subgraphs": list(new_logs),
+                    "counts": list(new_logs.values()),
+                },
+            )
+
+    async def ingest(
+        self, lines: AsyncIterator[bytes], flush_interval: float = 1
+    ) -> int:
+        """Ingests query log lines until the end of `lines`, flushing the rows by
+        batches of `batch_size`, or after `flush_interval` seconds.
+
+        Returns:
+            int: Number of rows written.
+        """
+
+        async def flush_periodically():
+            while True:
+                await aio.sleep(flush_interval)
+                try:
+                    # Not interrupted by the end of the ingestion
+                    await aio.shield(self.flush())
+                except aio.CancelledError:
+                    raise
+                except:
+                    logging.exception("Error while writing the query logs.")
+
+        rows_written = self.rows_written
+        periodic_flush = aio.ensure_future(flush_periodically())
+        try:
+            async for line in lines:
+                if self.add_line(line):
+                    try:
+                        await self.flush()
+                    except aio.CancelledError:
+                        raise
+                    except:
+                        # The rows stay buffered, and are written again with the next
+                        # batch. Backing off holds the source back in the meantime.
+                        logging.exception("Error while writing the query logs.")
+                        await aio.sleep(flush_interval)
+        finally:
+            periodic_flush.cancel()
+        await self.flush()
+        return self.rows_written - rows_written
+
+
+async def read_lines(file: BinaryIO, chunk_size: int = 1 << 20) -> AsyncIterator[bytes]:
+    """Reads the lines of a file, or of a pipe without blocking the event loop
+    while waiting for more lines.
+
+    Args:
+        file (BinaryIO): File or pipe, opened in binary mode.
+        chunk_size (int, optional): Approximate number of bytes read at once from
+            a file. Defaults to 1 MiB.
+    """
+    loop = aio.get_event_loop()
+    if stat.S_ISREG(os.fstat(file.fileno()).st_mode):
+        while True:
+            lines = await loop.run_in_executor(None, file.readlines, chunk_size)
+            if not lines:
+                return
+            for line in lines:
+                yield line
+    else:
+        reader = aio.StreamReader(limit=1 << 24)
+        await loop.connect_read_pipe(lambda: aio.StreamReaderProtocol(reader), file)
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            yield line
+
+
+async def query_logs_ingestion(pgpool: psycopg_pool.AsyncConnectionPool):
+    """Ingests the query logs of `--query-logs-ingestion-source` until its end."""
+    source = args.query_logs_ingestion_source
+    ingestor = QueryLogsIngestor(pgpool, args.query_logs_ingestion_batch_size)
+    file = sys.stdin.buffer if source == "-" else open(source, "rb")
+    try:
+        written = await ingestor.ingest(
+            read_lines(file), args.query_logs_ingestion_flush_interval
+        )
+    except:
+        logging.exception("Error while ingesting the query logs.")
+        raise
+    finally:
+        if file is not sys.stdin.buffer:
+            file.close()
+    logging.info("Ingested %s query logs from %s.", written, source)
@@ -0,0 +1,407 @@
+# Copyright 2023-, Semiotic AI, Inc.
+# SPDX-License-Identifier: Apache-2.0
+
+"""Native range partitioning of the `query_logs` table by day.
+
+`query_logs` is converted once into a table partitioned by `timestamp`, with its
+existing rows attached as the `query_logs_legacy` partition. Daily partitions
+(`query_logs_pYYYYMMDD`, UTC days) are then created ahead of time, and the
+partitions older than the retention dropped, or detached to be archived. A default
+partition catches the rows outside of the created partitions, so that the ingestion
+never fails. They are moved to their daily partition once it is created.
+
+The aggregations restricted to a time window, and the rollup updates, only scan the
+partitions overlapping their time range (partition pruning).
+"""
+
+import asyncio as aio
+import logging
+from datetime import date, datetime, timedelta, timezone
+from typing import List, Optional, Tuple
+
+import psycopg
+import psycopg_pool
+from psycopg import sql
+
+from autoagora.config import args
+
+
+class QueryLogsPartitions:
+    legacy_partition = "query_logs_legacy"
+    default_partition = "query_logs_default"
+
+    def __init__(self, pgpool: psycopg_pool.AsyncConnectionPool) -> None:
+        self.pgpool = pgpool
+
+    @staticmethod
+    def partition_name(day: date) -> str:
+        return f"query_logs_p{day:%Y%m%d}"
+
+    async def is_partitioned(self) -> bool:
+        async with self.pgpool.connection() as connection:
+            cursor = await connection.execute(
+                "SELECT relkind = 'p' FROM pg_class WHERE oid = 'query_logs'::regclass"
+            )
+            row = await cursor.fetchone()
+        return bool(row and row[0])
+
+    async def partition_table(self) -> None:
+        """Converts the regular `query_logs` table into a partitioned table, its
+        rows becoming the `query_logs_legacy` partition, which spans until the end
+        of the day of its latest row.
+
+        The table is locked during the conversion. The indexes of `query_logs` are
+        created on the partitioned table, along with the ones its primary key
+        requires on the legacy rows.
+        """
+        async with self.pgpool.connection() as connection:
+            await connection.execute("LOCK TABLE query_logs IN ACCESS EXCLUSIVE MODE")
+            cursor = await connection.execute(
+                "SELECT relkind = 'p' FROM pg_class WHERE oid = 'query_logs'::regclass"
+            )
+            row = await cursor.fetchone()
+            if row and row[0]:
+                return
+
+            cursor = await connection.execute(
+                """
+                SELECT
+                    date_trunc(
+                        'day', greatest(max(timestamp), now()), 'UTC'
+                    ) + interval '1 day'
+                FROM
+                    query_logs
+                """
+            )
+            row = await cursor.fetchone()
+            assert row
+            legacy_upper_bound: datetime = row[0]
+
+            cursor = await connection.execute(
+                """
+                SELECT
+                    conname,
+                    array_agg(attname::text ORDER BY ordinal)
+                FROM
+                    pg_constraint,
+                    unnest(conkey) WITH ORDINALITY AS key(attnum, ordinal)
+                INNER JOIN
+                    pg_attribute
+                ON
+                    attrelid = 'query_logs'::regclass
+                    AND pg_attribute.attnum = key.attnum
+                WHERE
+                    conrelid = 'query_logs'::regclass
+                    AND contype = 'p'
+                GROUP BY
+                    conname
+                """
+            )
+            primary_key = await cursor.fetchone()
+
+            cursor = await connection.execute(
+                """
+                SELECT
+                    conname,
+                    pg_get_constraintdef(oid)
+                FROM
+                    pg_constraint
+                WHERE
+                    conrelid = 'query_logs'::regclass
+                    AND contype = 'f'
+                """
+            )
+            foreign_keys = await cursor.fetchall()
+
+            cursor = await connection.execute(
+                """
+                SELECT
+                    indexrelid::regclass::text,
+                    CASE WHEN NOT indisunique THEN pg_get_indexdef(indexrelid) END
+                FROM
+                    pg_index
+                WHERE
+                    indrelid = 'query_logs'::regclass
+                """
+            )
+            indexes = await cursor.fetchall()
+
+            # The index names are unique per schema: free them for the partitioned
+            # table's indexes.
+            await connection.execute(
+                sql.SQL("ALTER TABLE query_logs RENAME TO {}").format(
+                    sql.Identifier(self.legacy_partition)
+                )
+            )
+            for index, _ in indexes:
+                await connection.execute(
+                    sql.SQL("ALTER INDEX {} RENAME TO {}").format(
+                        sql.Identifier(index),
+                        sql.Identifier(
+                            index.replace("query_logs", self.legacy_partition, 1)
+                        ),
+                    )
+                )
+
+            await connection.execute(
+                sql.SQL(
+                    """
+                    CREATE TABLE query_logs (
+                        LIKE {} INCLUDING DEFAULTS INCLUDING CONSTRAINTS
+                    ) PARTITION BY RANGE (timestamp)
+                    """
+                ).format(sql.Identifier(self.legacy_partition))
+            )
+            if primary_key:
+                # The partition key must be part of the primary key, which replaces
+                # the legacy rows' one.
+                primary_key_name, primary_key_columns = primary_key
+                if "timestamp" not in primary_key_columns:
+                    primary_key_columns.append("timestamp")
+                await connection.execute(
+                    sql.SQL("ALTER TABLE {} DROP CONSTRAINT {}").format(
+                        sql.Identifier(self.legacy_partition),
+                        sql.Identifier(
+                            primary_key_name.replace(
+                                "query_logs", self.legacy_partition, 1
+                            )
+                        ),
+                    )
+                )
+                await connection.execute(
+                    sql.SQL("ALTER TABLE query_logs ADD PRIMARY KEY ({})").format(
+                        sql.SQL(", ").join(map(sql.Identifier, primary_key_columns))
+                    )
+                )
+            for name, definition in foreign_keys:
+                await connection.execute(
+                    sql.SQL("ALTER TABLE query_logs ADD CONSTRAINT {} {}").format(
+                        sql.Identifier(name), sql.SQL(definition)
+                    )
+                )
+            # The indexes of the schema (see `schema_migrations`), cascaded to each
+            # partition. Their definition still refers to `query_logs`.
+            for _, definition in indexes:
+                if definition is not None:
+                    await connection.execute(sql.SQL(definition))
+
+            await connection.execute(
+                sql.SQL(
+                    """
+                    ALTER TABLE query_logs ATTACH PARTITION {}
+                    FOR VALUES FROM (MINVALUE) TO ({})
+                    """
+                ).format(
+                    sql.Identifier(self.legacy_partition),
+                    sql.Literal(legacy_upper_bound),
+                )
+            )
+            await connection.execute(
+                sql.SQL("CREATE TABLE {} PARTITION OF query_logs DEFAULT").format(
+                    sql.Identifier(self.default_partition)
+                )
+            )
+        logging.info(
+            "Partitioned query_logs, with the rows before %s in %s.",
+            legacy_upper_bound,
+            self.legacy_partition,
+        )
+
+    async def partitions(self) -> List[Tuple[str, Optional[datetime]]]:
+        """Returns the partitions of `query_logs` with their (exclusive) upper
+        bound, earliest first. The default partition has no upper bound, and comes
+        last."""
+        async with self.pgpool.connection() as connection:
+            cursor = await connection.execute(
+                """
+                SELECT
+                    relname::text,
+                    (
+                        regexp_match(
+                            pg_get_expr(relpartbound, oid), $$TO \\('(.*)'\\)$$
+                        )
+                    )[1]::timestamptz AS upper_bound
+                FROM
+                    pg_inherits
+                INNER JOIN
+                    pg_class
+                ON
+                    oid = inhrelid
+                WHERE
+                    inhparent = 'query_logs'::regclass
+                ORDER BY
+                    upper_bound NULLS LAST
+                """
+            )
+            return await cursor.fetchall()
+
+    async def create_partitions(self, until: datetime) -> List[str]:
+        """Creates the daily partitions following the latest one, up to the one
+        containing `until`.
+
+        Returns:
+            List[str]: Names of the created partitions.
+        """
+        upper_bounds = [
+            upper_bound
+            for _, upper_bound in await self.partitions()
+            if upper_bound is not None
+        ]
+        day = (
+            max(upper_bounds).astimezone(timezone.utc).date()
+            if upper_bounds
+            else datetime.now(timezone.utc).date()
+        )
+
+        created = []
+        async with self.pgpool.connection() as connection:
+            while day <= until.astimezone(timezone.utc).date():
+                lower_bound = datetime.combine(day, datetime.min.time(), timezone.utc)
+                upper_bound = lower_bound + timedelta(days=1)
+                name = self.partition_name(day)
+                async with connection.transaction():
+                    await self._create_partition(
+                        connection, name, lower_bound, upper_bound
+                    )
+                created.append(name)
+                day += timedelta(days=1)
+        return created
+
+    async def _create_partition(
+        self,
+        connection: psycopg.AsyncConnection,
+        name: str,
+        lower_bound: datetime,
+        upper_bound: datetime,
+    ) -> None:
+        """Creates a partition of `query_logs`, moving the rows of its range out of
+        the default partition, which would otherwise make its creation fail."""
+        create_partition = sql.SQL(
+            """
+            CREATE TABLE {} PARTITION OF query_logs
+            FOR VALUES FROM ({}) TO ({})
+            """
+        ).format(
+            sql.Identifier(name),
+            sql.Literal(lower_bound),
+            sql.Literal(upper_bound),
+        )
+        cursor = await connection.execute(
+            sql.SQL(
+                "SELECT EXISTS (SELECT FROM {} WHERE timestamp >= %s AND timestamp < %s)"
+            ).format(sql.Identifier(self.default_partition)),
+            (lower_bound, upper_bound),
+        )
+        row = await cursor.fetchone()
+        if not (row and row[0]):
+            await connection.execute(create_partition)
+            return
+
+        await connection.execute(
+            sql.SQL("ALTER TABLE query_logs DETACH PARTITION {}").format(
+                sql.Identifier(self.default_partition)
+            )
+        )
+        await connection.execute(create_partition)
+        # Routed to the new partition, the default one being detached
+        cursor = await connection.execute(
+            sql.SQL(
+                """
+                WITH moved AS (
+                    DELETE FROM {}
+                    WHERE timestamp >= %s AND timestamp < %s
+                    RETURNING *
+                )
+                INSERT INTO query_logs
+                SELECT * FROM moved
+                """
+            ).format(sql.Identifier(self.default_partition)),
+            (lower_bound, upper_bound),
+        )
+        await connection.execute(
+            sql.SQL("ALTER TABLE query_logs ATTACH PARTITION {} DEFAULT").format(
+                sql.Identifier(self.default_partition)
+            )
+        )
+        logging.info(
+            "Moved %s query logs from %s to %s.",
+            cursor.rowcount,
+            self.default_partition,
+            name,
+        )
+
+    async def expire_partitions(
+        self, cutoff: datetime, archive: bool = False
+    ) -> List[str]:
+        """Drops the partitions entirely before `cutoff`, or detaches them from
+        `query_logs` with `archive`, to be archived and dropped externally.
+
+        Returns:
+            List[str]: Names of the expired partitions.
+        """
+        expired = [
+            name
+            for name, upper_bound in await self.partitions()
+            if upper_bound is not None and upper_bound <= cutoff
+        ]
+        async with self.pgpool.connection() as connection:
+            for name in expired:
+                await connection.execute(
+                    sql.SQL(
+                        "ALTER TABLE query_logs DETACH PARTITION {}"
+                        if archive
+                        else "DROP TABLE {}"
+                    ).format(sql.Identifier(name))
+                )
+        return expired
+
+    async def maintain(
+        self,
+        premake: timedelta,
+        retention: Optional[timedelta] = None,
+        archive: bool = False,
+    ) -> None:
+        """Partitions `query_logs` if needed, creates its partitions up to `premake`
+        ahead, and expires the partitions older than `retention`.
+
+        Args:
+            premake (timedelta): How far ahead to create the partitions.
+            retention (Optional[timedelta], optional): Age of the query logs to
+                expire. Defaults to None (keep all the history).
+            archive (bool, optional): Detach the expired partitions instead of
+                dropping them. Defaults to False.
+        """
+        if not await self.is_partitioned():
+            await self.partition_table()
+
+        now = datetime.now(timezone.utc)
+        created = await self.create_partitions(now + premake)
+        if created:
+            logging.info("Created query_logs partitions %s.", created)
+
+        if retention is not None:
+            expired = await self.expire_partitions(now - retention, archive)
+            if expired:
+                logging.info(
+                    "%s expired query_logs partitions %s.",
+                    "Detached" if archive else "Dropped",
+                    expired,
+                )
+
+
+async def query_logs_partitions_loop(pgpool: psycopg_pool.AsyncConnectionPool):
+    """Periodically maintains the `query_logs` partitions, according to the
+    `--query-logs-partitions-*` settings."""
+    partitions = QueryLogsPartitions(pgpool)
+    while True:
+        try:
+            await partitions.maintain(
+                premake=timedelta(days=args.query_logs_partitions_premake),
+                retention=timedelta(days=args.query_logs_retention)
+                if args.query_logs_retention is not None
+                else None,
+                archive=args.query_logs_retention_archive,
+            )
+        except:
+            logging.exception("Error while maintaining the query_logs partitions.")
+        await aio.sleep(args.query_logs_partitions_interval)
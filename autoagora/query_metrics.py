@@ -1,17 +1,78 @@
 # Copyright 2022-, Semiotic AI, Inc.
 # SPDX-License-Identifier: Apache-2.0
 
+import asyncio as aio
 import logging
 import re
 from abc import ABC, abstractmethod
-from functools import reduce
-from typing import List
+from dataclasses import dataclass
+from datetime import timedelta
+from time import time
+from typing import Dict, List, Optional
 from urllib.parse import urlparse
 
 import aiohttp
-import backoff
+from prometheus_client import Counter, Gauge, Histogram
+
+from autoagora.k8s_service_watcher import (
+    K8SServiceEndpointSlicesWatcher,
+    K8SServiceEndpointsWatcher,
+)
+
+stale_endpoints_gauge = Gauge(
+    "indexer_service_metrics_stale_endpoints",
+    "Indexer-service metrics endpoints left out of the last query count of a "
+    "subgraph, as their scrape failed or timed out.",
+    ["subgraph"],
+)
+scrape_histogram = Histogram(
+    "indexer_service_metrics_scrape_seconds",
+    "Duration of the requests to the indexer-service metrics endpoints, by outcome "
+    '("ok", "error", or "cancelled" when timed out or hedged).',
+    ["outcome"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+hedged_scrapes_counter = Counter(
+    "indexer_service_metrics_hedged_scrapes",
+    "Scrapes of an indexer-service metrics endpoint sent again, as the endpoint was "
+    "slower than usual.",
+)
+
+# A scrape is sent again after this factor of the endpoint's usual latency...
+HEDGE_LATENCY_FACTOR = 3
+# ... but not before this delay
+MIN_HEDGE_DELAY = timedelta(milliseconds=100)
+
+
+@dataclass
+class EndpointStats:
+    # Exponentially weighted moving average of the scrape latency, in seconds
+    latency: Optional[float] = None
+    # Time of the last successful scrape
+    last_success: Optional[float] = None
+
+    def add_latency(self, latency: float, smoothing: float = 0.2) -> None:
+        self.latency = (
+            latency
+            if self.latency is None
+            else smoothing * latency + (1 - smoothing) * self.latency
+        )
 
-from autoagora.k8s_service_watcher import K8SServiceEndpointsWatcher
+
+@dataclass
+class QueryCounts:
+    """Cumulative query counts of a subgraph, by metrics endpoint (indexer-service
+    pod)."""
+
+    # Endpoints scraped
+    endpoints: List[str]
+    # Query counts of the endpoints that answered
+    counts: Dict[str, int]
+
+    @property
+    def stale(self) -> List[str]:
+        """Endpoints scraped that did not answer."""
+        return [endpoint for endpoint in self.endpoints if endpoint not in self.counts]
 
 
 class MetricsEndpoints(ABC):
@@ -19,6 +80,8 @@ class MetricsEndpoints(ABC):
 
     def __init__(self) -> None:
         super().__init__()
+        # Scrape statistics, by endpoint
+        self.stats: Dict[str, EndpointStats] = {}
 
     @abstractmethod
     def __call__(self) -> List[str]:
@@ -55,15 +118,21 @@ class StaticMetricsEndpoints(MetricsEndpoints):
 
 class K8SServiceWatcherMetricsEndpoints(MetricsEndpoints):
     """Implementation of MetricsEndpoints that returns a continuously-updating a list of
-    metrics endpoints from a Kubernetes service URL."""
+    metrics endpoints from a Kubernetes service URL.
 
-    def __init__(self, url: str) -> None:
+    Only the ready pods of the service are listed: the watched Endpoints list their
+    not ready addresses apart, and the not ready endpoints of the EndpointSlices are
+    filtered out."""
+
+    def __init__(self, url: str, endpoint_slices: bool = False) -> None:
         """Initializes a new instance of K8SServiceWatcherMetricsEndpoints with the
         given Kubernetes service URL.
 
         Args:
             url (str): A string representing the Kubernetes service URL in the format
             <scheme>://<service_name>:<pod_metrics_port>/<path>.
+            endpoint_slices (bool, optional): Watch the service's EndpointSlices
+            rather than its Endpoints. Defaults to False.
         """
         super().__init__()
         self._parsed_url = urlparse(url)
@@ -77,7 +146,11 @@ class K8SServiceWatcherMetricsEndpoints(MetricsEndpoints):
         assert re.fullmatch(
             r"[a-z0-9]([-a-z0-9]*[a-z0-9])?", service_name
         ), "Invalid k8s service name."
-        self._k8s_service_watcher = K8SServiceEndpointsWatcher(service_name)
+        self._k8s_service_watcher = (
+            K8SServiceEndpointSlicesWatcher(service_name)
+            if endpoint_slices
+            else K8SServiceEndpointsWatcher(service_name)
+        )
 
     def __call__(self) -> List[str]:
         """Retrieves a list of metrics endpoints.
@@ -87,7 +160,12 @@ class K8SServiceWatcherMetricsEndpoints(MetricsEndpoints):
         """
         port = self._parsed_url.port
         return [
-            self._parsed_url._replace(netloc=f"{endpoint_ip}:{port}").geturl()
+            self._parsed_url._replace(
+                # IPv6 addresses are bracketed in URLs
+                netloc=f"[{endpoint_ip}]:{port}"
+                if ":" in endpoint_ip
+                else f"{endpoint_ip}:{port}"
+            ).geturl()
             for endpoint_ip in self._k8s_service_watcher.endpoint_ips
         ]
 
@@ -96,41 +174,188 @@ class HTTPError(Exception):
     """Catch-all for HTTP errors"""
 
 
-@backoff.on_exception(
-    backoff.expo, (aiohttp.ClientError, HTTPError), max_time=30, logger=logging.root
-)
-async def subgraph_query_count(
-    subgraph: str, metrics_endpoints: MetricsEndpoints
-) -> int:
-    endpoints = metrics_endpoints()
-    results = []
-    async with aiohttp.ClientSession() as session:
-        for endpoint in endpoints:
+async def _scrape(
+    session: aiohttp.ClientSession,
+    endpoint: str,
+    stats: EndpointStats,
+    hedge_delay: timedelta,
+) -> str:
+    """Returns the metrics of an endpoint.
+
+    If the endpoint has not answered after `hedge_delay`, or after a few times its
+    usual latency, the request is sent again (hedged), and the first response of
+    either is used.
+    """
+
+    async def get() -> str:
+        start = time()
+        outcome = "error"
+        try:
             async with session.get(endpoint) as response:
                 if response.status != 200:
                     raise HTTPError(response.status)
+                text = await response.text()
+            outcome = "ok"
+        except aio.CancelledError:
+            outcome = "cancelled"
+            raise
+        finally:
+            scrape_histogram.labels(outcome=outcome).observe(time() - start)
+        stats.add_latency(time() - start)
+        return text
 
-                results.extend(
-                    re.findall(
-                        r'indexer_service_queries_ok{{deployment="{subgraph}"}} ([0-9]*)'.format(
-                            subgraph=subgraph
-                        ),
-                        await response.text(),
-                    )
-                )
+    if stats.latency is not None:
+        hedge_delay = max(
+            MIN_HEDGE_DELAY, timedelta(seconds=HEDGE_LATENCY_FACTOR * stats.latency)
+        )
+
+    attempts = {aio.ensure_future(get())}
+    hedged = False
+    try:
+        while True:
+            done, attempts = await aio.wait(
+                attempts,
+                timeout=None if hedged else hedge_delay.total_seconds(),
+                return_when=aio.FIRST_COMPLETED,
+            )
+            for attempt in done:
+                if attempt.exception() is None:
+                    return attempt.result()
+            if not attempts:
+                # Raises the error of the last attempt
+                return done.pop().result()
+            if not done:
+                hedged = True
+                hedged_scrapes_counter.inc()
+                attempts.add(aio.ensure_future(get()))
+    finally:
+        for attempt in attempts:
+            attempt.cancel()
+
+
+async def subgraph_query_counts(
+    subgraph: str,
+    metrics_endpoints: MetricsEndpoints,
+    timeout: timedelta = timedelta(seconds=10),
+    hedge_delay: timedelta = timedelta(seconds=1),
+) -> QueryCounts:
+    """Scrapes the cumulative query count of a subgraph from each metrics endpoint,
+    concurrently.
+
+    An endpoint that fails or times out is left out of the counts (stale), rather than
+    failing the whole scrape.
 
-                logging.debug(
-                    "Number of queries for subgraph %s from %s: %s",
-                    subgraph,
-                    endpoint,
-                    results[-1:],  # Will return empty list if empty, instead of error
+    Args:
+        subgraph (str): Subgraph IPFS hash.
+        metrics_endpoints (MetricsEndpoints): Metrics endpoints to scrape.
+        timeout (timedelta, optional): Timeout of the scrape of each endpoint.
+            Defaults to 10 seconds.
+        hedge_delay (timedelta, optional): Delay after which the scrape of an
+            endpoint of unknown latency is sent again. Defaults to 1 second.
+
+    Returns:
+        QueryCounts: Query counts of the endpoints that answered.
+    """
+    endpoints = metrics_endpoints()
+    # Forget the endpoints gone
+    for endpoint in metrics_endpoints.stats.keys() - set(endpoints):
+        del metrics_endpoints.stats[endpoint]
+
+    async with aiohttp.ClientSession() as session:
+        results = await aio.gather(
+            *(
+                aio.wait_for(
+                    _scrape(
+                        session,
+                        endpoint,
+                        metrics_endpoints.stats.setdefault(endpoint, EndpointStats()),
+                        hedge_delay,
+                    ),
+                    timeout.total_seconds(),
                 )
+                for endpoint in endpoints
+            ),
+            return_exceptions=True,
+        )
+
+    counts = {}
+    for endpoint, result in zip(endpoints, results):
+        if isinstance(result, (aiohttp.ClientError, HTTPError, aio.TimeoutError)):
+            stats = metrics_endpoints.stats[endpoint]
+            logging.warning(
+                "Stale metrics endpoint %s, last scraped at %s: %r",
+                endpoint,
+                stats.last_success,
+                result,
+            )
+            continue
+        if isinstance(result, BaseException):
+            raise result
+
+        metrics_endpoints.stats[endpoint].last_success = time()
+        # The subgraph query count will not be in the metric if it hasn't received
+        # any queries.
+        counts[endpoint] = sum(
+            int(count)
+            for count in re.findall(
+                r'indexer_service_queries_ok{{deployment="{subgraph}"}} ([0-9]*)'.format(
+                    subgraph=subgraph
+                ),
+                result,
+            )
+        )
+        logging.debug(
+            "Number of queries for subgraph %s from %s: %s",
+            subgraph,
+            endpoint,
+            counts[endpoint],
+        )
+
+    stale_endpoints_gauge.labels(subgraph=subgraph).set(len(endpoints) - len(counts))
+    return QueryCounts(endpoints=endpoints, counts=counts)
+
+
+def query_rate(first: QueryCounts, second: QueryCounts, duration: float) -> float:
+    """Returns the queries per second of a subgraph between two of its query counts.
+
+    Only the endpoints scraped both times, which served for the whole duration, are
+    accounted for. Their rate is measured on the ones that answered both times, with
+    a counter that did not reset (pod restart), and extrapolated to the others, as
+    the Kubernetes service balances the queries evenly across its pods.
+
+    Args:
+        first (QueryCounts): Query counts at the start of the duration.
+        second (QueryCounts): Query counts at the end of the duration.
+        duration (float): Duration between the query counts, in seconds.
+
+    Raises:
+        HTTPError: None of the endpoints answered both times.
+
+    Returns:
+        float: Queries per second.
+    """
+    if not first.endpoints and not second.endpoints:
+        return 0.0
+
+    endpoints = set(first.endpoints) & set(second.endpoints)
+    measured = [
+        endpoint
+        for endpoint in endpoints
+        if endpoint in first.counts
+        and endpoint in second.counts
+        and second.counts[endpoint] >= first.counts[endpoint]
+    ]
+    if not measured:
+        raise HTTPError("No metrics endpoint answered both query counts.")
+    if len(measured) < len(endpoints):
+        logging.warning(
+            "Query rate extrapolated from %s of %s metrics endpoints.",
+            len(measured),
+            len(endpoints),
+        )
 
-    if len(results) == 0:
-        # The subgraph query count will not be in the metric if it hasn't received any
-        # queries.
-        return 0
-    if len(results) == 1:
-        return int(results[0])
-    else:
-        return reduce(lambda x, y: int(x) + int(y), results)
+    rate = (
+        sum(second.counts[endpoint] - first.counts[endpoint] for endpoint in measured)
+        / duration
+    )
+    return rate * len(endpoints) / len(measured)
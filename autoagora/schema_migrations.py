@@ -0,0 +1,391 @@
+# Copyright 2023-, Semiotic AI, Inc.
+# SPDX-License-Identifier: Apache-2.0
+
+"""Versioned migrations of the database schema, applied once at startup, before
+any loop starts, rather than as the tables are first used.
+
+The versions applied are recorded in the `schema_migrations` table, and `migrate`
+applies the missing ones in order, under an advisory lock so that concurrent
+AutoAgora instances do not apply them twice. The first migrations create the
+tables with `IF NOT EXISTS`, to adopt the databases set up by the previous
+versions, or by AutoAgora Processor for the query logs.
+
+The query logs migrations are only applied when AutoAgora uses the query logs,
+leaving their schema to AutoAgora Processor otherwise. The background migrations
+(index builds, which may take long on large query logs) are applied after the
+startup, while the loops run, under their own advisory lock.
+
+New schema changes are added as new migrations, with the next version number.
+Applied migrations must never be modified.
+"""
+
+import asyncio as aio
+import logging
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import Awaitable, Callable, List, Optional
+
+import psycopg
+import psycopg_pool
+from psycopg import sql
+
+# Advisory lock key held while migrating (arbitrary)
+MIGRATIONS_LOCK_KEY = 0x4155_544F_4147_4F52
+# Advisory lock key held while applying the background migrations, which must not
+# hold back the startup migrations of the other instances.
+MIGRATIONS_BACKGROUND_LOCK_KEY = 0x4155_544F_4147_4F53
+# Interval between the attempts to take the advisory lock
+MIGRATIONS_LOCK_RETRY_INTERVAL = timedelta(seconds=1)
+
+
+@dataclass
+class Migration:
+    version: int
+    description: str
+    apply: Callable[[psycopg.AsyncConnection], Awaitable[None]]
+    # Applied outside of a transaction, which `CREATE INDEX CONCURRENTLY` requires.
+    # The migration must then be idempotent, as it may be interrupted midway.
+    transactional: bool = True
+    # Creates or modifies the query logs tables, only used with the relative query
+    # costs. It must then only depend on the query logs or the common migrations.
+    query_logs: bool = False
+    # Applied in the background, once AutoAgora started. Nothing may depend on it.
+    background: bool = False
+
+
+async def _create_price_save_state(connection: psycopg.AsyncConnection) -> None:
+    await connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS price_save_state (
+            subgraph        char(46)            PRIMARY KEY,
+            last_update     timestamptz         NOT NULL,
+            mean            double precision    NOT NULL,
+            stddev          double precision    NOT NULL
+        )
+        """
+    )
+
+
+async def _create_query_logs(connection: psycopg.AsyncConnection) -> None:
+    await connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS query_skeletons (
+            hash        bytea   PRIMARY KEY,
+            query       text    NOT NULL
+        )
+        """
+    )
+    await connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS query_logs (
+            id              uuid        PRIMARY KEY DEFAULT gen_random_uuid(),
+            query_hash      bytea       REFERENCES query_skeletons(hash),
+            subgraph        char(46)    NOT NULL,
+            timestamp       timestamptz NOT NULL,
+            query_time_ms   integer,
+            query_variables text
+        )
+        """
+    )
+
+
+async def _create_index(
+    connection: psycopg.AsyncConnection, name: str, columns: sql.Composable
+) -> None:
+    """Creates an index of `query_logs` without blocking the ingestion
+    (`CONCURRENTLY`).
+
+    A partitioned table does not support `CONCURRENTLY`: the index is then created
+    on the partitioned table alone, and becomes valid once the indexes of all its
+    partitions, created concurrently, are attached to it. The partitions created
+    meanwhile get theirs on creation.
+
+    An invalid index left by an interrupted `CREATE INDEX CONCURRENTLY` is dropped
+    and created again."""
+    cursor = await connection.execute(
+        "SELECT relkind = 'p' FROM pg_class WHERE oid = 'query_logs'::regclass"
+    )
+    row = await cursor.fetchone()
+    assert row
+    if not row[0]:
+        await _create_index_concurrently(connection, name, "query_logs", columns)
+        return
+
+    await connection.execute(
+        sql.SQL(
+            "CREATE INDEX IF NOT EXISTS {name} ON ONLY query_logs {columns}"
+        ).format(name=sql.Identifier(name), columns=columns)
+    )
+    # The partitions without an index attached to the partitioned table's one
+    cursor = await connection.execute(
+        """
+        SELECT
+            inhrelid::regclass::text
+        FROM
+            pg_inherits
+        WHERE
+            inhparent = 'query_logs'::regclass
+            AND inhrelid NOT IN (
+                SELECT
+                    indrelid
+                FROM
+                    pg_inherits
+                INNER JOIN
+                    pg_index
+                ON
+                    indexrelid = inhrelid
+                WHERE
+                    inhparent = %s::regclass
+            )
+        """,
+        [name],
+    )
+    for (partition,) in await cursor.fetchall():
+        partition_index = name.replace("query_logs", partition, 1)
+        await _create_index_concurrently(
+            connection, partition_index, partition, columns
+        )
+        await connection.execute(
+            sql.SQL("ALTER INDEX {} ATTACH PARTITION {}").format(
+                sql.Identifier(name), sql.Identifier(partition_index)
+            )
+        )
+
+
+async def _create_index_concurrently(
+    connection: psycopg.AsyncConnection,
+    name: str,
+    table: str,
+    columns: sql.Composable,
+) -> None:
+    cursor = await connection.execute(
+        "SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)",
+        [name],
+    )
+    if await cursor.fetchone() == (True,):
+        await connection.execute(
+            sql.SQL("DROP INDEX CONCURRENTLY {}").format(sql.Identifier(name))
+        )
+    await connection.execute(
+        sql.SQL("CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON {} {}").format(
+            sql.Identifier(name), sql.Identifier(table), columns
+        )
+    )
+
+
+async def _create_query_logs_indexes(connection: psycopg.AsyncConnection) -> None:
+    # Per subgraph time windows (`LogsDB` time windows and high-water marks, rollup
+    # updates)
+    await _create_index(
+        connection,
+        "query_logs_subgraph_timestamp_idx",
+        sql.SQL("(subgraph, timestamp)"),
+    )
+    # Per subgraph aggregations by query skeleton, with index-only scans
+    await _create_index(
+        connection,
+        "query_logs_subgraph_query_hash_idx",
+        sql.SQL("(subgraph, query_hash) INCLUDE (query_time_ms)"),
+    )
+
+
+async def _create_query_stats_rollup(connection: psycopg.AsyncConnection) -> None:
+    await connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS query_stats_rollup (
+            subgraph        char(46)            NOT NULL,
+            query_hash      bytea               NOT NULL,
+            bucket          timestamptz         NOT NULL,
+            count           bigint              NOT NULL,
+            sum_time        double precision    NOT NULL,
+            sum_sq_time     double precision    NOT NULL,
+            min_time        integer             NOT NULL,
+            max_time        integer             NOT NULL,
+            PRIMARY KEY (subgraph, query_hash, bucket)
+        )
+        """
+    )
+    # Query time sketch bins. Bin i counts the query times in (gamma^(i-1), gamma^i],
+    # and bin -1 the zero query times.
+    await connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS query_stats_sketch (
+            subgraph        char(46)            NOT NULL,
+            query_hash      bytea               NOT NULL,
+            bucket          timestamptz         NOT NULL,
+            bin             smallint            NOT NULL,
+            count           bigint              NOT NULL,
+            PRIMARY KEY (subgraph, query_hash, bucket, bin)
+        )
+        """
+    )
+    # Single-row table holding the `query_logs.timestamp` up to which
+    # `query_stats_rollup` and `query_stats_sketch` have been aggregated.
+    await connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS query_stats_rollup_watermark (
+            id              boolean             PRIMARY KEY DEFAULT TRUE CHECK (id),
+            high_water_mark timestamptz         NOT NULL
+        )
+        """
+    )
+
+
+async def _create_price_history(connection: psycopg.AsyncConnection) -> None:
+    await connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS price_history (
+            timestamp           timestamptz         NOT NULL,
+            subgraph            char(46)            NOT NULL,
+            price_multiplier    double precision    NOT NULL,
+            queries_per_second  double precision    NOT NULL,
+            reward              double precision    NOT NULL,
+            mean                double precision    NOT NULL,
+            stddev              double precision    NOT NULL
+        )
+        """
+    )
+    # The steps are appended in time order
+    await connection.execute(
+        """
+        CREATE INDEX IF NOT EXISTS price_history_timestamp_idx
+        ON price_history USING brin (timestamp)
+        """
+    )
+
+
+async def _create_model_rebuild_watermark(
+    connection: psycopg.AsyncConnection,
+) -> None:
+    # The `query_logs.timestamp` up to which the model of each subgraph was last
+    # built from, and when (see `ModelRebuildTrigger`). NULL if it had no query logs.
+    await connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS model_rebuild_watermark (
+            subgraph        char(46)            PRIMARY KEY,
+            high_water_mark timestamptz,
+            built_at        timestamptz         NOT NULL
+        )
+        """
+    )
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, "Create price_save_state", _create_price_save_state),
+    Migration(
+        2,
+        "Create query_skeletons and query_logs",
+        _create_query_logs,
+        query_logs=True,
+    ),
+    Migration(
+        3,
+        "Index query_logs by subgraph and timestamp, and by subgraph and query hash",
+        _create_query_logs_indexes,
+        transactional=False,
+        query_logs=True,
+        background=True,
+    ),
+    Migration(
+        4,
+        "Create the query stats rollup tables",
+        _create_query_stats_rollup,
+        query_logs=True,
+    ),
+    Migration(5, "Create price_history", _create_price_history),
+    Migration(
+        6,
+        "Create model_rebuild_watermark",
+        _create_model_rebuild_watermark,
+        query_logs=True,
+    ),
+]
+
+
+async def migrate(
+    pgpool: psycopg_pool.AsyncConnectionPool,
+    migrations: List[Migration] = MIGRATIONS,
+    query_logs: bool = True,
+    background: Optional[bool] = None,
+) -> List[int]:
+    """Applies the migrations not applied yet, in version order.
+
+    Args:
+        pgpool (psycopg_pool.AsyncConnectionPool): Database connection pool.
+        migrations (List[Migration], optional): Migrations of the schema. Defaults
+            to `MIGRATIONS`.
+        query_logs (bool, optional): Whether to apply the query logs migrations.
+            Defaults to True.
+        background (Optional[bool], optional): Only apply the background
+            migrations if True, only the others if False. Defaults to None (all
+            the migrations).
+
+    Returns:
+        List[int]: Versions of the migrations applied.
+    """
+    applied = []
+    lock_key = MIGRATIONS_BACKGROUND_LOCK_KEY if background else MIGRATIONS_LOCK_KEY
+    async with pgpool.connection() as connection:
+        await connection.commit()
+        await connection.set_autocommit(True)
+        try:
+            # Polled rather than waited for, as `CREATE INDEX CONCURRENTLY` waits for
+            # all the transactions in progress, which would then include the wait of
+            # another instance for the lock.
+            while True:
+                cursor = await connection.execute(
+                    "SELECT pg_try_advisory_lock(%s)", [lock_key]
+                )
+                if await cursor.fetchone() == (True,):
+                    break
+                await aio.sleep(MIGRATIONS_LOCK_RETRY_INTERVAL.total_seconds())
+            try:
+                await connection.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS schema_migrations (
+                        version         integer         PRIMARY KEY,
+                        description     text            NOT NULL,
+                        applied_at      timestamptz     NOT NULL DEFAULT now()
+                    )
+                    """
+                )
+                cursor = await connection.execute(
+                    "SELECT version FROM schema_migrations"
+                )
+                applied_versions = {version for version, in await cursor.fetchall()}
+
+                for migration in sorted(migrations, key=lambda m: m.version):
+                    if (
+                        migration.version in applied_versions
+                        or (migration.query_logs and not query_logs)
+                        or (
+                            background is not None
+                            and migration.background != background
+                        )
+                    ):
+                        continue
+                    logging.info(
+                        "Applying schema migration %s: %s",
+                        migration.version,
+                        migration.description,
+                    )
+                    if migration.transactional:
+                        async with connection.transaction():
+                            await migration.apply(connection)
+                            await _record(connection, migration)
+                    else:
+                        await migration.apply(connection)
+                        await _record(connection, migration)
+                    applied.append(migration.version)
+            finally:
+                await connection.execute("SELECT pg_advisory_unlock(%s)", [lock_key])
+        finally:
+            await connection.set_autocommit(False)
+    return applied
+
+
+async def _record(connection: psycopg.AsyncConnection, migration: Migration) -> None:
+    await connection.execute(
+        "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+        [migration.version, migration.description],
+    )
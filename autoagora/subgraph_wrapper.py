@@ -7,9 +7,24 @@ from typing import Optional
 
 import aiohttp
 import backoff
+from prometheus_client import Histogram
 
 from autoagora.indexer_utils import get_cost_variables, set_cost_model
-from autoagora.query_metrics import HTTPError, MetricsEndpoints, subgraph_query_count
+from autoagora.query_metrics import (
+    HTTPError,
+    MetricsEndpoints,
+    query_rate,
+    subgraph_query_counts,
+)
+
+# Stages of the price bandits' cycles. Not labeled by subgraph, to keep the number of
+# series bounded.
+cycle_stage_histogram = Histogram(
+    "bandit_cycle_stage_seconds",
+    "Duration of the stages of the price bandits' cycles.",
+    ["stage"],
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300),
+)
 
 
 class SubgraphWrapper:
@@ -20,16 +35,16 @@ class SubgraphWrapper:
         self.last_change_time: Optional[float] = None
 
     async def set_cost_multiplier(self, cost_multiplier: float):
-        cost_variables = await get_cost_variables(self.subgraph)
-        cost_variables["GLOBAL_COST_MULTIPLIER"] = cost_multiplier
-        await set_cost_model(self.subgraph, variables=cost_variables)
+        with cycle_stage_histogram.labels(stage="set_cost_multiplier").time():
+            cost_variables = await get_cost_variables(self.subgraph)
+            cost_variables["GLOBAL_COST_MULTIPLIER"] = cost_multiplier
+            await set_cost_model(self.subgraph, variables=cost_variables)
         self.last_change_time = time()
 
     # Timeout occurs when e.g. restarting the indexer-service. So we give it up to 10
     # minutes to recover.
-    # Though subgraph_query_count has its own backoff, it is shorter. If the
-    # indexer-service outage lasts for longer, we prefer re-running the whole
-    # queries_per_second.
+    # A pod that fails is left out of the query counts, so this only happens when
+    # none of them answered. We then prefer re-running the whole queries_per_second.
     @backoff.on_exception(
         backoff.expo, (aiohttp.ClientError, HTTPError), max_time=600, max_tries=10
     )
@@ -40,18 +55,22 @@ class SubgraphWrapper:
         if self.last_change_time is not None:
             time_since_last_change = time() - self.last_change_time
             if time_since_last_change < SubgraphWrapper.GATEWAY_DELAY:
-                await sleep(SubgraphWrapper.GATEWAY_DELAY - time_since_last_change)
+                with cycle_stage_histogram.labels(stage="gateway_delay").time():
+                    await sleep(SubgraphWrapper.GATEWAY_DELAY - time_since_last_change)
 
-        query_count_1 = await subgraph_query_count(self.subgraph, metrics_endpoints)
+        with cycle_stage_histogram.labels(stage="query_count").time():
+            query_counts_1 = await subgraph_query_counts(
+                self.subgraph, metrics_endpoints
+            )
         timestamp_1 = time()
 
-        await sleep(average_duration)
+        with cycle_stage_histogram.labels(stage="observation").time():
+            await sleep(average_duration)
 
-        query_count_2 = await subgraph_query_count(self.subgraph, metrics_endpoints)
+        with cycle_stage_histogram.labels(stage="query_count").time():
+            query_counts_2 = await subgraph_query_counts(
+                self.subgraph, metrics_endpoints
+            )
         timestamp_2 = time()
 
-        queries_per_second = (query_count_2 - query_count_1) / (
-            timestamp_2 - timestamp_1
-        )
-
-        return queries_per_second
+        return query_rate(query_counts_1, query_counts_2, timestamp_2 - timestamp_1)
@@ -3,6 +3,10 @@ DEFAULT_AGORA_VARIABLES = {"DEFAULT_COST": 50}
 
 AGORA_DEFAULT_COST_MODEL = "default => $DEFAULT_COST * $GLOBAL_COST_MULTIPLIER;"
 
+# Channel of the `NOTIFY` sent with each batch of ingested query logs, with a
+# "<subgraph IPFS hash> <number of new query logs>" payload per subgraph.
+QUERY_LOGS_NOTIFY_CHANNEL = "query_logs_ingested"
+
 AGORA_ENTRY_TEMPLATE = """\
 # Generated by AutoAgora {{aa_version}}
 
@@ -12,11 +16,22 @@ AGORA_ENTRY_TEMPLATE = """\
 {% for frequent_query in most_frequent_queries %}
 
 # count:        {{frequent_query.count}}
+{%- if frequent_query.count_stderr is not none %}
+# count stderr: {{frequent_query.count_stderr}}
+{%- endif %}
 # min time:     {{frequent_query.min_time}}
 # max time:     {{frequent_query.max_time}}
 # avg time:     {{frequent_query.avg_time}}
 # stddev time:  {{frequent_query.stddev_time}}
-{{frequent_query.query}} => {{frequent_query.avg_time}} * $GLOBAL_COST_MULTIPLIER;
+{%- for quantile, quantile_time in (frequent_query.quantile_times or {}).items() %}
+{{("# p%g time:"|format(quantile * 100)).ljust(15)}} {{quantile_time}}
+{%- endfor %}
+{{frequent_query.query}} => {{frequent_query.price_time}} * $GLOBAL_COST_MULTIPLIER;
+{% endfor %}
+{%- for root_field_cost in long_tail_costs %}
+
+# long tail count: {{root_field_cost.count}}
+{{"query{%s}"|format(root_field_cost.root_field)}} => {{root_field_cost.time}} * $GLOBAL_COST_MULTIPLIER;
 {% endfor %}
 default => $DEFAULT_COST * $GLOBAL_COST_MULTIPLIER;\
 """
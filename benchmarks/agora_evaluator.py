@@ -0,0 +1,112 @@
+# Copyright 2023-, Semiotic AI, Inc.
+# SPDX-License-Identifier: Apache-2.0
+
+"""Builds the relative query costs model of a subgraph from an AutoAgora logs
+database, and replays the subgraph's logged queries against it.
+
+Reports the model size, the share of the logged queries it prices, the share priced
+by its `default` statement, price statistics and the matching throughput. Any
+option after `--` is passed on to the AutoAgora configuration (e.g.
+`--relative-query-costs-max-entries 100`), to compare model settings.
+
+Usage:
+    poetry run python benchmarks/agora_evaluator.py \\
+        "host=localhost dbname=autoagora user=postgres password=postgres" \\
+        QmPnu3R7Fm4RmBF21aCYUohDmWbKd3VMXo64ACiRtwUQrn --limit 100000
+"""
+
+import argparse
+import asyncio
+import statistics
+from datetime import timedelta
+
+import psycopg_pool
+
+from autoagora.agora_evaluator import AgoraModel
+from autoagora.config import init_config
+from autoagora.logs_db import LogsDB
+from autoagora.model_builder import model_builder
+from autoagora.schema_migrations import migrate
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("conninfo", help="libpq connection string.")
+    parser.add_argument("subgraph", help="Subgraph IPFS hash.")
+    parser.add_argument(
+        "--limit", type=int, default=None, help="Replay the most recent queries only."
+    )
+    parser.add_argument(
+        "--window",
+        type=int,
+        default=None,
+        help="(Seconds) Replay the queries logged within that duration only.",
+    )
+    parser.add_argument("autoagora_args", nargs=argparse.REMAINDER)
+    benchmark_args = parser.parse_args()
+
+    init_config(
+        [
+            "--indexer-agent-mgmt-endpoint",
+            "http://nowhere",
+            "--postgres-host",
+            "nowhere",
+            "--postgres-username",
+            "nowhere",
+            "--postgres-password",
+            "nowhere",
+            "--indexer-service-metrics-endpoint",
+            "http://nowhere",
+            "--relative-query-costs",
+        ]
+        + [arg for arg in benchmark_args.autoagora_args if arg != "--"]
+    )
+
+    pgpool = psycopg_pool.AsyncConnectionPool(
+        benchmark_args.conninfo, min_size=1, max_size=1, open=False
+    )
+    await pgpool.open()
+    await migrate(pgpool)
+    try:
+        model_text = await model_builder(benchmark_args.subgraph, pgpool)
+        model = AgoraModel(model_text)
+
+        logs_db = LogsDB(pgpool)
+        logged_queries = [
+            logged_query
+            async for logged_query in logs_db.iter_logged_queries(
+                benchmark_args.subgraph,
+                window=timedelta(seconds=benchmark_args.window)
+                if benchmark_args.window
+                else None,
+                limit=benchmark_args.limit,
+            )
+        ]
+    finally:
+        await pgpool.close()
+
+    stats = model.replay(logged_queries)
+
+    print(
+        f"Model:          {len(model.statements)} statements, "
+        f"{len(model_text.encode())} bytes"
+    )
+    print(f"Queries:        {stats.queries}")
+    print(f"Priced:         {stats.priced_share:.2%}")
+    print(f"Default priced: {stats.default_share:.2%} of the root fields")
+    if stats.costs:
+        print(
+            f"Price:          mean {statistics.mean(stats.costs):.4g}, "
+            f"median {statistics.median(stats.costs):.4g}, "
+            f"max {max(stats.costs):.4g}"
+        )
+    if stats.evaluation_seconds > 0:
+        print(
+            f"Throughput:     {stats.queries / stats.evaluation_seconds:.0f} queries/s"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,92 @@
+# Copyright 2023-, Semiotic AI, Inc.
+# SPDX-License-Identifier: Apache-2.0
+
+"""Compares rendering large Agora models with a template compiled per build and with
+the precompiled, streamed template.
+
+The per-build rendering is what `build_template` used to do: resolve the AutoAgora
+version, compile `AGORA_ENTRY_TEMPLATE` and render it into a single string, for
+every model.
+
+Usage:
+    poetry run python benchmarks/agora_model_template.py --entries 10000
+"""
+
+import argparse
+import time
+from importlib.metadata import version
+
+from jinja2 import Template
+
+from autoagora.config import init_config
+from autoagora.logs_db import LogsDB
+from autoagora.model_builder import agora_entry_template, build_template
+from autoagora.utils.constants import AGORA_ENTRY_TEMPLATE
+
+SUBGRAPH = "Qmadj8x9km1YEyKmRnJ6EkC2zpJZFCfTyTZpuqC3j6e1QH"
+
+
+def per_build_template(most_frequent_queries) -> str:
+    template = Template(AGORA_ENTRY_TEMPLATE)
+    return template.render(
+        aa_version=version("autoagora"),
+        most_frequent_queries=most_frequent_queries,
+        manual_entry=None,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--entries", type=int, default=10_000)
+    parser.add_argument("--models", type=int, default=20)
+    benchmark_args = parser.parse_args()
+
+    init_config(
+        [
+            "--indexer-agent-mgmt-endpoint",
+            "http://nowhere",
+            "--postgres-host",
+            "nowhere",
+            "--postgres-username",
+            "nowhere",
+            "--postgres-password",
+            "nowhere",
+            "--indexer-service-metrics-endpoint",
+            "http://nowhere",
+        ]
+    )
+
+    most_frequent_queries = [
+        LogsDB.QueryStats(
+            query=f"query {{ entity{i}(first: $_0) {{ id value }} }}",
+            count=1000 - i % 1000,
+            min_time=1,
+            max_time=100 + i,
+            avg_time=50.5 + i,
+            stddev_time=12.25,
+        )
+        for i in range(benchmark_args.entries)
+    ]
+
+    start = time.perf_counter()
+    for _ in range(benchmark_args.models):
+        per_build_model = per_build_template(most_frequent_queries)
+    per_build_duration = time.perf_counter() - start
+
+    agora_entry_template()  # Compiled once at startup
+    start = time.perf_counter()
+    for _ in range(benchmark_args.models):
+        precompiled_model = build_template(SUBGRAPH, most_frequent_queries)
+    precompiled_duration = time.perf_counter() - start
+
+    assert precompiled_model == per_build_model
+    print(
+        f"{benchmark_args.models} models of {benchmark_args.entries} entries "
+        f"({len(precompiled_model) / 1e6:.1f} MB each)"
+    )
+    print(f"Per-build template:   {per_build_duration:.3f}s")
+    print(f"Precompiled template: {precompiled_duration:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
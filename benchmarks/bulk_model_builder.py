@@ -0,0 +1,153 @@
+# Copyright 2023-, Semiotic AI, Inc.
+# SPDX-License-Identifier: Apache-2.0
+
+"""Compares the per-subgraph and bulk relative query costs model builds.
+
+Fills a scratch schema of the given PostgreSQL database with synthetic query logs,
+then times building the models of all the subgraphs with one `model_builder` call
+per subgraph (as the per-subgraph `model_update_loop`s do) and with a single
+`bulk_model_builder` call.
+
+Usage:
+    poetry run python benchmarks/bulk_model_builder.py \\
+        "host=localhost dbname=autoagora user=postgres password=postgres"
+"""
+
+import argparse
+import asyncio
+import time
+
+import psycopg_pool
+
+from autoagora.config import init_config
+from autoagora.model_builder import bulk_model_builder, model_builder
+from autoagora.schema_migrations import migrate
+
+SCHEMA = "autoagora_benchmark"
+
+
+async def populate(
+    pgpool: psycopg_pool.AsyncConnectionPool,
+    subgraphs: int,
+    skeletons: int,
+    logs: int,
+):
+    async with pgpool.connection() as connection:
+        await connection.execute(
+            """
+            CREATE TABLE query_skeletons (
+                hash BYTEA PRIMARY KEY,
+                query TEXT NOT NULL
+            )
+            """
+        )
+        await connection.execute(
+            """
+            CREATE TABLE query_logs (
+                id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+                query_hash BYTEA REFERENCES query_skeletons(hash),
+                subgraph CHAR(46) NOT NULL,
+                timestamp TIMESTAMPTZ NOT NULL,
+                query_time_ms INTEGER,
+                query_variables TEXT
+            )
+            """
+        )
+        await connection.execute(
+            """
+            INSERT INTO query_skeletons (hash, query)
+            SELECT
+                int4send(i),
+                'query { entity' || i || '(first: 10) { id value } }'
+            FROM generate_series(1, %(skeletons)s) AS i
+            """,
+            {"skeletons": skeletons},
+        )
+        # Zipf-like skeleton popularity, uniform subgraphs
+        await connection.execute(
+            """
+            INSERT INTO query_logs (query_hash, subgraph, timestamp, query_time_ms)
+            SELECT
+                int4send(
+                    least(ceil(1 / (random() + 1e-6))::int, %(skeletons)s)
+                ),
+                'Qm' || lpad((i %% %(subgraphs)s)::text, 44, '0'),
+                now() - random() * interval '30 days',
+                (random() * 1000)::int
+            FROM generate_series(1, %(logs)s) AS i
+            """,
+            {"skeletons": skeletons, "subgraphs": subgraphs, "logs": logs},
+        )
+        await connection.execute("ANALYZE")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("conninfo", help="libpq connection string.")
+    parser.add_argument("--subgraphs", type=int, default=200)
+    parser.add_argument("--skeletons", type=int, default=1000)
+    parser.add_argument("--logs", type=int, default=2_000_000)
+    benchmark_args = parser.parse_args()
+
+    init_config(
+        [
+            "--indexer-agent-mgmt-endpoint",
+            "http://nowhere",
+            "--postgres-host",
+            "nowhere",
+            "--postgres-username",
+            "nowhere",
+            "--postgres-password",
+            "nowhere",
+            "--indexer-service-metrics-endpoint",
+            "http://nowhere",
+        ]
+    )
+
+    async with psycopg_pool.AsyncConnectionPool(
+        benchmark_args.conninfo, min_size=1, max_size=1, open=False
+    ) as setup_pool:
+        async with setup_pool.connection() as connection:
+            await connection.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+            await connection.execute(f"CREATE SCHEMA {SCHEMA}")
+
+    pgpool = psycopg_pool.AsyncConnectionPool(
+        benchmark_args.conninfo,
+        min_size=1,
+        max_size=1,
+        open=False,
+        kwargs={"options": f"-c search_path={SCHEMA}"},
+    )
+    await pgpool.open()
+    try:
+        print("Populating the query logs...")
+        await populate(
+            pgpool,
+            benchmark_args.subgraphs,
+            benchmark_args.skeletons,
+            benchmark_args.logs,
+        )
+        await migrate(pgpool)
+        subgraphs = ["Qm" + str(i).zfill(44) for i in range(benchmark_args.subgraphs)]
+
+        start = time.perf_counter()
+        per_subgraph_models = {
+            subgraph: await model_builder(subgraph, pgpool) for subgraph in subgraphs
+        }
+        per_subgraph_duration = time.perf_counter() - start
+
+        start = time.perf_counter()
+        bulk_models = await bulk_model_builder(subgraphs, pgpool)
+        bulk_duration = time.perf_counter() - start
+
+        assert bulk_models == per_subgraph_models
+        print(f"Per-subgraph: {per_subgraph_duration:.3f}s")
+        print(f"Bulk:         {bulk_duration:.3f}s")
+    finally:
+        async with pgpool.connection() as connection:
+            await connection.execute(f"DROP SCHEMA {SCHEMA} CASCADE")
+        await pgpool.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
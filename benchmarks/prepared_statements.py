@@ -0,0 +1,151 @@
+# Copyright 2023-, Semiotic AI, Inc.
+# SPDX-License-Identifier: Apache-2.0
+
+"""Compares the per-call latency of the price save state queries with the values
+inlined as literals and with server-side parameters in prepared statements.
+
+The literal-inlined queries are what `PriceSaveStateDB` used to send: a new query
+text per subgraph and price, parsed and planned by PostgreSQL on every call. Runs in
+a scratch schema of the given PostgreSQL database.
+
+Usage:
+    poetry run python benchmarks/prepared_statements.py \\
+        "host=localhost dbname=autoagora user=postgres password=postgres"
+"""
+
+import argparse
+import asyncio
+import random
+import statistics
+import time
+from datetime import datetime, timezone
+from functools import partial
+from typing import Awaitable, Callable, List, Tuple
+
+import psycopg_pool
+from psycopg import sql
+
+from autoagora.price_save_state_db import PriceSaveStateDB
+from autoagora.schema_migrations import migrate
+
+SCHEMA = "autoagora_benchmark"
+
+
+async def literal_save_state(
+    pgpool: psycopg_pool.AsyncConnectionPool, subgraph: str, mean: float, stddev: float
+):
+    async with pgpool.connection() as connection:
+        await connection.execute(
+            sql.SQL(
+                """
+            INSERT INTO price_save_state (subgraph, last_update, mean, stddev)
+                VALUES({subgraph_hash}, {datetime}, {mean}, {stddev})
+            ON CONFLICT (subgraph)
+                DO
+                UPDATE SET
+                    last_update = {datetime},
+                    mean        = {mean},
+                    stddev      = {stddev}
+            """
+            ).format(
+                subgraph_hash=subgraph,
+                datetime=str(datetime.now(timezone.utc)),
+                mean=mean,
+                stddev=stddev,
+            )
+        )
+
+
+async def literal_load_state(pgpool: psycopg_pool.AsyncConnectionPool, subgraph: str):
+    async with pgpool.connection() as connection:
+        cursor = await connection.execute(
+            sql.SQL(
+                """
+            SELECT
+                last_update,
+                mean,
+                stddev
+            FROM
+                price_save_state
+            WHERE
+                subgraph = {subgraph_hash}
+            """
+            ).format(subgraph_hash=subgraph)
+        )
+        await cursor.fetchone()
+
+
+async def time_calls(
+    call: Callable[..., Awaitable], calls_args: List[Tuple]
+) -> List[float]:
+    durations = []
+    for args in calls_args:
+        start = time.perf_counter()
+        await call(*args)
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def report(name: str, durations: List[float]):
+    durations = sorted(durations)
+    p99 = durations[min(len(durations) - 1, int(len(durations) * 0.99))]
+    print(
+        f"{name:<24} median {statistics.median(durations) * 1e6:8.1f}µs, "
+        f"p99 {p99 * 1e6:8.1f}µs"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("conninfo", help="libpq connection string.")
+    parser.add_argument("--subgraphs", type=int, default=200)
+    parser.add_argument("--calls", type=int, default=5000)
+    benchmark_args = parser.parse_args()
+
+    async with psycopg_pool.AsyncConnectionPool(
+        benchmark_args.conninfo, min_size=1, max_size=1, open=False
+    ) as setup_pool:
+        async with setup_pool.connection() as connection:
+            await connection.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+            await connection.execute(f"CREATE SCHEMA {SCHEMA}")
+
+    pgpool = psycopg_pool.AsyncConnectionPool(
+        benchmark_args.conninfo,
+        min_size=1,
+        max_size=1,
+        open=False,
+        kwargs={"options": f"-c search_path={SCHEMA}"},
+    )
+    await pgpool.open()
+    await migrate(pgpool)
+    try:
+        pssdb = PriceSaveStateDB(pgpool)
+        random.seed(42)
+        subgraphs = ["Qm" + str(i).zfill(44) for i in range(benchmark_args.subgraphs)]
+        for subgraph in subgraphs:
+            await pssdb.save_state(subgraph, random.random(), random.random())
+
+        states = [
+            (random.choice(subgraphs), random.random() * 1e-8, random.random())
+            for _ in range(benchmark_args.calls)
+        ]
+
+        load_states = [(subgraph,) for subgraph, _, _ in states]
+        report(
+            "Literal save_state",
+            await time_calls(partial(literal_save_state, pgpool), states),
+        )
+        report("Prepared save_state", await time_calls(pssdb.save_state, states))
+        report(
+            "Literal load_state",
+            await time_calls(partial(literal_load_state, pgpool), load_states),
+        )
+        report("Prepared load_state", await time_calls(pssdb.load_state, load_states))
+    finally:
+        async with pgpool.connection() as connection:
+            await connection.execute(f"DROP SCHEMA {SCHEMA} CASCADE")
+        await pgpool.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,104 @@
+# Copyright 2023-, Semiotic AI, Inc.
+# SPDX-License-Identifier: Apache-2.0
+
+"""Measures the query logs ingestion throughput.
+
+Writes a file of synthetic indexer-service query logs, then times its ingestion into
+a scratch schema of the given PostgreSQL database. The queries are drawn from a set
+of distinct query texts, with random variables, as GraphQL clients usually send.
+
+Usage:
+    poetry run python benchmarks/query_logs_ingestion.py \\
+        "host=localhost dbname=autoagora user=postgres password=postgres"
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import tempfile
+import time
+
+import psycopg_pool
+
+from autoagora.query_logs_ingestion import QueryLogsIngestor, read_lines
+from autoagora.schema_migrations import migrate
+
+SCHEMA = "autoagora_benchmark"
+
+
+def write_logs(file, logs: int, queries: int, subgraphs: int):
+    random.seed(42)
+    query_texts = [
+        f"query q{i}($skip: Int) {{ entity{i % 50}(first: {i}, skip: $skip) "
+        f'{{ id value owner(where: {{name: "n{i}"}}) {{ id }} }} }}'
+        for i in range(queries)
+    ]
+    now_ms = int(time.time() * 1000)
+    for i in range(logs):
+        log = {
+            "level": 30,
+            "time": now_ms - random.randrange(86_400_000),
+            "subgraphDeployment": "Qm" + str(i % subgraphs).zfill(44),
+            "query": random.choice(query_texts),
+            "variables": json.dumps({"skip": random.randrange(1000)}),
+            "responseTime": random.randrange(1, 1000),
+            "msg": "Done executing paid query",
+        }
+        file.write(json.dumps(log).encode() + b"\n")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("conninfo", help="libpq connection string.")
+    parser.add_argument("--logs", type=int, default=500_000)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--subgraphs", type=int, default=50)
+    parser.add_argument("--batch-size", type=int, default=10_000)
+    benchmark_args = parser.parse_args()
+
+    async with psycopg_pool.AsyncConnectionPool(
+        benchmark_args.conninfo, min_size=1, max_size=1, open=False
+    ) as setup_pool:
+        async with setup_pool.connection() as connection:
+            await connection.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+            await connection.execute(f"CREATE SCHEMA {SCHEMA}")
+
+    pgpool = psycopg_pool.AsyncConnectionPool(
+        benchmark_args.conninfo,
+        min_size=1,
+        max_size=1,
+        open=False,
+        kwargs={"options": f"-c search_path={SCHEMA}"},
+    )
+    await pgpool.open()
+    await migrate(pgpool)
+    try:
+        with tempfile.TemporaryFile() as file:
+            print("Writing the query logs...")
+            write_logs(
+                file,
+                benchmark_args.logs,
+                benchmark_args.queries,
+                benchmark_args.subgraphs,
+            )
+            file.seek(0)
+
+            ingestor = QueryLogsIngestor(pgpool, benchmark_args.batch_size)
+            start = time.perf_counter()
+            written = await ingestor.ingest(read_lines(file))
+            duration = time.perf_counter() - start
+
+        assert written == benchmark_args.logs
+        print(
+            f"Ingested {written} query logs in {duration:.3f}s "
+            f"({written / duration:,.0f} rows/s)"
+        )
+    finally:
+        async with pgpool.connection() as connection:
+            await connection.execute(f"DROP SCHEMA {SCHEMA} CASCADE")
+        await pgpool.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
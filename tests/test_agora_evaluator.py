@@ -0,0 +1,137 @@
+import pytest
+
+from autoagora.agora_evaluator import AgoraModel, compile_expression
+from autoagora.config import init_config
+from autoagora.logs_db import LogsDB
+from autoagora.model_builder import build_template
+
+TEST_MODEL = """\
+# Manual entries
+query { values(first: $first) { id } } when $first > 100 => $first * 0.5;
+query { values { id } } => 10;
+query { info(where: { kind: "large" }) { id } } => 30 * $GLOBAL_COST_MULTIPLIER;
+query { info { id text } } => 20 * $GLOBAL_COST_MULTIPLIER;
+
+default => $DEFAULT_COST * $GLOBAL_COST_MULTIPLIER;
+"""
+
+
+class TestAgoraEvaluator:
+    @pytest.mark.parametrize(
+        "expression,expected",
+        [
+            ("1 + 2 * 3", 7),
+            ("(1 + 2) * 3", 9),
+            ("-$a / 4", -0.5),
+            ("$a >= 2 && !($a == 3) || false", True),
+            ("1.5e1 - .5", 14.5),
+        ],
+    )
+    def test_compile_expression(self, expression, expected):
+        assert compile_expression(expression)({"a": 2}) == expected
+
+    @pytest.mark.parametrize("expression", ["1 +", "(1 + 2", "1 % 2", "$"])
+    def test_compile_expression_invalid(self, expression):
+        with pytest.raises(ValueError):
+            compile_expression(expression)
+
+    @pytest.mark.parametrize(
+        "query,variables,expected_cost",
+        [
+            # Capture and condition
+            ("{ values(first: 200) { id name } }", None, 100),
+            ("query($n: Int) { values(first: $n) { id } }", {"n": 500}, 250),
+            # Condition not met, next statement
+            ("{ values(first: 10) { id } }", None, 10),
+            # Missing sub-selection, default statement
+            ("{ values { name } }", None, 100),
+            # Input object subset
+            ('{ info(where: { kind: "large", id: 1 }) { id } }', None, 60),
+            ('{ info(where: { kind: "small" }) { id text } }', None, 40),
+            # Fragments are inlined
+            (
+                "{ info { ... on Info { id } ...text } } fragment text on Info { text }",
+                None,
+                40,
+            ),
+            # Root fields are priced separately
+            ("{ values { id } info { id text } }", None, 50),
+        ],
+    )
+    def test_cost(self, query, variables, expected_cost):
+        model = AgoraModel(
+            TEST_MODEL, {"DEFAULT_COST": 50, "GLOBAL_COST_MULTIPLIER": 2}
+        )
+        assert model.cost(query, variables) == pytest.approx(expected_cost)
+
+    def test_cost_unmatched(self):
+        model = AgoraModel("query { values { id } } => 10;")
+        assert model.cost("{ values { id } }") == 10
+        assert model.cost("{ info { id } }") is None
+
+    def test_replay(self):
+        model = AgoraModel(
+            TEST_MODEL, {"DEFAULT_COST": 50, "GLOBAL_COST_MULTIPLIER": 1}
+        )
+        stats = model.replay(
+            [
+                ("{ values { id } }", None),
+                ("query($n: Int) { values(first: $n) { id } }", {"n": 400}),
+                ("{ other { id } }", None),
+                ("{ values { id } info { id text } }", None),
+                ("not a query", None),
+            ]
+        )
+
+        assert stats.queries == 5
+        assert stats.unpriced == 1
+        assert stats.costs == [10, 200, 50, 30]
+        assert stats.root_fields == 5
+        assert stats.default_root_fields == 1
+        assert stats.statement_matches == {1: 2, 0: 1, 4: 1, 3: 1}
+        assert stats.priced_share == pytest.approx(0.8)
+        assert stats.default_share == pytest.approx(0.2)
+        assert stats.evaluation_seconds > 0
+
+    def test_generated_model(self):
+        init_config(
+            [
+                "--indexer-agent-mgmt-endpoint",
+                "http://nowhere",
+                "--postgres-host",
+                "nowhere",
+                "--postgres-username",
+                "nowhere",
+                "--postgres-password",
+                "nowhere",
+                "--indexer-service-metrics-endpoint",
+                "http://nowhere",
+            ]
+        )
+        ldb = LogsDB(None)  # type: ignore
+        most_frequent_queries = [
+            LogsDB.QueryStats(
+                query=ldb.return_query_body(query),
+                count=100,
+                min_time=1,
+                max_time=60,
+                avg_time=avg_time,
+                stddev_time=0.5,
+            )
+            for query, avg_time in [
+                ("query($_0: Int) { values(first: $_0) { id } }", 1.5),
+                ("query { info { text id } }", 4.0),
+            ]
+        ]
+        model = AgoraModel(
+            build_template(
+                "Qmadj8x9km1YEyKmRnJ6EkC2zpJZFCfTyTZpuqC3j6e1QH", most_frequent_queries
+            )
+        )
+
+        # Skeleton variables are captures matching any value
+        assert model.cost(
+            "query($first: Int) { values(first: $first) { id } }", {"first": 3}
+        ) == pytest.approx(1.5)
+        assert model.cost("{ info { id text } }") == pytest.approx(4.0)
+        assert model.cost("{ other { id } }") == pytest.approx(50)
@@ -1,3 +1,5 @@
+import pytest
+
 from autoagora.config import args, init_config
 
 
@@ -26,3 +28,24 @@ class TestInitConfig:
         assert args.postgres_host == "nowhere"
         assert args.postgres_username == "nowhere"
         assert args.postgres_password == "nowhere"
+
+    def test_quantiles_require_rollup(self):
+        argv = [
+            "--indexer-agent-mgmt-endpoint",
+            "http://nowhere",
+            "--postgres-host",
+            "nowhere",
+            "--postgres-username",
+            "nowhere",
+            "--postgres-password",
+            "nowhere",
+            "--indexer-service-metrics-endpoint",
+            "http://indexer-service.default.svc.cluster.local:7300/metrics",
+            "--relative-query-costs-quantiles",
+            "0.5,0.9",
+        ]
+        with pytest.raises(SystemExit):
+            init_config(argv)
+
+        init_config(argv + ["--relative-query-costs-rollup"])
+        assert args.relative_query_costs_quantiles == "0.5,0.9"
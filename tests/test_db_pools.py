@@ -0,0 +1,110 @@
+import asyncio as aio
+
+import psycopg_pool
+import pytest
+from prometheus_client import REGISTRY
+
+from autoagora.config import init_config
+from autoagora.db_pools import open_pools
+
+
+class TestDBPools:
+    @pytest.fixture
+    async def pools(self, postgresql):
+        init_config(
+            [
+                "--indexer-agent-mgmt-endpoint",
+                "http://nowhere",
+                "--postgres-host",
+                postgresql.info.host,
+                "--postgres-username",
+                postgresql.info.user,
+                "--postgres-password",
+                postgresql.info.password,
+                "--indexer-service-metrics-endpoint",
+                "http://nowhere",
+                "--postgres-analytics-max-connections",
+                "2",
+            ]
+        )
+        conn_string = (
+            f"host={postgresql.info.host} "
+            f"dbname={postgresql.info.dbname} "
+            f"user={postgresql.info.user} "
+            f'password="{postgresql.info.password}" '
+            f"port={postgresql.info.port}"
+        )
+        pools_ = await open_pools(conn_string)
+        yield pools_
+        for pool in pools_.values():
+            await pool.close()
+
+    async def test_open_pools(self, pools):
+        assert pools["oltp"].max_size == 1
+        assert pools["analytics"].max_size == 2
+        assert pools["maintenance"].max_size == 2
+
+    async def test_pools_isolation(self, pools):
+        analytics_started = aio.Event()
+
+        async def long_aggregation():
+            async with pools["analytics"].connection() as connection:
+                analytics_started.set()
+                await connection.execute("SELECT pg_sleep(1)")
+
+        aggregation = aio.ensure_future(long_aggregation())
+        await analytics_started.wait()
+
+        # The save states do not wait for the model builds
+        async with pools["oltp"].connection(timeout=0.5) as connection:
+            await connection.execute("SELECT 1")
+
+        await aggregation
+
+    async def test_pool_metrics(self, pools):
+        def sample(name, pool):
+            return REGISTRY.get_sample_value(name, {"pool": pool}) or 0
+
+        waits_before = sample("postgres_pool_wait_seconds_count", "oltp")
+        checkouts_before = sample("postgres_pool_checkout_seconds_count", "oltp")
+        checkout_time_before = sample("postgres_pool_checkout_seconds_sum", "oltp")
+
+        async with pools["oltp"].connection() as connection:
+            assert sample("postgres_pool_saturation", "oltp") == 1
+            await connection.execute("SELECT pg_sleep(0.1)")
+
+        assert sample("postgres_pool_wait_seconds_count", "oltp") == waits_before + 1
+        assert (
+            sample("postgres_pool_checkout_seconds_count", "oltp")
+            == checkouts_before + 1
+        )
+        assert (
+            sample("postgres_pool_checkout_seconds_sum", "oltp")
+            >= checkout_time_before + 0.1
+        )
+        assert sample("postgres_pool_saturation", "oltp") == 0
+        assert sample("postgres_pool_size", "oltp") == 1
+
+    async def test_pool_wait_timeout(self, pools):
+        waits_before = (
+            REGISTRY.get_sample_value(
+                "postgres_pool_wait_seconds_count", {"pool": "oltp"}
+            )
+            or 0
+        )
+        async with pools["oltp"].connection():
+            with pytest.raises(psycopg_pool.PoolTimeout):
+                async with pools["oltp"].connection(timeout=0.1):
+                    pass
+            assert (
+                REGISTRY.get_sample_value(
+                    "postgres_pool_requests_waiting", {"pool": "oltp"}
+                )
+                == 0
+            )
+        assert (
+            REGISTRY.get_sample_value(
+                "postgres_pool_wait_seconds_count", {"pool": "oltp"}
+            )
+            == waits_before + 2
+        )
@@ -0,0 +1,73 @@
+import graphql
+import pytest
+
+from autoagora.graphql_printer import (
+    print_canonical_operation,
+    print_canonical_query_body,
+)
+
+
+def canonical(query: str) -> str:
+    return print_canonical_query_body(
+        graphql.parse(query).definitions[0].selection_set  # type: ignore
+    )
+
+
+class TestGraphQLPrinter:
+    def test_minified(self):
+        assert (
+            canonical(
+                """
+                query {
+                    values(first: 10, where: { id_gt: $_0 }) {
+                        id
+                        owner { name }
+                    }
+                }
+                """
+            )
+            == "query{values(first:10 where:{id_gt:$_0}){id owner{name}}}"
+        )
+
+    def test_canonical_ordering(self):
+        assert canonical("{ b(y: 1, x: { q: 2, p: 1 }) { z a } a }") == canonical(
+            "{ a b(x: { p: 1, q: 2 }, y: 1) { a z } }"
+        )
+        assert canonical("{ b(y: 1, x: 2) { z a } a }") == "query{a b(x:2 y:1){a z}}"
+
+    @pytest.mark.parametrize(
+        "query,expected",
+        [
+            ("{ values(in: [1, -1, 2.5]) { id } }", "query{values(in:[1 -1 2.5]){id}}"),
+            (
+                '{ values(name: "a \\"b\\"", flag: true, none: null, order: asc) '
+                "{ id } }",
+                'query{values(flag:true name:"a \\"b\\"" none:null order:asc){id}}',
+            ),
+            ('{ values(text: """block""") { id } }', 'query{values(text:"block"){id}}'),
+            ("{ first: values(id: $_0) { id } }", "query{first:values(id:$_0){id}}"),
+            (
+                "{ values { id ... on Value @include(if: $_0) { name } } }",
+                "query{values{...on Value@include(if:$_0){name}id}}",
+            ),
+        ],
+    )
+    def test_values_and_selections(self, query, expected):
+        printed = canonical(query)
+        assert printed == expected
+        # Still valid GraphQL, and a fixed point
+        assert canonical(printed) == printed
+
+    def test_operation(self):
+        operation = graphql.parse(
+            """
+            query getValues($where: Value_filter @a, $first: [Int!]! = [10]) @b {
+                values(first: $first, where: $where) { id }
+            }
+            """
+        ).definitions[0]
+        assert (
+            print_canonical_operation(operation)  # type: ignore
+            == "query getValues($first:[Int!]!=[10]$where:Value_filter@a)@b"
+            "{values(first:$first where:$where){id}}"
+        )
@@ -1,4 +1,12 @@
-from autoagora.indexer_utils import hex_to_ipfs_hash, ipfs_hash_to_hex
+from unittest import mock
+
+from prometheus_client import REGISTRY
+
+from autoagora.indexer_utils import (
+    get_cost_variables,
+    hex_to_ipfs_hash,
+    ipfs_hash_to_hex,
+)
 
 
 class TestHexIpfs:
@@ -13,3 +21,25 @@ class TestHexIpfs:
         assert (
             hex == "0xbbde25a2c85f55b53b7698b9476610c3d1202d88870e66502ab0076b7218f98a"
         )
+
+
+class TestIndexerAgentRequests:
+    async def test_request_histogram(self):
+        def request_count():
+            return (
+                REGISTRY.get_sample_value(
+                    "indexer_agent_request_seconds_count",
+                    {"operation": "get_cost_variables"},
+                )
+                or 0
+            )
+
+        count = request_count()
+        with mock.patch(
+            "autoagora.indexer_utils.query_indexer_agent",
+            return_value={"costModel": {"variables": '{"GLOBAL_COST_MULTIPLIER": 1}'}},
+        ):
+            assert await get_cost_variables(
+                "Qmaz1R8vcv9v3gUfksqiS9JUz7K9G8S5By3JYn8kTiiP5K"
+            ) == {"GLOBAL_COST_MULTIPLIER": 1}
+        assert request_count() == count + 1
@@ -1,10 +1,123 @@
+import asyncio as aio
+import copy
+import json
+from contextlib import asynccontextmanager
 from unittest import mock
 
-from easydict import EasyDict
+import pytest
+from aiohttp import web
+from kubernetes import client
 
-from autoagora.k8s_service_watcher import K8SServiceEndpointsWatcher, aio
+from autoagora.k8s_service_watcher import (
+    K8SServiceEndpointSlicesWatcher,
+    K8SServiceEndpointsWatcher,
+)
 from tests.utils.constants import K8S_EVENT
 
+ENDPOINTS = K8S_EVENT["raw_object"]
+
+
+def endpoints(resource_version, ips):
+    obj = copy.deepcopy(ENDPOINTS)
+    obj["metadata"]["resourceVersion"] = resource_version
+    obj["subsets"][0]["addresses"] = [
+        address for address in obj["subsets"][0]["addresses"] if address["ip"] in ips
+    ]
+    return obj
+
+
+def endpoint_slice(
+    name, resource_version, ready_ips, not_ready_ips=(), address_type="IPv4"
+):
+    return {
+        "kind": "EndpointSlice",
+        "apiVersion": "discovery.k8s.io/v1",
+        "metadata": {
+            "name": name,
+            "namespace": "namespace",
+            "resourceVersion": resource_version,
+            "labels": {"kubernetes.io/service-name": "indexer-service"},
+        },
+        "addressType": address_type,
+        "endpoints": [
+            {"addresses": [ip], "conditions": {"ready": True}} for ip in ready_ips
+        ]
+        + [{"addresses": [ip], "conditions": {"ready": False}} for ip in not_ready_ips],
+        "ports": [{"name": "metrics", "port": 7300, "protocol": "TCP"}],
+    }
+
+
+class FakeAPIServer:
+    """Kubernetes API server serving the lists of `list_results`, and the watches of
+    `watch_results`: lists of watch events (or raw lines), or HTTP statuses."""
+
+    def __init__(self, selector) -> None:
+        self.selector = selector
+        self.list_results = aio.Queue()
+        self.watch_results = aio.Queue()
+        self.requests = []
+
+    async def handler(self, request: web.Request):
+        assert request.match_info["namespace"] == "namespace"
+        assert request.headers["Authorization"] == "Bearer token"
+        assert {key: request.query[key] for key in self.selector} == self.selector
+        self.requests.append(dict(request.query))
+
+        if "watch" not in request.query:
+            return web.json_response(await self.list_results.get())
+
+        result = await self.watch_results.get()
+        if isinstance(result, int):
+            return web.Response(status=result)
+        response = web.StreamResponse()
+        await response.prepare(request)
+        for event in result:
+            line = event if isinstance(event, bytes) else json.dumps(event).encode()
+            await response.write(line + b"\n")
+        return response
+
+
+async def wait_for(condition, timeout=5):
+    async def poll():
+        while not condition():
+            await aio.sleep(0.01)
+
+    await aio.wait_for(poll(), timeout)
+
+
+@asynccontextmanager
+async def serve(server, path):
+    """Serves `server` on `path`, and returns the API configuration to reach it."""
+    app = web.Application()
+    app.router.add_get(path, server.handler)
+    # The pending watches are cancelled as the watcher disconnects
+    runner = web.AppRunner(app, handler_cancellation=True)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    try:
+        yield client.Configuration(
+            host=f"http://127.0.0.1:{port}",
+            api_key={"authorization": "token"},
+            api_key_prefix={"authorization": "Bearer"},
+        )
+    finally:
+        await runner.cleanup()
+
+
+def start_watcher(watcher_class, api_configuration):
+    """Returns a watcher of the "indexer-service" service, and its watch loop."""
+    with mock.patch("builtins.open") as mock_open:
+        mock_open.return_value.__enter__.return_value.read.return_value = "namespace"
+        with mock.patch.object(watcher_class, "_watch_loop"):
+            watcher = watcher_class("indexer-service", api_configuration)
+    # Not wrapped in `async_exit_on_exception`, to be cancelled
+    watch_loop = aio.ensure_future(
+        watcher_class._watch_loop.__wrapped__(watcher)  # type: ignore
+    )
+    return watcher, watch_loop
+
 
 class TestK8SServiceEndpointsWatcher:
     def test_k8s_service_creation(self):
@@ -27,40 +140,214 @@ class TestK8SServiceEndpointsWatcher:
                     assert k8ssew._service_name == "mock_service_name"
                     assert k8ssew._namespace == "namespace"
 
-    async def test_watch(self):
+    @pytest.fixture
+    async def api_server(self):
+        server = FakeAPIServer({"fieldSelector": "metadata.name=indexer-service"})
+        async with serve(server, "/api/v1/namespaces/{namespace}/endpoints") as (
+            api_configuration
+        ):
+            yield server, api_configuration
 
-        loop = aio.new_event_loop()
-        aio.set_event_loop(loop)
-        event_mock = mock.MagicMock()
-        event_mock.__getitem__.return_value = EasyDict(K8S_EVENT["object"])
-        event_stream_mock = mock.MagicMock()
-        event_stream_mock.__next__.return_value = event_mock
-        w = mock.MagicMock()
-        w.stream.return_value = event_stream_mock
+    async def test_watch(self, api_server):
+        server, api_configuration = api_server
+        watcher, watch_loop = start_watcher(
+            K8SServiceEndpointsWatcher, api_configuration
+        )
+        try:
+            await server.list_results.put(
+                {
+                    "metadata": {"resourceVersion": "100"},
+                    "items": [endpoints("100", ["192.168.42.78", "192.168.95.50"])],
+                }
+            )
+            await wait_for(lambda: len(server.requests) == 2)
+            assert watcher.endpoint_ips == ["192.168.42.78", "192.168.95.50"]
+            assert server.requests[1]["resourceVersion"] == "100"
+            assert server.requests[1]["allowWatchBookmarks"] == "true"
 
-        with mock.patch("builtins.open") as mock_open:
-            with mock.patch(
-                "autoagora.k8s_service_watcher.K8SServiceEndpointsWatcher._watch_loop"
-            ) as mock_watch_loop:  # pyright: ignore[reportUnusedVariable]
-                with mock.patch(
-                    "autoagora.k8s_service_watcher.config.load_incluster_config"
-                ) as mock_load_incluster_config:  # pyright: ignore[reportUnusedVariable]
-                    with mock.patch(
-                        "autoagora.k8s_service_watcher.watch.Watch",
-                        return_value=w,
-                    ) as mock_Watch_stream:  # pyright: ignore[reportUnusedVariable]
-                        mock_open.return_value.__enter__.return_value.read.return_value = (
-                            "namespace"
-                        )
-
-                        service_name = "my-service"
-                        watcher = K8SServiceEndpointsWatcher(service_name)
-
-                        task = aio.create_task(watcher._watch())
-                        await aio.sleep(0.001)
-                        task.cancel()
-                        assert watcher.endpoint_ips == [
-                            "192.168.42.78",
-                            "192.168.95.50",
-                        ]
-                        aio.set_event_loop(None)
+            # Resumed from the bookmark, without listing again
+            await server.watch_results.put(
+                [
+                    {
+                        "type": "MODIFIED",
+                        "object": endpoints("101", ["192.168.95.50"]),
+                    },
+                    {
+                        "type": "BOOKMARK",
+                        "object": {
+                            "kind": "Endpoints",
+                            "metadata": {"resourceVersion": "105"},
+                        },
+                    },
+                ]
+            )
+            await wait_for(lambda: len(server.requests) == 3)
+            assert watcher.endpoint_ips == ["192.168.95.50"]
+            assert "watch" in server.requests[2]
+            assert server.requests[2]["resourceVersion"] == "105"
+
+            # Listed again once the resource version is gone
+            await server.watch_results.put(
+                [
+                    {
+                        "type": "ERROR",
+                        "object": {"kind": "Status", "code": 410},
+                    }
+                ]
+            )
+            await server.list_results.put(
+                {"metadata": {"resourceVersion": "200"}, "items": []}
+            )
+            await wait_for(lambda: len(server.requests) == 5)
+            assert "watch" not in server.requests[3]
+            assert watcher.endpoint_ips == []
+            assert server.requests[4]["resourceVersion"] == "200"
+
+            await server.watch_results.put(
+                [{"type": "ADDED", "object": endpoints("201", ["192.168.42.78"])}]
+            )
+            await wait_for(lambda: watcher.endpoint_ips == ["192.168.42.78"])
+            await server.watch_results.put(
+                [{"type": "DELETED", "object": endpoints("202", [])}]
+            )
+            await wait_for(lambda: watcher.endpoint_ips == [])
+            await server.watch_results.put(410)
+            await server.list_results.put(
+                {
+                    "metadata": {"resourceVersion": "300"},
+                    "items": [endpoints("300", ["192.168.42.78"])],
+                }
+            )
+            await wait_for(lambda: watcher.endpoint_ips == ["192.168.42.78"])
+
+            # Listed again after an invalid or oversized event
+            oversized_event = {
+                "type": "BOOKMARK",
+                "object": {
+                    "metadata": {"resourceVersion": "301"},
+                    "padding": "x" * watcher.max_event_size,
+                },
+            }
+            for invalid_event in (b"{not json", json.dumps(oversized_event).encode()):
+                requests = len(server.requests)
+                await server.watch_results.put([invalid_event])
+                await server.list_results.put(
+                    {"metadata": {"resourceVersion": "400"}, "items": []}
+                )
+                await wait_for(lambda: len(server.requests) == requests + 2)
+                assert "watch" not in server.requests[requests]
+                assert watcher.endpoint_ips == []
+                await server.list_results.put(
+                    {
+                        "metadata": {"resourceVersion": "300"},
+                        "items": [endpoints("300", ["192.168.42.78"])],
+                    }
+                )
+                await server.watch_results.put(410)
+                await wait_for(lambda: watcher.endpoint_ips == ["192.168.42.78"])
+            assert not watch_loop.done()
+        finally:
+            watch_loop.cancel()
+
+
+class TestK8SServiceEndpointSlicesWatcher:
+    @pytest.fixture
+    async def api_server(self):
+        server = FakeAPIServer(
+            {"labelSelector": "kubernetes.io/service-name=indexer-service"}
+        )
+        async with serve(
+            server, "/apis/discovery.k8s.io/v1/namespaces/{namespace}/endpointslices"
+        ) as api_configuration:
+            yield server, api_configuration
+
+    async def test_watch(self, api_server):
+        server, api_configuration = api_server
+        watcher, watch_loop = start_watcher(
+            K8SServiceEndpointSlicesWatcher, api_configuration
+        )
+        try:
+            await server.list_results.put(
+                {
+                    "metadata": {"resourceVersion": "100"},
+                    "items": [
+                        endpoint_slice("a", "98", ("10.0.0.1",), ("10.0.0.2",)),
+                        # Same pods, dual-stack
+                        endpoint_slice(
+                            "a-v6", "99", ("fd00::1",), ("fd00::2",), "IPv6"
+                        ),
+                    ],
+                }
+            )
+            await wait_for(lambda: len(server.requests) == 2)
+            # Ready addresses only
+            assert watcher.endpoint_ips == ["10.0.0.1"]
+
+            await server.watch_results.put(
+                [
+                    {
+                        "type": "ADDED",
+                        "object": endpoint_slice("b", "101", ("10.0.1.1",)),
+                    },
+                    {
+                        "type": "MODIFIED",
+                        "object": endpoint_slice("a", "102", ("10.0.0.1", "10.0.0.2")),
+                    },
+                    {
+                        "type": "MODIFIED",
+                        "object": endpoint_slice(
+                            "a-v6", "103", ("fd00::1", "fd00::2"), address_type="IPv6"
+                        ),
+                    },
+                ]
+            )
+            await wait_for(lambda: len(server.requests) == 3)
+            assert watcher.endpoint_ips == ["10.0.0.1", "10.0.0.2", "10.0.1.1"]
+            assert server.requests[2]["resourceVersion"] == "103"
+
+            # Not updated when the slice's ready addresses did not change
+            endpoint_ips = watcher.endpoint_ips
+            await server.watch_results.put(
+                [
+                    {
+                        "type": "MODIFIED",
+                        "object": endpoint_slice(
+                            "b", "104", ("10.0.1.1",), ("10.0.1.2",)
+                        ),
+                    },
+                ]
+            )
+            await wait_for(lambda: len(server.requests) == 4)
+            assert watcher.endpoint_ips is endpoint_ips
+
+            await server.watch_results.put(
+                [{"type": "DELETED", "object": endpoint_slice("a", "105", ())}]
+            )
+            await wait_for(lambda: watcher.endpoint_ips == ["10.0.1.1"])
+
+            # Listed again once the resource version is gone
+            await server.watch_results.put(410)
+            await server.list_results.put(
+                {
+                    "metadata": {"resourceVersion": "200"},
+                    "items": [endpoint_slice("c", "199", ("10.0.2.1",))],
+                }
+            )
+            await wait_for(lambda: watcher.endpoint_ips == ["10.0.2.1"])
+
+            # IPv6 single-stack service
+            await server.watch_results.put(
+                [
+                    {"type": "DELETED", "object": endpoint_slice("c", "201", ())},
+                    {
+                        "type": "ADDED",
+                        "object": endpoint_slice(
+                            "c-v6", "202", ("fd00::3",), address_type="IPv6"
+                        ),
+                    },
+                ]
+            )
+            await wait_for(lambda: watcher.endpoint_ips == ["fd00::3"])
+            assert not watch_loop.done()
+        finally:
+            watch_loop.cancel()
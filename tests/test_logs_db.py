@@ -1,10 +1,21 @@
+import asyncio as aio
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+import graphql
 import psycopg_pool
 import pytest
 
 from autoagora.logs_db import LogsDB
+from autoagora.schema_migrations import migrate
 
 
 class TestLogsDB:
+    @pytest.fixture(autouse=True)
+    def clear_query_bodies_cache(self):
+        # The query bodies cache is shared by all the LogsDB instances
+        LogsDB.clear_query_bodies_cache()
+
     @pytest.fixture
     async def pgpool(self, postgresql):
         conn_string = (
@@ -56,6 +67,7 @@ class TestLogsDB:
                 ('hash1', 'QmTJBvvpknMow6n4YU8R9Swna6N8mHK8N2WufetysBiyuL', '2023-05-18T21:47:41+00:00', 10)
             """
             )
+        await migrate(pool)
         yield pool
         await pool.close()
 
@@ -65,7 +77,7 @@ class TestLogsDB:
             "QmPnu3R7Fm4RmBF21aCYUohDmWbKd3VMXo64ACiRtwUQrn", 2
         )
         assert mfq
-        query = "query {\n  values {\n    id\n  }\n}"
+        query = "query{values{id}}"
         compare = LogsDB.QueryStats(
             query=query,
             count=2,
@@ -88,3 +100,472 @@ class TestLogsDB:
         )
         # empty array will be returned since min is default to 100
         assert mfq == []
+
+    async def test_get_most_frequent_queries_from_rollup(self, pgpool):
+        ldb = LogsDB(pgpool)
+        await ldb.update_query_stats_rollup(lag=timedelta(0))
+        mfq_rollup = await ldb.get_most_frequent_queries(
+            "QmPnu3R7Fm4RmBF21aCYUohDmWbKd3VMXo64ACiRtwUQrn", 2, from_rollup=True
+        )
+        mfq = await ldb.get_most_frequent_queries(
+            "QmPnu3R7Fm4RmBF21aCYUohDmWbKd3VMXo64ACiRtwUQrn", 2
+        )
+        assert len(mfq_rollup) == len(mfq) == 1
+        assert mfq_rollup[0].query == mfq[0].query
+        assert mfq_rollup[0].count == mfq[0].count
+        assert mfq_rollup[0].min_time == mfq[0].min_time
+        assert mfq_rollup[0].max_time == mfq[0].max_time
+        assert mfq_rollup[0].avg_time == pytest.approx(mfq[0].avg_time)
+        assert mfq_rollup[0].stddev_time == pytest.approx(mfq[0].stddev_time)
+
+    async def test_update_query_stats_rollup_incremental(self, pgpool):
+        subgraph = "QmTJBvvpknMow6n4YU8R9Swna6N8mHK8N2WufetysBiyuL"
+        ldb = LogsDB(pgpool)
+        await ldb.update_query_stats_rollup(lag=timedelta(0))
+        # No new logs, nothing should be counted twice
+        await ldb.update_query_stats_rollup(lag=timedelta(0))
+        mfq = await ldb.get_most_frequent_queries(subgraph, 1, from_rollup=True)
+        assert sorted((q.count, q.min_time, q.max_time) for q in mfq) == [
+            (1, 10, 10),
+            (1, 50, 50),
+        ]
+
+        async with pgpool.connection() as conn:
+            await conn.execute(
+                """
+                INSERT INTO query_logs (query_hash, subgraph, timestamp, query_time_ms)
+                VALUES ('hash1', 'QmTJBvvpknMow6n4YU8R9Swna6N8mHK8N2WufetysBiyuL', now(), 30),
+                ('hash1', 'QmTJBvvpknMow6n4YU8R9Swna6N8mHK8N2WufetysBiyuL', now(), 5)
+            """
+            )
+        await ldb.update_query_stats_rollup(lag=timedelta(0))
+        mfq = await ldb.get_most_frequent_queries(subgraph, 2, from_rollup=True)
+        assert len(mfq) == 1
+        assert mfq[0].query == "query{values{id}}"
+        assert mfq[0].count == 3
+        assert mfq[0].min_time == 5
+        assert mfq[0].max_time == 30
+        assert mfq[0].avg_time == pytest.approx(15)
+        assert mfq[0].stddev_time == pytest.approx(13.228756555322953)
+
+    async def test_compact_query_stats_rollup(self, pgpool):
+        subgraph = "QmTJBvvpknMow6n4YU8R9Swna6N8mHK8N2WufetysBiyuL"
+        async with pgpool.connection() as conn:
+            # Query times 1, 2, ..., 1000 ms, spread over 2023-05-18 hours
+            await conn.execute(
+                """
+                INSERT INTO query_logs (query_hash, subgraph, timestamp, query_time_ms)
+                SELECT 'hash2', 'QmTJBvvpknMow6n4YU8R9Swna6N8mHK8N2WufetysBiyuL',
+                    '2023-05-18T00:30:00+00:00'::timestamptz + (i % 24) * interval '1 hour',
+                    i
+                FROM generate_series(1, 1000) as i
+            """
+            )
+        ldb = LogsDB(pgpool)
+        await ldb.update_query_stats_rollup(lag=timedelta(0))
+        expected = await ldb.get_most_frequent_queries(
+            subgraph, 1, from_rollup=True, quantiles=[0.5, 0.9]
+        )
+
+        await ldb.compact_query_stats_rollup(datetime(2023, 5, 20, tzinfo=timezone.utc))
+        async with pgpool.connection() as conn:
+            cursor = await conn.execute(
+                "SELECT subgraph, query_hash, bucket FROM query_stats_rollup"
+            )
+            # One bucket per skeleton of 2023-05-18
+            assert len(await cursor.fetchall()) == 3
+            cursor = await conn.execute(
+                "SELECT count(DISTINCT bucket) FROM query_stats_sketch"
+            )
+            assert await cursor.fetchone() == (1,)
+
+        mfq = await ldb.get_most_frequent_queries(
+            subgraph, 1, from_rollup=True, quantiles=[0.5, 0.9]
+        )
+        assert [
+            (q.query, q.count, q.min_time, q.max_time, q.quantile_times) for q in mfq
+        ] == [
+            (q.query, q.count, q.min_time, q.max_time, q.quantile_times)
+            for q in expected
+        ]
+        for query_stats, expected_stats in zip(mfq, expected):
+            assert query_stats.avg_time == pytest.approx(expected_stats.avg_time)
+            assert query_stats.stddev_time == pytest.approx(expected_stats.stddev_time)
+
+        # The days after compact_before are left as is
+        await ldb.compact_query_stats_rollup(datetime(2023, 5, 18, tzinfo=timezone.utc))
+        assert (await ldb.get_most_frequent_queries(subgraph, 1, from_rollup=True))[
+            0
+        ].count == expected[0].count
+
+        await ldb.compact_query_stats_rollup(
+            datetime(2023, 5, 20, tzinfo=timezone.utc),
+            datetime(2023, 5, 19, tzinfo=timezone.utc),
+        )
+        async with pgpool.connection() as conn:
+            for table in ("query_stats_rollup", "query_stats_sketch"):
+                cursor = await conn.execute(f"SELECT count(*) FROM {table}")
+                assert await cursor.fetchone() == (0,)
+
+    @pytest.fixture
+    async def recent_logs(self, pgpool):
+        async with pgpool.connection() as conn:
+            await conn.execute(
+                """
+                INSERT INTO query_logs (query_hash, subgraph, timestamp, query_time_ms)
+                VALUES ('hash2', 'QmPnu3R7Fm4RmBF21aCYUohDmWbKd3VMXo64ACiRtwUQrn', now() - interval '1 day', 40),
+                ('hash2', 'QmPnu3R7Fm4RmBF21aCYUohDmWbKd3VMXo64ACiRtwUQrn', now(), 60)
+            """
+            )
+
+    @pytest.mark.parametrize("from_rollup", [False, True])
+    async def test_get_most_frequent_queries_window(
+        self, pgpool, recent_logs, from_rollup
+    ):
+        ldb = LogsDB(pgpool)
+        await ldb.update_query_stats_rollup(lag=timedelta(0))
+        mfq = await ldb.get_most_frequent_queries(
+            "QmPnu3R7Fm4RmBF21aCYUohDmWbKd3VMXo64ACiRtwUQrn",
+            1,
+            from_rollup=from_rollup,
+            window=timedelta(days=2),
+        )
+        # The 2023 logs of hash1 are out of the window
+        assert len(mfq) == 1
+        assert mfq[0].query == "query{info{id text}}"
+        assert mfq[0].count == 2
+        assert mfq[0].min_time == 40
+        assert mfq[0].max_time == 60
+        assert mfq[0].avg_time == pytest.approx(50)
+
+    @pytest.mark.parametrize("from_rollup", [False, True])
+    async def test_get_most_frequent_queries_decay(
+        self, pgpool, recent_logs, from_rollup
+    ):
+        ldb = LogsDB(pgpool)
+        await ldb.update_query_stats_rollup(lag=timedelta(0))
+        mfq = await ldb.get_most_frequent_queries(
+            "QmPnu3R7Fm4RmBF21aCYUohDmWbKd3VMXo64ACiRtwUQrn",
+            1,
+            from_rollup=from_rollup,
+            half_life=timedelta(days=2),
+        )
+        # The 2023 logs of hash1 have a negligible weight
+        assert len(mfq) == 1
+        # Weights are 0.5**0.5 and 1. The rollup rounds the timestamps to the hour.
+        weight = 0.5**0.5
+        tolerance = 0.05 if from_rollup else 1e-3
+        assert mfq[0].count == 2
+        assert mfq[0].min_time == 40
+        assert mfq[0].max_time == 60
+        assert mfq[0].avg_time == pytest.approx(
+            (weight * 40 + 60) / (weight + 1), rel=tolerance
+        )
+
+    async def test_get_most_frequent_queries_bulk(self, pgpool):
+        subgraphs = [
+            "QmPnu3R7Fm4RmBF21aCYUohDmWbKd3VMXo64ACiRtwUQrn",
+            "QmTJBvvpknMow6n4YU8R9Swna6N8mHK8N2WufetysBiyuL",
+            "QmYBv5WZKiU5G8tqtWzhA5L7vpjmR3pvBeyGJFSXgHYxt4",  # No logs
+        ]
+        ldb = LogsDB(pgpool)
+        bulk = [
+            (subgraph, query_stats)
+            async for subgraph, query_stats in ldb.get_most_frequent_queries_bulk(
+                subgraphs, 1
+            )
+        ]
+        per_subgraph = [
+            (subgraph, query_stats)
+            for subgraph in sorted(subgraphs)
+            for query_stats in await ldb.get_most_frequent_queries(subgraph, 1)
+        ]
+        assert len(bulk) == 3
+        assert bulk == per_subgraph
+
+    async def test_query_bodies_cache(self, pgpool):
+        ldb = LogsDB(pgpool)
+        with mock.patch(
+            "autoagora.logs_db.graphql.parse", wraps=graphql.parse
+        ) as parse_mock:
+            first = await ldb.get_most_frequent_queries(
+                "QmPnu3R7Fm4RmBF21aCYUohDmWbKd3VMXo64ACiRtwUQrn", 2
+            )
+            assert parse_mock.call_count == 1
+            # Only the new skeleton is parsed
+            await ldb.get_most_frequent_queries(
+                "QmTJBvvpknMow6n4YU8R9Swna6N8mHK8N2WufetysBiyuL", 1
+            )
+            assert parse_mock.call_count == 2
+            second = await LogsDB(pgpool).get_most_frequent_queries(
+                "QmPnu3R7Fm4RmBF21aCYUohDmWbKd3VMXo64ACiRtwUQrn", 2
+            )
+            assert parse_mock.call_count == 2
+        assert first == second
+
+    def test_query_bodies_cache_eviction(self):
+        ldb = LogsDB(mock.MagicMock())
+        with mock.patch.object(LogsDB, "query_bodies_cache_size", 2):
+            ldb._cached_query_body(b"hash1", "query { a { id } }")
+            ldb._cached_query_body(b"hash2", "query { b { id } }")
+            # hash1 becomes the most recently used
+            ldb._cached_query_body(b"hash1", "query { a { id } }")
+            ldb._cached_query_body(b"hash3", "query { c { id } }")
+        assert list(LogsDB._query_bodies.keys()) == [b"hash1", b"hash3"]
+
+    def test_row_to_query_stats_null_quantiles(self):
+        ldb = LogsDB(mock.MagicMock())
+        query_stats = ldb._row_to_query_stats(
+            (b"hash", "query { a { id } }", 3, 1, 3, 2.0, 1.0, None, None, None),
+            quantiles=[0.5, 0.9],
+        )
+        # No query time sample to estimate the quantiles from
+        assert query_stats.quantile_times == {}
+        assert query_stats.price_time == 2.0
+
+    @pytest.mark.parametrize(
+        "top_k,coverage,expected_counts",
+        [
+            (None, None, [2, 2]),
+            (1, None, [2]),
+            (None, 0.5, [2]),
+            (None, 0.75, [2, 2]),
+            (1, 0.75, [2]),
+        ],
+    )
+    async def test_iter_most_frequent_queries_cutoffs(
+        self, pgpool, recent_logs, top_k, coverage, expected_counts
+    ):
+        ldb = LogsDB(pgpool)
+        mfq = [
+            query_stats
+            async for query_stats in ldb.iter_most_frequent_queries(
+                "QmPnu3R7Fm4RmBF21aCYUohDmWbKd3VMXo64ACiRtwUQrn",
+                2,
+                top_k=top_k,
+                coverage=coverage,
+            )
+        ]
+        assert [query_stats.count for query_stats in mfq] == expected_counts
+        # Equal counts are ordered by hash: hash1 first
+        assert mfq[0].query == "query{values{id}}"
+
+    @pytest.mark.parametrize("half_life", [None, timedelta(days=7)])
+    async def test_get_most_frequent_queries_quantiles(self, pgpool, half_life):
+        subgraph = "QmTJBvvpknMow6n4YU8R9Swna6N8mHK8N2WufetysBiyuL"
+        async with pgpool.connection() as conn:
+            # Query times 1, 2, ..., 1000 ms
+            await conn.execute(
+                """
+                INSERT INTO query_logs (query_hash, subgraph, timestamp, query_time_ms)
+                SELECT 'hash2', 'QmTJBvvpknMow6n4YU8R9Swna6N8mHK8N2WufetysBiyuL', now(), i
+                FROM generate_series(1, 1000) as i
+            """
+            )
+        ldb = LogsDB(pgpool)
+        await ldb.update_query_stats_rollup(lag=timedelta(0))
+        mfq = await ldb.get_most_frequent_queries(
+            subgraph,
+            100,
+            from_rollup=True,
+            half_life=half_life,
+            quantiles=[0.5, 0.9],
+        )
+        assert len(mfq) == 1
+        if half_life is None:
+            assert mfq[0].count == 1001
+        else:
+            # The 2023 log has a negligible weight, and the others are up to an hour
+            # old in the rollup.
+            assert mfq[0].count == pytest.approx(1000, rel=0.01)
+        assert mfq[0].quantile_times.keys() == {0.5, 0.9}
+        accuracy = LogsDB.sketch_relative_accuracy
+        assert mfq[0].quantile_times[0.5] == pytest.approx(500, rel=accuracy)
+        assert mfq[0].quantile_times[0.9] == pytest.approx(900, rel=accuracy)
+        assert mfq[0].price_time == pytest.approx(700, rel=accuracy)
+
+    async def test_iter_logged_queries(self, pgpool, recent_logs):
+        async with pgpool.connection() as connection:
+            await connection.execute(
+                """
+                UPDATE query_logs SET query_variables = '{"first": 10}'
+                WHERE timestamp > now() - interval '1 hour'
+                """
+            )
+        ldb = LogsDB(pgpool)
+
+        logged_queries = [
+            logged_query
+            async for logged_query in ldb.iter_logged_queries(
+                "QmPnu3R7Fm4RmBF21aCYUohDmWbKd3VMXo64ACiRtwUQrn"
+            )
+        ]
+        assert len(logged_queries) == 4
+        # Most recent first
+        assert logged_queries[0] == ("query getInfo{ info { id text} }", {"first": 10})
+        assert logged_queries[1] == ("query getInfo{ info { id text} }", None)
+
+        logged_queries = [
+            logged_query
+            async for logged_query in ldb.iter_logged_queries(
+                "QmPnu3R7Fm4RmBF21aCYUohDmWbKd3VMXo64ACiRtwUQrn",
+                window=timedelta(days=2),
+                limit=1,
+            )
+        ]
+        assert logged_queries == [("query getInfo{ info { id text} }", {"first": 10})]
+
+    async def test_get_long_tail_queries_bulk(self, pgpool):
+        ldb = LogsDB(pgpool)
+        long_tail_queries = [
+            long_tail_query
+            async for long_tail_query in ldb.get_long_tail_queries_bulk(
+                [
+                    "QmPnu3R7Fm4RmBF21aCYUohDmWbKd3VMXo64ACiRtwUQrn",
+                    "QmTJBvvpknMow6n4YU8R9Swna6N8mHK8N2WufetysBiyuL",
+                ],
+                min_count=2,
+            )
+        ]
+        # hash1 is frequent enough for the first subgraph. The skeletons are returned
+        # as logged.
+        assert long_tail_queries == [
+            (
+                "QmTJBvvpknMow6n4YU8R9Swna6N8mHK8N2WufetysBiyuL",
+                "query getData{ values { id } }",
+                1.0,
+                10.0,
+            ),
+            (
+                "QmTJBvvpknMow6n4YU8R9Swna6N8mHK8N2WufetysBiyuL",
+                "query getInfo{ info { id text} }",
+                1.0,
+                50.0,
+            ),
+        ]
+
+    async def test_sampled_aggregation(self, pgpool):
+        async with pgpool.connection() as conn:
+            # 3/4 hash1 and 1/4 hash2, with query times from 100 to 149
+            await conn.execute(
+                """
+                INSERT INTO query_logs (query_hash, subgraph, timestamp, query_time_ms)
+                SELECT
+                    CASE WHEN i % 4 = 0 THEN 'hash2' ELSE 'hash1' END::bytea,
+                    'QmPnu3R7Fm4RmBF21aCYUohDmWbKd3VMXo64ACiRtwUQrn',
+                    '2023-05-18T21:47:41+00:00',
+                    100 + i % 50
+                FROM
+                    generate_series(1, 100000) AS i
+            """
+            )
+            await conn.execute("ANALYZE query_logs")
+
+        ldb = LogsDB(pgpool)
+        subgraphs = [
+            "QmPnu3R7Fm4RmBF21aCYUohDmWbKd3VMXo64ACiRtwUQrn",
+            "QmTJBvvpknMow6n4YU8R9Swna6N8mHK8N2WufetysBiyuL",
+        ]
+        # The small subgraph is aggregated exactly
+        sample_fractions = await ldb._sample_fractions(subgraphs, sample_size=10_000)
+        assert list(sample_fractions) == [subgraphs[0]]
+        assert sample_fractions[subgraphs[0]] == pytest.approx(0.1, rel=0.1)
+
+        mfq = dict()
+        async for subgraph, query_stats in ldb.get_most_frequent_queries_bulk(
+            subgraphs, min_count=1, sample_size=10_000
+        ):
+            mfq[subgraph, query_stats.query] = query_stats
+
+        for query, count in [
+            ("query{values{id}}", 75_002),
+            ("query{info{id text}}", 25_000),
+        ]:
+            query_stats = mfq[subgraphs[0], query]
+            assert query_stats.count_stderr
+            assert abs(query_stats.count - count) < 5 * query_stats.count_stderr
+            assert query_stats.avg_time == pytest.approx(124.5, rel=0.05)
+            assert query_stats.stddev_time == pytest.approx(14.4, rel=0.1)
+            assert 100 <= query_stats.min_time <= query_stats.max_time <= 200
+
+        assert [
+            (query_stats.count, query_stats.count_stderr)
+            for (subgraph, _), query_stats in mfq.items()
+            if subgraph == subgraphs[1]
+        ] == [(1, None), (1, None)]
+
+        # Sampling a small share of query_logs would read more pages than the
+        # subgraph's query logs
+        async with pgpool.connection() as conn:
+            await conn.execute(
+                """
+                INSERT INTO query_logs (query_hash, subgraph, timestamp, query_time_ms)
+                SELECT
+                    'hash1',
+                    'QmTJBvvpknMow6n4YU8R9Swna6N8mHK8N2WufetysBiyuL',
+                    '2023-05-18T21:47:41+00:00',
+                    100
+                FROM
+                    generate_series(1, 200)
+            """
+            )
+            await conn.execute("ANALYZE query_logs")
+        assert list(await ldb._sample_fractions(subgraphs, sample_size=100)) == [
+            subgraphs[0]
+        ]
+
+    @pytest.fixture
+    async def replica_pgpool(self, postgresql):
+        # The test database is not in recovery, so it acts as a replica without lag
+        conn_string = (
+            f"host={postgresql.info.host} "
+            f"dbname={postgresql.info.dbname} "
+            f"user={postgresql.info.user} "
+            f'password="{postgresql.info.password}" '
+            f"port={postgresql.info.port}"
+        )
+        pool = psycopg_pool.AsyncConnectionPool(
+            conn_string, min_size=1, max_size=2, open=False
+        )
+        await pool.open()
+        yield pool
+        await pool.close()
+
+    async def test_replica_routing(self, pgpool, replica_pgpool):
+        ldb = LogsDB(pgpool, replica_pgpool)
+        assert await ldb._read_pgpool() is replica_pgpool
+
+        with mock.patch.object(
+            replica_pgpool, "connection", wraps=replica_pgpool.connection
+        ) as replica_connection:
+            mfq = await ldb.get_most_frequent_queries(
+                "QmPnu3R7Fm4RmBF21aCYUohDmWbKd3VMXo64ACiRtwUQrn", 2
+            )
+        # Lag check and aggregation
+        assert replica_connection.call_count == 2
+        assert mfq == await LogsDB(pgpool).get_most_frequent_queries(
+            "QmPnu3R7Fm4RmBF21aCYUohDmWbKd3VMXo64ACiRtwUQrn", 2
+        )
+
+    async def test_replica_fallback(self, pgpool, replica_pgpool):
+        ldb = LogsDB(pgpool, replica_pgpool, replica_max_lag=timedelta(minutes=1))
+        with mock.patch.object(ldb, "_replica_lag", return_value=timedelta(hours=1)):
+            assert await ldb._read_pgpool() is pgpool
+        with mock.patch.object(ldb, "_replica_lag", return_value=None):
+            assert await ldb._read_pgpool() is pgpool
+
+        # Slow replica
+        async def replica_lag():
+            await aio.sleep(10)
+
+        ldb.replica_lag_timeout = timedelta(milliseconds=10)
+        with mock.patch.object(ldb, "_replica_lag", side_effect=replica_lag):
+            assert await aio.wait_for(ldb._read_pgpool(), 1) is pgpool
+
+        # Unreachable replica
+        await replica_pgpool.close()
+        assert await ldb._read_pgpool() is pgpool
+        mfq = await ldb.get_most_frequent_queries(
+            "QmPnu3R7Fm4RmBF21aCYUohDmWbKd3VMXo64ACiRtwUQrn", 2
+        )
+        assert len(mfq) == 1
@@ -0,0 +1,74 @@
+import random
+
+import pytest
+
+from autoagora.long_tail_costs import RootFieldCost, fit_root_field_costs, root_fields
+
+
+class TestLongTailCosts:
+    def test_root_fields(self):
+        assert root_fields(
+            "query($_0: Int) { a(first: $_0) { id } b: a { id } c }"
+        ) == [
+            "a",
+            "a",
+            "c",
+        ]
+        assert root_fields("{ __typename values { id } }") == ["values"]
+        assert root_fields("fragment f on Value { id }") == []
+
+    def test_fit_root_field_costs(self):
+        random.seed(0)
+        field_times = {"a": 2.0, "b": 5.0, "c": 1.0}
+        long_tail_queries = []
+        for i in range(300):
+            fields = random.sample(sorted(field_times), random.randint(1, 3))
+            query = (
+                "query { "
+                + " ".join(f"{field}(first: {i}) {{ id }}" for field in fields)
+                + " }"
+            )
+            time = sum(field_times[field] for field in fields)
+            long_tail_queries.append((query, random.randint(1, 20), time))
+        # Too infrequent to be fitted, along with the skeletons selecting it
+        long_tail_queries.append(("query { rare { id } a { id } }", 5, 1000.0))
+        # Unparsable
+        long_tail_queries.append(("query {", 50, 1000.0))
+
+        costs = fit_root_field_costs(long_tail_queries, min_count=10)
+
+        assert [cost.root_field for cost in costs] == sorted(
+            field_times,
+            key=lambda field: -sum(
+                count for query, count, _ in long_tail_queries[:300] if field in query
+            ),
+        )
+        for cost in costs:
+            assert cost.time == pytest.approx(field_times[cost.root_field])
+
+    def test_fit_root_field_costs_aliases(self):
+        # a is selected twice by the second skeleton, which is priced twice by Agora
+        costs = fit_root_field_costs(
+            [
+                ("{ a { id } }", 10, 3.0),
+                ("{ x: a { id } y: a { id } }", 10, 6.0),
+                ("{ a { id } b { id } }", 10, 4.0),
+            ]
+        )
+        assert costs == [
+            RootFieldCost(root_field="a", count=30, time=pytest.approx(3.0)),
+            RootFieldCost(root_field="b", count=10, time=pytest.approx(1.0)),
+        ]
+
+    def test_fit_root_field_costs_positive(self):
+        # Fitting both gives b a negative cost, so it is left out and a fitted alone
+        costs = fit_root_field_costs(
+            [("{ a { id } }", 10, 4.0), ("{ a { id } b { id } }", 10, 2.0)]
+        )
+        assert costs == [
+            RootFieldCost(root_field="a", count=20, time=pytest.approx(3.0))
+        ]
+
+    def test_fit_root_field_costs_empty(self):
+        assert fit_root_field_costs([]) == []
+        assert fit_root_field_costs([("{ a { id } }", 1, 4.0)]) == []
@@ -64,3 +64,55 @@ class TestScript:
                             # Since there is no args for relative query cost the update_loop wont be called
                             assert mock_model_update_loop.call_count == 0
                             mock_price_bandit_loop.assert_called()
+
+    async def test_allocated_subgraph_watcher_bulk(self, postgresql):
+        subgraph1 = "QmPnu3R7Fm4RmBF21aCYUohDmWbKd3VMXo64ACiRtwUQrn"
+        subgraph2 = "QmTJBvvpknMow6n4YU8R9Swna6N8mHK8N2WufetysBiyuL"
+        with mock.patch(
+            "autoagora.main.get_allocated_subgraphs"
+        ) as mock_get_allocated_subgraphs:
+            with mock.patch("autoagora.main.set_cost_model"):
+                with mock.patch("autoagora.main.apply_default_model"):
+                    with mock.patch(
+                        "autoagora.main.model_update_loop"
+                    ) as mock_model_update_loop:
+                        with mock.patch(
+                            "autoagora.main.bulk_model_update_loop"
+                        ) as mock_bulk_model_update_loop:
+                            with mock.patch("autoagora.main.price_bandit_loop"):
+                                init_config(
+                                    [
+                                        "--indexer-agent-mgmt-endpoint",
+                                        "http://nowhere",
+                                        "--postgres-host",
+                                        postgresql.info.host,
+                                        "--postgres-username",
+                                        postgresql.info.user,
+                                        "--postgres-password",
+                                        postgresql.info.password,
+                                        "--postgres-port",
+                                        str(postgresql.info.port),
+                                        "--postgres-database",
+                                        postgresql.info.dbname,
+                                        "--indexer-service-metrics-endpoint",
+                                        "http://indexer-service.default.svc.cluster.local:7300/metrics",
+                                        "--relative-query-costs",
+                                        "--relative-query-costs-bulk",
+                                    ]
+                                )
+                                mock_get_allocated_subgraphs.return_value = {
+                                    subgraph1,
+                                    subgraph2,
+                                }
+
+                                task = asyncio.create_task(allocated_subgraph_watcher())
+                                await asyncio.sleep(2)
+                                task.cancel()
+
+                                # A single loop for all the subgraphs
+                                assert mock_model_update_loop.call_count == 0
+                                mock_bulk_model_update_loop.assert_called_once()
+                                get_subgraphs = mock_bulk_model_update_loop.call_args[
+                                    0
+                                ][0]
+                                assert set(get_subgraphs()) == {subgraph1, subgraph2}
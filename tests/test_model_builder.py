@@ -1,11 +1,31 @@
+import asyncio as aio
 import os
 import re
+import statistics
 import tempfile
+from datetime import timedelta
 from unittest import mock
 
+import pytest
+from prometheus_client import REGISTRY
+
+from autoagora.agora_evaluator import AgoraModel
 from autoagora.config import init_config
 from autoagora.logs_db import LogsDB
-from autoagora.model_builder import apply_default_model, build_template
+from autoagora.model_builder import (
+    ManualEntries,
+    agora_entry_template,
+    apply_default_model,
+    build_template,
+    bulk_model_builder,
+    bulk_model_update_loop,
+    dedupe_model_entries,
+    generate_model,
+    manual_entries_watcher,
+    model_builder,
+    model_update_loop,
+    select_model_entries,
+)
 from tests.utils.constants import TEST_MANUAL_AGORA_ENTRY, TEST_QUERY_1, TEST_QUERY_2
 
 
@@ -152,3 +172,491 @@ class TestModelBuilder:
                     debug_logs_args = str(debug_logs_args).replace(r"\n", "")
                     manual_agora_entry = TEST_MANUAL_AGORA_ENTRY.replace("\n", "")
                     assert manual_agora_entry in debug_logs_args
+
+    async def test_bulk_model_builder(self, postgresql):
+        subgraph1 = "QmPnu3R7Fm4RmBF21aCYUohDmWbKd3VMXo64ACiRtwUQrn"
+        subgraph2 = "QmTJBvvpknMow6n4YU8R9Swna6N8mHK8N2WufetysBiyuL"
+        subgraph3 = "QmYBv5WZKiU5G8tqtWzhA5L7vpjmR3pvBeyGJFSXgHYxt4"
+        init_config(
+            [
+                "--indexer-agent-mgmt-endpoint",
+                "http://nowhere",
+                "--postgres-host",
+                postgresql.info.host,
+                "--postgres-username",
+                postgresql.info.user,
+                "--postgres-password",
+                postgresql.info.password,
+                "--postgres-port",
+                str(postgresql.info.port),
+                "--postgres-database",
+                postgresql.info.dbname,
+                "--indexer-service-metrics-endpoint",
+                "http://indexer-service.default.svc.cluster.local:7300/metrics",
+            ]
+        )
+
+        async def most_frequent_queries_bulk(subgraphs, **kwargs):
+            for subgraph, query in [
+                (subgraph1, TEST_QUERY_1),
+                (subgraph1, TEST_QUERY_2),
+                (subgraph2, TEST_QUERY_2),
+            ]:
+                yield subgraph, LogsDB.QueryStats(
+                    query=query,
+                    count=100,
+                    min_time=1,
+                    max_time=60,
+                    avg_time=1.2,
+                    stddev_time=0.5,
+                )
+
+        with mock.patch("autoagora.model_builder.LogsDB") as logs_db_mock:
+            logs_db_mock.return_value.get_most_frequent_queries_bulk = (
+                most_frequent_queries_bulk
+            )
+            models = await bulk_model_builder(
+                [subgraph1, subgraph2, subgraph3], mock.MagicMock()
+            )
+
+        assert models.keys() == {subgraph1, subgraph2, subgraph3}
+        assert TEST_QUERY_1 in models[subgraph1]
+        assert TEST_QUERY_2 in models[subgraph1]
+        assert TEST_QUERY_1 not in models[subgraph2]
+        assert TEST_QUERY_2 in models[subgraph2]
+        assert models[subgraph3] == build_template(subgraph3)
+
+    async def test_bulk_model_update_loop_failure(self):
+        subgraph1 = "QmPnu3R7Fm4RmBF21aCYUohDmWbKd3VMXo64ACiRtwUQrn"
+        subgraph2 = "QmTJBvvpknMow6n4YU8R9Swna6N8mHK8N2WufetysBiyuL"
+        init_config(
+            [
+                "--indexer-agent-mgmt-endpoint",
+                "http://nowhere",
+                "--postgres-host",
+                "nowhere",
+                "--postgres-username",
+                "nowhere",
+                "--postgres-password",
+                "nowhere",
+                "--indexer-service-metrics-endpoint",
+                "http://nowhere",
+                "--relative-query-costs-refresh-interval",
+                "0",
+            ]
+        )
+
+        applied = aio.Queue()
+
+        async def set_cost_model(subgraph, model):
+            if subgraph == subgraph1:
+                raise RuntimeError()
+            await applied.put((subgraph, model))
+
+        with mock.patch(
+            "autoagora.model_builder.bulk_model_builder",
+            side_effect=[
+                RuntimeError(),
+                {subgraph1: "model1", subgraph2: "model2"},
+                {subgraph2: "model3"},
+            ],
+        ), mock.patch(
+            "autoagora.model_builder.set_cost_model", side_effect=set_cost_model
+        ):
+            loop = aio.ensure_future(
+                bulk_model_update_loop(lambda: [subgraph1, subgraph2], mock.MagicMock())
+            )
+            try:
+                # Neither the failed build nor the failed application of subgraph1's
+                # model stop the updates
+                assert await aio.wait_for(applied.get(), timeout=5) == (
+                    subgraph2,
+                    "model2",
+                )
+                assert await aio.wait_for(applied.get(), timeout=5) == (
+                    subgraph2,
+                    "model3",
+                )
+            finally:
+                loop.cancel()
+
+    async def test_model_update_loop_check_failure(self):
+        subgraph = "QmPnu3R7Fm4RmBF21aCYUohDmWbKd3VMXo64ACiRtwUQrn"
+        checks = [RuntimeError(), {subgraph}]
+
+        async def wait(get_subgraphs):
+            if not checks:
+                await aio.Event().wait()
+            result = checks.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        rebuild_trigger = mock.MagicMock()
+        rebuild_trigger.wait = wait
+        rebuild_trigger.check_interval = timedelta(seconds=0)
+        rebuild_trigger.commit = mock.AsyncMock()
+
+        with mock.patch("autoagora.model_builder.update_model") as update_model_mock:
+            loop = aio.ensure_future(
+                model_update_loop(
+                    subgraph, mock.MagicMock(), rebuild_trigger=rebuild_trigger
+                )
+            )
+            try:
+                await aio.sleep(0.1)
+                # Checked again after the failed check
+                assert not loop.done()
+                update_model_mock.assert_awaited_once()
+                rebuild_trigger.commit.assert_awaited_once_with([subgraph])
+            finally:
+                loop.cancel()
+
+    async def test_bulk_model_update_loop_rebuild_trigger(self):
+        subgraph1 = "QmPnu3R7Fm4RmBF21aCYUohDmWbKd3VMXo64ACiRtwUQrn"
+        subgraph2 = "QmTJBvvpknMow6n4YU8R9Swna6N8mHK8N2WufetysBiyuL"
+        rebuild_trigger = mock.MagicMock()
+        rebuild_trigger.wait = mock.AsyncMock(return_value={subgraph1, subgraph2})
+        rebuild_trigger.check_interval = timedelta(hours=1)
+        rebuild_trigger.commit = mock.AsyncMock()
+
+        async def set_cost_model(subgraph, model):
+            if subgraph == subgraph1:
+                raise RuntimeError()
+
+        with mock.patch(
+            "autoagora.model_builder.bulk_model_builder",
+            return_value={subgraph1: "model1", subgraph2: "model2"},
+        ), mock.patch(
+            "autoagora.model_builder.set_cost_model", side_effect=set_cost_model
+        ):
+            loop = aio.ensure_future(
+                bulk_model_update_loop(
+                    lambda: [subgraph1, subgraph2],
+                    mock.MagicMock(),
+                    rebuild_trigger=rebuild_trigger,
+                )
+            )
+            try:
+                await aio.sleep(0.1)
+                # Only the applied model is committed, and the failed one retried
+                # at the next check
+                rebuild_trigger.commit.assert_called_once_with([subgraph2])
+                assert not loop.done()
+            finally:
+                loop.cancel()
+
+    def test_build_model_quantiles(self):
+        most_frequent_queries = [
+            LogsDB.QueryStats(
+                query=TEST_QUERY_1,
+                count=100,
+                min_time=1,
+                max_time=60,
+                avg_time=1.2,
+                stddev_time=0.5,
+                quantile_times={0.5: 2.0, 0.9: 5.0},
+            ),
+        ]
+
+        model = build_template(
+            "Qmadj8x9km1YEyKmRnJ6EkC2zpJZFCfTyTZpuqC3j6e1QH", most_frequent_queries
+        )
+        assert "# p50 time:     2.0\n" in model
+        assert "# p90 time:     5.0\n" in model
+        # Priced on the mean of the quantile times
+        assert f"{TEST_QUERY_1} => 3.5 * $GLOBAL_COST_MULTIPLIER;" in model
+
+    def test_generate_model(self):
+        subgraph = "Qmadj8x9km1YEyKmRnJ6EkC2zpJZFCfTyTZpuqC3j6e1QH"
+        most_frequent_queries = [
+            LogsDB.QueryStats(
+                query=query,
+                count=100,
+                min_time=1,
+                max_time=60,
+                avg_time=1.2,
+                stddev_time=0.5,
+            )
+            for query in (TEST_QUERY_1, TEST_QUERY_2)
+        ]
+
+        agora_entry_template.cache_clear()
+        try:
+            with mock.patch(
+                "autoagora.model_builder.version", return_value="1.2.3"
+            ) as version_mock:
+                # Streamed from a generator
+                chunks = list(
+                    generate_model(subgraph, (query for query in most_frequent_queries))
+                )
+                model = build_template(subgraph, most_frequent_queries)
+        finally:
+            agora_entry_template.cache_clear()
+
+        # The template is compiled, and the version resolved, only once
+        version_mock.assert_called_once_with("autoagora")
+        assert len(chunks) > 1
+        assert "".join(chunks) == model
+        assert model.startswith("# Generated by AutoAgora 1.2.3\n")
+        assert TEST_QUERY_1 in model
+        assert TEST_QUERY_2 in model
+        assert "# count stderr:" not in model
+
+        # Sampled counts
+        most_frequent_queries[0].count_stderr = 3.5
+        model = build_template(subgraph, most_frequent_queries)
+        assert "# count:        100\n# count stderr: 3.5\n# min time:" in model
+
+    async def test_manual_entries(self):
+        subgraph = "Qmadj8x9km1YEyKmRnJ6EkC2zpJZFCfTyTZpuqC3j6e1QH"
+        with tempfile.TemporaryDirectory() as temp_dir:
+            init_config(
+                [
+                    "--indexer-agent-mgmt-endpoint",
+                    "http://nowhere",
+                    "--postgres-host",
+                    "nowhere",
+                    "--postgres-username",
+                    "nowhere",
+                    "--postgres-password",
+                    "nowhere",
+                    "--indexer-service-metrics-endpoint",
+                    "http://nowhere",
+                    "--manual-entry-path",
+                    temp_dir,
+                ]
+            )
+            entry_path = os.path.join(temp_dir, subgraph + ".agora")
+            manual_entries = ManualEntries()
+
+            # No entry file yet
+            assert await manual_entries.refresh([subgraph]) == set()
+            assert manual_entries.get(subgraph) is None
+
+            with open(entry_path, "w") as entry_file:
+                entry_file.write(TEST_MANUAL_AGORA_ENTRY)
+            os.utime(entry_path, ns=(1_000_000_000, 1_000_000_000))
+            assert await manual_entries.refresh([subgraph]) == {subgraph}
+            assert manual_entries.get(subgraph) == TEST_MANUAL_AGORA_ENTRY
+
+            # The file is not read again while its modification time is unchanged
+            with mock.patch(
+                "autoagora.model_builder.obtain_manual_entries"
+            ) as obtain_manual_entries_mock:
+                assert await manual_entries.refresh([subgraph]) == set()
+                assert manual_entries.get(subgraph) == TEST_MANUAL_AGORA_ENTRY
+                obtain_manual_entries_mock.assert_not_called()
+
+            # Modified
+            with open(entry_path, "w") as entry_file:
+                entry_file.write("default => 1;")
+            os.utime(entry_path, ns=(2_000_000_000, 2_000_000_000))
+            assert manual_entries.get(subgraph) == TEST_MANUAL_AGORA_ENTRY
+            assert await manual_entries.refresh([subgraph]) == {subgraph}
+            assert manual_entries.get(subgraph) == "default => 1;"
+
+            # Deleted
+            os.remove(entry_path)
+            assert await manual_entries.refresh([subgraph]) == {subgraph}
+            assert manual_entries.get(subgraph) is None
+
+    async def test_manual_entries_watcher(self):
+        subgraph1 = "QmPnu3R7Fm4RmBF21aCYUohDmWbKd3VMXo64ACiRtwUQrn"
+        subgraph2 = "QmTJBvvpknMow6n4YU8R9Swna6N8mHK8N2WufetysBiyuL"
+        with tempfile.TemporaryDirectory() as temp_dir:
+            init_config(
+                [
+                    "--indexer-agent-mgmt-endpoint",
+                    "http://nowhere",
+                    "--postgres-host",
+                    "nowhere",
+                    "--postgres-username",
+                    "nowhere",
+                    "--postgres-password",
+                    "nowhere",
+                    "--indexer-service-metrics-endpoint",
+                    "http://nowhere",
+                    "--manual-entry-path",
+                    temp_dir,
+                    "--manual-entry-poll-interval",
+                    "0",
+                ]
+            )
+            for subgraph in (subgraph1, subgraph2):
+                with open(os.path.join(temp_dir, subgraph + ".agora"), "w") as file:
+                    file.write(TEST_MANUAL_AGORA_ENTRY)
+
+            with mock.patch(
+                "autoagora.model_builder.manual_entries", ManualEntries()
+            ) as manual_entries:
+                await manual_entries.refresh([subgraph1, subgraph2])
+
+                changed = aio.Queue()
+                watcher = aio.ensure_future(
+                    manual_entries_watcher(lambda: [subgraph1, subgraph2], changed.put)
+                )
+                try:
+                    entry_path = os.path.join(temp_dir, subgraph2 + ".agora")
+                    with open(entry_path, "w") as entry_file:
+                        entry_file.write("default => 1;")
+                    os.utime(entry_path, ns=(1_000_000_000, 1_000_000_000))
+
+                    # Only the modified subgraph's model is rebuilt
+                    assert await aio.wait_for(changed.get(), timeout=5) == subgraph2
+                    await aio.sleep(0.1)
+                    assert changed.empty()
+                    assert manual_entries.get(subgraph2) == "default => 1;"
+                finally:
+                    watcher.cancel()
+
+    @staticmethod
+    def _budget_candidates():
+        # Ordered by decreasing count, as returned by LogsDB
+        return [
+            LogsDB.QueryStats(
+                query=query,
+                count=count,
+                min_time=1,
+                max_time=100,
+                avg_time=avg_time,
+                stddev_time=0.5,
+            )
+            for query, count, avg_time in [
+                ("query { a_long_skeleton_name { id } }", 500, 1.0),
+                ("query { b { id } }", 300, 10.0),
+                ("query { c { id } }", 150, 2.0),
+                ("query { d { id } }", 50, 1.0),
+            ]
+        ]
+
+    @pytest.mark.parametrize(
+        "budget,expected_root_fields,expected_coverage",
+        [
+            ({}, ["a_long_skeleton_name", "b", "c", "d"], 1.0),
+            ({"max_entries": 2}, ["a_long_skeleton_name", "b"], 0.8),
+            # b, c and d (18 bytes each) cover more per byte than a (37 bytes), which
+            # does not fit anymore after b.
+            ({"max_bytes": 54}, ["b", "c", "d"], 0.5),
+            ({"max_entries": 1, "objective": "revenue"}, ["b"], 3000 / 3850),
+            ({"max_entries": 2, "max_bytes": 54}, ["b", "c"], 0.45),
+        ],
+    )
+    def test_select_model_entries(
+        self, budget, expected_root_fields, expected_coverage
+    ):
+        selected, coverage = select_model_entries(self._budget_candidates(), **budget)
+
+        # Most frequent first
+        assert [
+            query_stats.query.split(" ")[2] for query_stats in selected
+        ] == expected_root_fields
+        assert coverage == pytest.approx(expected_coverage)
+
+    def test_dedupe_model_entries(self):
+        def query_stats(query, times):
+            return LogsDB.QueryStats(
+                query=query,
+                count=len(times),
+                min_time=min(times),
+                max_time=max(times),
+                avg_time=statistics.mean(times),
+                stddev_time=statistics.stdev(times),
+            )
+
+        a = query_stats("query { a { id } }", [1, 2, 3, 4])
+        b = query_stats("query { b { id } }", [10, 20, 30])
+        # Same query body as "b", from a skeleton with other variable definitions
+        duplicate = query_stats("query { b { id } }", [5, 15])
+
+        deduped = dedupe_model_entries([a, b, duplicate])
+        # Merged into the statistics of the union of their query times, now the
+        # most frequent
+        assert deduped[1] == a
+        expected = query_stats("query { b { id } }", [10, 20, 30, 5, 15])
+        assert (deduped[0].query, deduped[0].count) == (expected.query, 5)
+        assert (deduped[0].min_time, deduped[0].max_time) == (5, 30)
+        assert deduped[0].avg_time == pytest.approx(expected.avg_time)
+        assert deduped[0].stddev_time == pytest.approx(expected.stddev_time)
+
+    async def test_model_builder_budget(self):
+        subgraph = "QmPnu3R7Fm4RmBF21aCYUohDmWbKd3VMXo64ACiRtwUQrn"
+        init_config(
+            [
+                "--indexer-agent-mgmt-endpoint",
+                "http://nowhere",
+                "--postgres-host",
+                "nowhere",
+                "--postgres-username",
+                "nowhere",
+                "--postgres-password",
+                "nowhere",
+                "--indexer-service-metrics-endpoint",
+                "http://nowhere",
+                "--relative-query-costs-max-entries",
+                "2",
+            ]
+        )
+
+        with mock.patch("autoagora.model_builder.LogsDB") as logs_db_mock:
+            logs_db_mock.return_value.get_most_frequent_queries = mock.AsyncMock(
+                return_value=self._budget_candidates()
+            )
+            model = await model_builder(subgraph, mock.MagicMock())
+
+        assert "query { b { id } }" in model
+        assert "query { c { id } }" not in model
+        assert model.index("a_long_skeleton_name") < model.index("query { b { id } }")
+        assert REGISTRY.get_sample_value(
+            "relative_query_costs_model_coverage", {"subgraph": subgraph}
+        ) == pytest.approx(0.8)
+
+    async def test_model_builder_long_tail(self):
+        subgraph = "QmPnu3R7Fm4RmBF21aCYUohDmWbKd3VMXo64ACiRtwUQrn"
+        init_config(
+            [
+                "--indexer-agent-mgmt-endpoint",
+                "http://nowhere",
+                "--postgres-host",
+                "nowhere",
+                "--postgres-username",
+                "nowhere",
+                "--postgres-password",
+                "nowhere",
+                "--indexer-service-metrics-endpoint",
+                "http://nowhere",
+                "--relative-query-costs-long-tail",
+            ]
+        )
+
+        async def long_tail_queries_bulk(subgraphs, **kwargs):
+            for query, count, avg_time in [
+                ("query($_0: Int) { values(skip: $_0) { id } }", 20, 3.0),
+                ("query { values { count } info { id } }", 10, 10.0),
+                ("query { info { text } }", 10, 7.0),
+            ]:
+                yield subgraph, query, count, avg_time
+
+        with mock.patch("autoagora.model_builder.LogsDB") as logs_db_mock:
+            logs_db_mock.return_value.get_most_frequent_queries = mock.AsyncMock(
+                return_value=[
+                    LogsDB.QueryStats(
+                        query="query{values{id}}",
+                        count=100,
+                        min_time=1,
+                        max_time=60,
+                        avg_time=1.5,
+                        stddev_time=0.5,
+                    )
+                ]
+            )
+            logs_db_mock.return_value.get_long_tail_queries_bulk = (
+                long_tail_queries_bulk
+            )
+            model = AgoraModel(await model_builder(subgraph, mock.MagicMock()))
+
+        # Frequent shape first, then the fitted root fields, then the default
+        assert model.cost("{ values { id } }") == pytest.approx(1.5)
+        assert model.cost("{ values(first: 5) { count } }") == pytest.approx(3.0)
+        assert model.cost("{ info { id text } }") == pytest.approx(7.0)
+        assert model.cost("{ other { id } }") == pytest.approx(50)
@@ -0,0 +1,151 @@
+import asyncio as aio
+import json
+from datetime import timedelta
+from unittest import mock
+
+import psycopg_pool
+import pytest
+
+from autoagora.logs_db import LogsDB
+from autoagora.model_rebuild_trigger import ModelRebuildTrigger
+from autoagora.query_logs_ingestion import QueryLogsIngestor
+from autoagora.schema_migrations import migrate
+
+SUBGRAPH = "QmPnu3R7Fm4RmBF21aCYUohDmWbKd3VMXo64ACiRtwUQrn"
+OTHER_SUBGRAPH = "QmTJBvvpknMow6n4YU8R9Swna6N8mHK8N2WufetysBiyuL"
+
+
+async def ingest(pgpool, subgraph, times):
+    lines = [
+        json.dumps(
+            dict(
+                subgraphDeployment=subgraph,
+                query="{ values { id } }",
+                responseTime=100,
+                time=time,
+            )
+        ).encode()
+        for time in times
+    ]
+
+    async def aiter():
+        for line in lines:
+            yield line
+
+    return await QueryLogsIngestor(pgpool).ingest(aiter())
+
+
+class TestModelRebuildTrigger:
+    @pytest.fixture
+    async def pgpool(self, postgresql):
+        conn_string = (
+            f"host={postgresql.info.host} "
+            f"dbname={postgresql.info.dbname} "
+            f"user={postgresql.info.user} "
+            f'password="{postgresql.info.password}" '
+            f"port={postgresql.info.port}"
+        )
+
+        pool = psycopg_pool.AsyncConnectionPool(
+            conn_string, min_size=2, max_size=10, open=False
+        )
+        await pool.open()
+        await pool.wait()
+        await migrate(pool)
+        await ingest(pool, SUBGRAPH, [1684446461000])
+        yield pool
+        await pool.close()
+
+    async def test_get_new_query_logs(self, pgpool):
+        logs_db = LogsDB(pgpool)
+        new_query_logs = await logs_db.get_new_query_logs(
+            {SUBGRAPH: None, OTHER_SUBGRAPH: None}
+        )
+        assert new_query_logs[SUBGRAPH][0] == 1
+        assert new_query_logs[OTHER_SUBGRAPH] == (0, None)
+
+        high_water_mark = new_query_logs[SUBGRAPH][1]
+        await ingest(pgpool, SUBGRAPH, [1684446461000, 1684446462000])
+        assert await logs_db.get_new_query_logs({SUBGRAPH: high_water_mark}) == {
+            SUBGRAPH: (1, high_water_mark + timedelta(seconds=1))
+        }
+
+    async def test_wait(self, pgpool):
+        trigger = ModelRebuildTrigger(
+            LogsDB(pgpool), threshold=2, check_interval=timedelta(seconds=0.1)
+        )
+        # Never built
+        assert await trigger.wait(lambda: [SUBGRAPH, OTHER_SUBGRAPH]) == {
+            SUBGRAPH,
+            OTHER_SUBGRAPH,
+        }
+        # Still due until their rebuild is committed
+        assert await trigger.wait(lambda: [SUBGRAPH, OTHER_SUBGRAPH]) == {
+            SUBGRAPH,
+            OTHER_SUBGRAPH,
+        }
+        await trigger.commit([SUBGRAPH, OTHER_SUBGRAPH])
+
+        # Below the threshold
+        await ingest(pgpool, SUBGRAPH, [1684446462000])
+        with pytest.raises(aio.TimeoutError):
+            await aio.wait_for(trigger.wait(lambda: [SUBGRAPH, OTHER_SUBGRAPH]), 0.5)
+
+        await ingest(pgpool, SUBGRAPH, [1684446463000])
+        assert await trigger.wait(lambda: [SUBGRAPH, OTHER_SUBGRAPH]) == {SUBGRAPH}
+        await trigger.commit([SUBGRAPH])
+        with pytest.raises(aio.TimeoutError):
+            await aio.wait_for(trigger.wait(lambda: [SUBGRAPH, OTHER_SUBGRAPH]), 0.5)
+
+        # Maximum interval
+        trigger.max_interval = timedelta(seconds=0.2)
+        await aio.sleep(0.2)
+        assert await trigger.wait(lambda: [SUBGRAPH, OTHER_SUBGRAPH]) == {
+            SUBGRAPH,
+            OTHER_SUBGRAPH,
+        }
+
+    async def test_restart(self, pgpool):
+        trigger = ModelRebuildTrigger(
+            LogsDB(pgpool), threshold=2, check_interval=timedelta(seconds=0.1)
+        )
+        assert await trigger.wait(lambda: [SUBGRAPH, OTHER_SUBGRAPH]) == {
+            SUBGRAPH,
+            OTHER_SUBGRAPH,
+        }
+        await trigger.commit([SUBGRAPH])
+
+        # Resumed from the persisted high-water mark: not due, and only the new
+        # query logs counted
+        trigger = ModelRebuildTrigger(
+            LogsDB(pgpool), threshold=2, check_interval=timedelta(seconds=0.1)
+        )
+        await ingest(pgpool, SUBGRAPH, [1684446462000])
+        with mock.patch.object(
+            trigger.logs_db,
+            "get_new_query_logs",
+            wraps=trigger.logs_db.get_new_query_logs,
+        ) as get_new_query_logs:
+            assert await trigger.check([SUBGRAPH, OTHER_SUBGRAPH]) == {OTHER_SUBGRAPH}
+        high_water_marks = get_new_query_logs.call_args.args[0]
+        assert high_water_marks[SUBGRAPH] is not None
+        assert high_water_marks[OTHER_SUBGRAPH] is None
+        assert trigger._new_query_logs[SUBGRAPH] == 1
+
+    async def test_listen(self, pgpool):
+        trigger = ModelRebuildTrigger(
+            LogsDB(pgpool), threshold=2, check_interval=timedelta(hours=1)
+        )
+        listener = aio.ensure_future(trigger.listen())
+        try:
+            assert await trigger.wait(lambda: [SUBGRAPH]) == {SUBGRAPH}
+            await trigger.commit([SUBGRAPH])
+            wait = aio.ensure_future(trigger.wait(lambda: [SUBGRAPH]))
+            await aio.sleep(0.2)
+            assert not wait.done()
+
+            # Woken up by the ingestion's notification, not the hourly check
+            await ingest(pgpool, SUBGRAPH, [1684446462000, 1684446463000])
+            assert await aio.wait_for(wait, 5) == {SUBGRAPH}
+        finally:
+            listener.cancel()
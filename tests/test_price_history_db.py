@@ -0,0 +1,93 @@
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+import psycopg_pool
+import pytest
+
+from autoagora.price_history_db import PriceHistoryDB
+from autoagora.schema_migrations import migrate
+
+SUBGRAPH = "QmTJBvvpknMow6n4YU8R9Swna6N8mHK8N2WufetysBiyuL"
+OTHER_SUBGRAPH = "QmPnu3R7Fm4RmBF21aCYUohDmWbKd3VMXo64ACiRtwUQrn"
+
+
+class TestPriceHistoryDB:
+    @pytest.fixture
+    async def pgpool(self, postgresql):
+        conn_string = (
+            f"host={postgresql.info.host} "
+            f"dbname={postgresql.info.dbname} "
+            f"user={postgresql.info.user} "
+            f'password="{postgresql.info.password}" '
+            f"port={postgresql.info.port}"
+        )
+
+        pool = psycopg_pool.AsyncConnectionPool(
+            conn_string, min_size=2, max_size=10, open=False
+        )
+        await pool.open()
+        await pool.wait()
+        await migrate(pool)
+        yield pool
+        await pool.close()
+
+    async def test_append_flush(self, pgpool):
+        phdb = PriceHistoryDB(pgpool)
+        start = datetime.now(timezone.utc)
+        for i in range(3):
+            phdb.append(SUBGRAPH, 1e-6 * i, 10.0 + i, 1e-5 * i, 1e-6, 0.1)
+        phdb.append(OTHER_SUBGRAPH, 2e-6, 5.0, 1e-5, 2e-6, 0.2)
+
+        # Buffered until flushed
+        assert await phdb.get_history(SUBGRAPH, start) == []
+        assert await phdb.flush() == 4
+        assert await phdb.flush() == 0
+
+        history = await phdb.get_history(SUBGRAPH, start)
+        assert [
+            (step.subgraph, step.price_multiplier, step.queries_per_second)
+            for step in history
+        ] == [(SUBGRAPH, 1e-6 * i, 10.0 + i) for i in range(3)]
+        assert all(step.timestamp >= start for step in history)
+        assert await phdb.get_history(SUBGRAPH, start, history[1].timestamp) == (
+            history[:1]
+        )
+
+    async def test_flush_failure(self, pgpool):
+        phdb = PriceHistoryDB(pgpool)
+        phdb.append(SUBGRAPH, 1e-6, 10.0, 1e-5, 1e-6, 0.1)
+        with mock.patch.object(phdb, "_write", side_effect=RuntimeError):
+            with pytest.raises(RuntimeError):
+                await phdb.flush()
+        phdb.append(SUBGRAPH, 2e-6, 10.0, 2e-5, 1e-6, 0.1)
+
+        # Written in order on the next flush
+        assert await phdb.flush() == 2
+        history = await phdb.get_history(
+            SUBGRAPH, datetime.min.replace(tzinfo=timezone.utc)
+        )
+        assert [step.price_multiplier for step in history] == [1e-6, 2e-6]
+
+    async def test_buffer_overflow(self, pgpool):
+        phdb = PriceHistoryDB(pgpool)
+        phdb.max_buffered_steps = 2
+        for i in range(3):
+            phdb.append(SUBGRAPH, float(i), 10.0, 1e-5, 1e-6, 0.1)
+        assert [step.price_multiplier for step in phdb._steps] == [1.0, 2.0]
+
+    async def test_expire(self, pgpool):
+        phdb = PriceHistoryDB(pgpool)
+        phdb.append(SUBGRAPH, 1e-6, 10.0, 1e-5, 1e-6, 0.1)
+        await phdb.flush()
+        async with pgpool.connection() as connection:
+            await connection.execute(
+                "UPDATE price_history SET timestamp = now() - interval '10 days'"
+            )
+        phdb.append(SUBGRAPH, 2e-6, 10.0, 2e-5, 1e-6, 0.1)
+        await phdb.flush()
+
+        assert await phdb.expire(timedelta(days=7)) == 1
+        history = await phdb.get_history(
+            SUBGRAPH, datetime.now(timezone.utc) - timedelta(days=30)
+        )
+        assert [step.price_multiplier for step in history] == [2e-6]
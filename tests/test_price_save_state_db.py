@@ -7,6 +7,7 @@ from autoagora_agents.agent_factory import AgentFactory
 from numpy.testing import assert_approx_equal
 
 from autoagora import price_save_state_db
+from autoagora.schema_migrations import migrate
 
 
 class TestPriceSaveStateDB:
@@ -25,6 +26,7 @@ class TestPriceSaveStateDB:
         )
         await pool.open()
         await pool.wait()
+        await migrate(pool)
         yield pool
         await pool.close()
 
@@ -0,0 +1,198 @@
+import json
+import os
+import tempfile
+from datetime import datetime, timezone
+from unittest import mock
+
+import psycopg_pool
+import pytest
+
+from autoagora.logs_db import LogsDB
+from autoagora.query_logs_ingestion import (
+    QueryLogsIngestor,
+    normalize_query,
+    parse_log_line,
+    read_lines,
+)
+from autoagora.schema_migrations import migrate
+
+SUBGRAPH = "QmPnu3R7Fm4RmBF21aCYUohDmWbKd3VMXo64ACiRtwUQrn"
+
+
+def log_line(query, response_time=100, **fields):
+    return (
+        json.dumps(
+            {
+                "subgraphDeployment": SUBGRAPH,
+                "query": query,
+                "responseTime": response_time,
+                "time": 1684446461000,
+                **fields,
+            }
+        ).encode()
+        + b"\n"
+    )
+
+
+async def aiter(iterable):
+    for item in iterable:
+        yield item
+
+
+class TestQueryLogsIngestion:
+    @pytest.fixture
+    async def pgpool(self, postgresql):
+        conn_string = (
+            f"host={postgresql.info.host} "
+            f"dbname={postgresql.info.dbname} "
+            f"user={postgresql.info.user} "
+            f'password="{postgresql.info.password}" '
+            f"port={postgresql.info.port}"
+        )
+
+        pool = psycopg_pool.AsyncConnectionPool(
+            conn_string, min_size=2, max_size=10, open=False
+        )
+        await pool.open()
+        await pool.wait()
+        await migrate(pool)
+        yield pool
+        await pool.close()
+
+    def test_normalize_query(self):
+        skeleton, skeleton_hash, literals = normalize_query(
+            """
+            query getValues($owner: String) {
+                values(first: 10, where: { id_gt: "a", owner: $owner }) {
+                    ...ValueFields
+                }
+            }
+            fragment ValueFields on Value { id name @include(if: true) }
+            """
+        )
+        assert skeleton == (
+            "query getValues($owner:String)"
+            "{values(first:$_0 where:{id_gt:$_1 owner:$owner})"
+            "{...on Value{id name@include(if:$_2)}}}"
+        )
+        assert literals == {"_0": 10, "_1": "a", "_2": True}
+
+        # Same skeleton whatever the literals and the formatting
+        assert normalize_query(
+            "query getValues($owner: String) { values(where: {owner: $owner, "
+            'id_gt: "b"}, first: 5) { ... on Value { name @include(if: false) id } '
+            "} }"
+        )[1] == (skeleton_hash)
+
+        assert normalize_query("query a { x } query b { y }", "b")[0] == "query b{y}"
+
+    def test_parse_log_line(self):
+        assert parse_log_line(
+            log_line(
+                "{ values(first: 5) { id } }",
+                response_time=12,
+                variables='{"x": 1}',
+            )
+        )[1:] == (
+            "query{values(first:$_0){id}}",
+            normalize_query("{ values(first: 5) { id } }")[1],
+            parse_log_line(log_line("{ values { id } }"))[3],
+            12,
+            '{"_0": 5, "x": 1}',
+        )
+        assert parse_log_line(log_line("{ values { id } }"))[5] is None
+
+        # Not query logs
+        assert parse_log_line(b'{"msg": "Listening on port 7600"}\n') is None
+        assert parse_log_line(b"not json\n") is None
+        assert parse_log_line(log_line("{ values { ")) is None
+        # Not fitting the query_logs columns
+        assert (
+            parse_log_line(log_line("{ values { id } }", subgraphDeployment="Qm" * 30))
+            is None
+        )
+        assert (
+            parse_log_line(log_line("{ values { id } }", response_time=2**40)) is None
+        )
+        assert parse_log_line(log_line("{ values { id } }", response_time=-1)) is None
+        assert parse_log_line(log_line("{ values { id } }", time=10**20)) is None
+
+    async def test_ingest(self, pgpool):
+        ingestor = QueryLogsIngestor(pgpool, batch_size=2)
+        lines = [
+            log_line("{ values(first: 5) { id } }", 100),
+            b"Listening on port 7600\n",
+            log_line("{ values(first: 10) { id } }", 200),
+            log_line("{ info { id } }", 50),
+        ]
+        assert await ingestor.ingest(aiter(lines)) == 3
+
+        mfq = await LogsDB(pgpool).get_most_frequent_queries(SUBGRAPH, min_count=1)
+        assert [(stats.query, stats.count, stats.avg_time) for stats in mfq] == [
+            ("query{values(first:$_0){id}}", 2, 150),
+            ("query{info{id}}", 1, 50),
+        ]
+        logged_queries = [
+            logged_query
+            async for logged_query in LogsDB(pgpool).iter_logged_queries(SUBGRAPH)
+        ]
+        assert ("query{values(first:$_0){id}}", {"_0": 10}) in logged_queries
+
+        # The known skeletons are not inserted again
+        assert await ingestor.ingest(aiter(lines)) == 3
+        assert not ingestor._new_skeletons
+        async with pgpool.connection() as connection:
+            cursor = await connection.execute("SELECT count(*) FROM query_skeletons")
+            assert await cursor.fetchone() == (2,)
+            cursor = await connection.execute("SELECT count(*) FROM query_logs")
+            assert await cursor.fetchone() == (6,)
+
+    async def test_ingest_write_failure(self, pgpool):
+        ingestor = QueryLogsIngestor(pgpool, batch_size=1)
+        write = ingestor._write
+        failures = [RuntimeError()]
+
+        async def fail_once(*args, **kwargs):
+            if failures:
+                raise failures.pop()
+            return await write(*args, **kwargs)
+
+        lines = [log_line("{ values { id } }"), log_line("{ info { id } }")]
+        with mock.patch.object(ingestor, "_write", side_effect=fail_once):
+            # The ingestion went on after the failed batch, which was written again
+            assert await ingestor.ingest(aiter(lines), flush_interval=0.01) == 2
+
+        async with pgpool.connection() as connection:
+            cursor = await connection.execute("SELECT count(*) FROM query_logs")
+            assert await cursor.fetchone() == (2,)
+
+    async def test_ingest_invalid_rows(self, pgpool):
+        ingestor = QueryLogsIngestor(pgpool, batch_size=10)
+        ingestor.add_line(log_line("{ values { id } }"))
+        # Rejected by the database
+        ingestor._rows.append(
+            (ingestor._rows[0][0], "Qm" * 30, datetime.now(timezone.utc), 100, None)
+        )
+
+        # The batch is dropped rather than buffered again, and the ingestion goes on
+        assert await ingestor.flush() == 0
+        assert not ingestor._rows
+        assert await ingestor.ingest(aiter([log_line("{ info { id } }")])) == 1
+
+        async with pgpool.connection() as connection:
+            cursor = await connection.execute("SELECT count(*) FROM query_logs")
+            assert await cursor.fetchone() == (1,)
+
+    async def test_read_lines(self):
+        lines = [log_line("{ values { id } }"), log_line("{ info { id } }")]
+
+        with tempfile.TemporaryFile() as file:
+            file.writelines(lines)
+            file.seek(0)
+            assert [line async for line in read_lines(file, chunk_size=1)] == lines
+
+        read_fd, write_fd = os.pipe()
+        with os.fdopen(read_fd, "rb") as pipe:
+            with os.fdopen(write_fd, "wb") as writer:
+                writer.writelines(lines)
+            assert [line async for line in read_lines(pipe)] == lines
@@ -0,0 +1,188 @@
+from datetime import datetime, timedelta, timezone
+
+import psycopg_pool
+import pytest
+
+from autoagora.logs_db import LogsDB
+from autoagora.query_logs_partitions import QueryLogsPartitions
+from autoagora.schema_migrations import migrate
+
+
+class TestQueryLogsPartitions:
+    @pytest.fixture
+    async def pgpool(self, postgresql):
+        conn_string = (
+            f"host={postgresql.info.host} "
+            f"dbname={postgresql.info.dbname} "
+            f"user={postgresql.info.user} "
+            f'password="{postgresql.info.password}" '
+            f"port={postgresql.info.port}"
+        )
+
+        pool = psycopg_pool.AsyncConnectionPool(
+            conn_string, min_size=2, max_size=10, open=False
+        )
+        await pool.open()
+        await pool.wait()
+        async with pool.connection() as conn:
+            await conn.execute(
+                """
+                CREATE TABLE query_skeletons (
+                    hash BYTEA PRIMARY KEY,
+                    query TEXT NOT NULL
+                )
+            """
+            )
+            await conn.execute(
+                """
+                CREATE TABLE query_logs (
+                    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+                    query_hash BYTEA REFERENCES query_skeletons(hash),
+                    subgraph CHAR(46) NOT NULL,
+                    timestamp TIMESTAMPTZ NOT NULL,
+                    query_time_ms INTEGER,
+                    query_variables TEXT
+                )
+            """
+            )
+            await conn.execute(
+                """
+                INSERT INTO query_skeletons (hash, query)
+                VALUES ('hash1', 'query getData{ values { id } }')
+            """
+            )
+            await conn.execute(
+                """
+                INSERT INTO query_logs (query_hash, subgraph, timestamp, query_time_ms)
+                VALUES ('hash1', 'QmPnu3R7Fm4RmBF21aCYUohDmWbKd3VMXo64ACiRtwUQrn', '2023-05-18T21:47:41+00:00', 100),
+                ('hash1', 'QmPnu3R7Fm4RmBF21aCYUohDmWbKd3VMXo64ACiRtwUQrn', now() - interval '1 hour', 200)
+            """
+            )
+        await migrate(pool)
+        yield pool
+        await pool.close()
+
+    async def test_maintain(self, pgpool):
+        partitions = QueryLogsPartitions(pgpool)
+        assert not await partitions.is_partitioned()
+
+        await partitions.maintain(premake=timedelta(days=3))
+        assert await partitions.is_partitioned()
+
+        today = datetime.now(timezone.utc).date()
+        names = [name for name, _ in await partitions.partitions()]
+        # The legacy partition holds today's rows
+        assert names == [
+            "query_logs_legacy",
+            QueryLogsPartitions.partition_name(today + timedelta(days=1)),
+            QueryLogsPartitions.partition_name(today + timedelta(days=2)),
+            QueryLogsPartitions.partition_name(today + timedelta(days=3)),
+            "query_logs_default",
+        ]
+
+        # Idempotent
+        await partitions.maintain(premake=timedelta(days=3))
+        assert [name for name, _ in await partitions.partitions()] == names
+
+        mfq = await LogsDB(pgpool).get_most_frequent_queries(
+            "QmPnu3R7Fm4RmBF21aCYUohDmWbKd3VMXo64ACiRtwUQrn",
+            min_count=1,
+            window=timedelta(days=1),
+        )
+        assert [(stats.count, stats.avg_time) for stats in mfq] == [(1, 200)]
+
+        async with pgpool.connection() as conn:
+            await conn.execute(
+                """
+                INSERT INTO query_logs (query_hash, subgraph, timestamp, query_time_ms)
+                VALUES ('hash1', 'QmPnu3R7Fm4RmBF21aCYUohDmWbKd3VMXo64ACiRtwUQrn', now() + interval '2 days', 10),
+                ('hash1', 'QmPnu3R7Fm4RmBF21aCYUohDmWbKd3VMXo64ACiRtwUQrn', now() + interval '1 year', 10)
+            """
+            )
+            cursor = await conn.execute(
+                "SELECT tableoid::regclass::text, count(*) FROM query_logs "
+                "GROUP BY 1 ORDER BY 1"
+            )
+            assert await cursor.fetchall() == [
+                ("query_logs_default", 1),
+                ("query_logs_legacy", 2),
+                (QueryLogsPartitions.partition_name(today + timedelta(days=2)), 1),
+            ]
+
+            # Partition pruning
+            cursor = await conn.execute(
+                "EXPLAIN SELECT count(*) FROM query_logs "
+                "WHERE timestamp >= now() + interval '2 days'"
+            )
+            plan = "\n".join(line for line, in await cursor.fetchall())
+            assert "query_logs_legacy" not in plan
+
+            # The schema migrations' indexes carried over to the partitioned table
+            cursor = await conn.execute(
+                """
+                SELECT
+                    indexrelid::regclass::text
+                FROM
+                    pg_index
+                WHERE
+                    indrelid = 'query_logs'::regclass
+                    AND NOT indisunique
+                ORDER BY
+                    1
+                """
+            )
+            assert await cursor.fetchall() == [
+                ("query_logs_subgraph_query_hash_idx",),
+                ("query_logs_subgraph_timestamp_idx",),
+            ]
+
+    @pytest.mark.parametrize("archive", [False, True])
+    async def test_expire_partitions(self, pgpool, archive):
+        partitions = QueryLogsPartitions(pgpool)
+        await partitions.maintain(premake=timedelta(days=1))
+
+        expired = await partitions.expire_partitions(
+            datetime.now(timezone.utc) + timedelta(days=1), archive
+        )
+        assert expired == ["query_logs_legacy"]
+        names = [name for name, _ in await partitions.partitions()]
+        assert "query_logs_legacy" not in names
+
+        async with pgpool.connection() as conn:
+            cursor = await conn.execute("SELECT to_regclass('query_logs_legacy')")
+            row = await cursor.fetchone()
+            assert (row[0] is not None) == archive
+
+    async def test_create_partitions_default_rows(self, pgpool):
+        partitions = QueryLogsPartitions(pgpool)
+        await partitions.maintain(premake=timedelta(days=1))
+
+        # Logged in the default partition, ahead of the created partitions
+        async with pgpool.connection() as conn:
+            await conn.execute(
+                """
+                INSERT INTO query_logs (query_hash, subgraph, timestamp, query_time_ms)
+                VALUES ('hash1', 'QmPnu3R7Fm4RmBF21aCYUohDmWbKd3VMXo64ACiRtwUQrn', now() + interval '3 days', 10),
+                ('hash1', 'QmPnu3R7Fm4RmBF21aCYUohDmWbKd3VMXo64ACiRtwUQrn', now() + interval '1 year', 10)
+            """
+            )
+
+        today = datetime.now(timezone.utc).date()
+        assert await partitions.create_partitions(
+            datetime.now(timezone.utc) + timedelta(days=3)
+        ) == [
+            QueryLogsPartitions.partition_name(today + timedelta(days=2)),
+            QueryLogsPartitions.partition_name(today + timedelta(days=3)),
+        ]
+        assert (await partitions.partitions())[-1][0] == "query_logs_default"
+
+        async with pgpool.connection() as conn:
+            cursor = await conn.execute(
+                "SELECT tableoid::regclass::text, count(*) FROM query_logs "
+                "WHERE timestamp > now() GROUP BY 1 ORDER BY 1"
+            )
+            # Moved to their new partition
+            assert await cursor.fetchall() == [
+                ("query_logs_default", 1),
+                (QueryLogsPartitions.partition_name(today + timedelta(days=3)), 1),
+            ]
@@ -1,10 +1,57 @@
 import asyncio
+from collections import defaultdict
+from datetime import timedelta
+from unittest import mock
 
+import pytest
 import vcr
+from aiohttp import web
+from prometheus_client import REGISTRY
 
 import autoagora.query_metrics
 from autoagora.config import args, init_config
-from autoagora.query_metrics import StaticMetricsEndpoints
+from autoagora.query_metrics import (
+    HTTPError,
+    K8SServiceWatcherMetricsEndpoints,
+    QueryCounts,
+    StaticMetricsEndpoints,
+    query_rate,
+    subgraph_query_counts,
+)
+
+SUBGRAPH = "Qmadj8x9km1YEyKmRnJ6EkC2zpJZFCfTyTZpuqC3j6e1QH"
+
+
+def sample_value(name, labels=None):
+    return REGISTRY.get_sample_value(name, labels or {}) or 0
+
+
+@pytest.fixture
+async def indexer_service_pods():
+    """Serves the metrics of fake indexer-service pods, on /pods/<i>/metrics: pod 0
+    answers, pod 1 fails, pod 2 hangs, and pod 3 only hangs on its first request."""
+    requests = defaultdict(int)
+
+    async def metrics(request: web.Request):
+        pod = int(request.match_info["pod"])
+        requests[pod] += 1
+        if pod == 1:
+            return web.Response(status=500)
+        if pod == 2 or (pod == 3 and requests[pod] == 1):
+            await asyncio.sleep(60)
+        return web.Response(
+            text=f'indexer_service_queries_ok{{deployment="{SUBGRAPH}"}} {pod * 100}\n'
+        )
+
+    app = web.Application()
+    app.router.add_get("/pods/{pod}/metrics", metrics)
+    runner = web.AppRunner(app, handler_cancellation=True)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    yield [f"http://127.0.0.1:{port}/pods/{pod}/metrics" for pod in range(4)]
+    await runner.cleanup()
 
 
 class TestQueryMetrics:
@@ -30,11 +77,13 @@ class TestQueryMetrics:
 
         with vcr.use_cassette("vcr_cassettes/test_subgraph_query_count.yaml"):
             res = asyncio.run(
-                autoagora.query_metrics.subgraph_query_count(
+                autoagora.query_metrics.subgraph_query_counts(
                     "Qmadj8x9km1YEyKmRnJ6EkC2zpJZFCfTyTZpuqC3j6e1QH", metrics_endpoints
                 )
             )
-        assert res == 938
+        assert res.counts == {
+            "http://indexer-service.default.svc.cluster.local:7300/metrics": 938
+        }
 
     def test_subgraph_query_count_multiple_endpoints(self):
         init_config(
@@ -60,8 +109,84 @@ class TestQueryMetrics:
             "vcr_cassettes/test_subgraph_query_count_multiple_endpoints.yaml"
         ):
             res = asyncio.run(
-                autoagora.query_metrics.subgraph_query_count(
+                autoagora.query_metrics.subgraph_query_counts(
                     "Qmadj8x9km1YEyKmRnJ6EkC2zpJZFCfTyTZpuqC3j6e1QH", metrics_endpoints
                 )
             )
-        assert res == 2607
+        assert not res.stale
+        assert sum(res.counts.values()) == 2607
+
+    async def test_subgraph_query_counts_stale(self, indexer_service_pods):
+        scrapes = {
+            outcome: sample_value(
+                "indexer_service_metrics_scrape_seconds_count", {"outcome": outcome}
+            )
+            for outcome in ("ok", "error", "cancelled")
+        }
+        metrics_endpoints = StaticMetricsEndpoints(",".join(indexer_service_pods[:3]))
+        query_counts = await subgraph_query_counts(
+            SUBGRAPH,
+            metrics_endpoints,
+            timeout=timedelta(seconds=0.5),
+            hedge_delay=timedelta(seconds=0.1),
+        )
+        # The failing and hanging pods do not fail the others' counts
+        assert query_counts.counts == {indexer_service_pods[0]: 0}
+        assert query_counts.stale == indexer_service_pods[1:3]
+        assert (
+            sample_value(
+                "indexer_service_metrics_stale_endpoints", {"subgraph": SUBGRAPH}
+            )
+            == 2
+        )
+        # The hanging pod's request, and its hedge
+        assert {
+            outcome: sample_value(
+                "indexer_service_metrics_scrape_seconds_count", {"outcome": outcome}
+            )
+            - count
+            for outcome, count in scrapes.items()
+        } == {"ok": 1, "error": 1, "cancelled": 2}
+        assert metrics_endpoints.stats[indexer_service_pods[0]].latency is not None
+        assert metrics_endpoints.stats[indexer_service_pods[1]].last_success is None
+
+    async def test_subgraph_query_counts_hedged(self, indexer_service_pods):
+        hedged_scrapes = sample_value("indexer_service_metrics_hedged_scrapes_total")
+        query_counts = await asyncio.wait_for(
+            subgraph_query_counts(
+                SUBGRAPH,
+                StaticMetricsEndpoints(indexer_service_pods[3]),
+                hedge_delay=timedelta(seconds=0.1),
+            ),
+            # Well within the timeout of the first request
+            timeout=2,
+        )
+        assert query_counts.counts == {indexer_service_pods[3]: 300}
+        assert (
+            sample_value("indexer_service_metrics_hedged_scrapes_total")
+            == hedged_scrapes + 1
+        )
+
+    def test_query_rate(self):
+        first = QueryCounts(["a", "b", "c"], {"a": 10, "b": 10, "c": 10})
+        # "b" restarted, "c" is stale, and "d" was not there at the first count
+        second = QueryCounts(["a", "b", "c", "d"], {"a": 20, "b": 5, "d": 50})
+        # Extrapolated from "a" to the 3 pods there for the whole duration
+        assert query_rate(first, second, 2) == 15
+
+        with pytest.raises(HTTPError):
+            query_rate(first, QueryCounts(["a"], {}), 2)
+        assert query_rate(QueryCounts([], {}), QueryCounts([], {}), 2) == 0
+
+    def test_k8s_service_watcher_metrics_endpoints(self):
+        with mock.patch.object(
+            autoagora.query_metrics, "K8SServiceEndpointSlicesWatcher"
+        ) as watcher:
+            watcher.return_value.endpoint_ips = ["10.0.0.1", "fd00::1"]
+            metrics_endpoints = K8SServiceWatcherMetricsEndpoints(
+                "http://indexer-service:7300/metrics", endpoint_slices=True
+            )
+            assert metrics_endpoints() == [
+                "http://10.0.0.1:7300/metrics",
+                "http://[fd00::1]:7300/metrics",
+            ]
@@ -0,0 +1,171 @@
+import asyncio as aio
+
+import psycopg_pool
+import pytest
+
+from autoagora.schema_migrations import MIGRATIONS, Migration, migrate
+
+
+class TestSchemaMigrations:
+    @pytest.fixture
+    async def pgpool(self, postgresql):
+        conn_string = (
+            f"host={postgresql.info.host} "
+            f"dbname={postgresql.info.dbname} "
+            f"user={postgresql.info.user} "
+            f'password="{postgresql.info.password}" '
+            f"port={postgresql.info.port}"
+        )
+
+        pool = psycopg_pool.AsyncConnectionPool(
+            conn_string, min_size=2, max_size=10, open=False
+        )
+        await pool.open()
+        await pool.wait()
+        yield pool
+        await pool.close()
+
+    async def test_migrate(self, pgpool):
+        versions = [migration.version for migration in MIGRATIONS]
+        assert await migrate(pgpool) == versions
+        # Already applied
+        assert await migrate(pgpool) == []
+
+        async with pgpool.connection() as connection:
+            cursor = await connection.execute(
+                "SELECT version FROM schema_migrations ORDER BY version"
+            )
+            assert [version for version, in await cursor.fetchall()] == versions
+            cursor = await connection.execute(
+                """
+                SELECT
+                    indexrelid::regclass::text
+                FROM
+                    pg_index
+                WHERE
+                    indrelid = 'query_logs'::regclass
+                    AND indisvalid
+                    AND NOT indisprimary
+                ORDER BY
+                    1
+                """
+            )
+            assert await cursor.fetchall() == [
+                ("query_logs_subgraph_query_hash_idx",),
+                ("query_logs_subgraph_timestamp_idx",),
+            ]
+
+    async def test_migrate_without_query_logs(self, pgpool):
+        assert await migrate(pgpool, query_logs=False) == [
+            migration.version for migration in MIGRATIONS if not migration.query_logs
+        ]
+        async with pgpool.connection() as connection:
+            cursor = await connection.execute("SELECT to_regclass('query_logs')")
+            assert await cursor.fetchone() == (None,)
+
+        # Applied once the query logs are used
+        assert await migrate(pgpool) == [
+            migration.version for migration in MIGRATIONS if migration.query_logs
+        ]
+
+    async def test_migrate_background(self, pgpool):
+        assert await migrate(pgpool, background=False) == [
+            migration.version for migration in MIGRATIONS if not migration.background
+        ]
+        assert await migrate(pgpool, background=True) == [
+            migration.version for migration in MIGRATIONS if migration.background
+        ]
+        assert await migrate(pgpool) == []
+
+    async def test_migrate_partitioned(self, pgpool):
+        async with pgpool.connection() as connection:
+            await connection.execute(
+                """
+                CREATE TABLE query_skeletons (
+                    hash        bytea   PRIMARY KEY,
+                    query       text    NOT NULL
+                )
+                """
+            )
+            await connection.execute(
+                """
+                CREATE TABLE query_logs (
+                    id              uuid        DEFAULT gen_random_uuid(),
+                    query_hash      bytea       REFERENCES query_skeletons(hash),
+                    subgraph        char(46)    NOT NULL,
+                    timestamp       timestamptz NOT NULL,
+                    query_time_ms   integer,
+                    query_variables text
+                ) PARTITION BY RANGE (timestamp)
+                """
+            )
+            await connection.execute(
+                """
+                CREATE TABLE query_logs_p20230518 PARTITION OF query_logs
+                FOR VALUES FROM ('2023-05-18') TO ('2023-05-19')
+                """
+            )
+            await connection.execute(
+                "CREATE TABLE query_logs_default PARTITION OF query_logs DEFAULT"
+            )
+            await connection.commit()
+
+        await migrate(pgpool)
+
+        async with pgpool.connection() as connection:
+            cursor = await connection.execute(
+                """
+                SELECT
+                    indrelid::regclass::text,
+                    indexrelid::regclass::text
+                FROM
+                    pg_index
+                WHERE
+                    indrelid IN (
+                        'query_logs'::regclass,
+                        'query_logs_p20230518'::regclass,
+                        'query_logs_default'::regclass
+                    )
+                    AND indisvalid
+                ORDER BY
+                    1, 2
+                """
+            )
+            assert await cursor.fetchall() == [
+                ("query_logs", "query_logs_subgraph_query_hash_idx"),
+                ("query_logs", "query_logs_subgraph_timestamp_idx"),
+                ("query_logs_default", "query_logs_default_subgraph_query_hash_idx"),
+                ("query_logs_default", "query_logs_default_subgraph_timestamp_idx"),
+                (
+                    "query_logs_p20230518",
+                    "query_logs_p20230518_subgraph_query_hash_idx",
+                ),
+                ("query_logs_p20230518", "query_logs_p20230518_subgraph_timestamp_idx"),
+            ]
+
+    async def test_migrate_concurrently(self, pgpool):
+        # Each migration applied once, by a single instance
+        results = await aio.gather(*(migrate(pgpool) for _ in range(2)))
+        assert sorted(results, key=len) == [
+            [],
+            [migration.version for migration in MIGRATIONS],
+        ]
+
+    async def test_migrate_failure(self, pgpool):
+        async def fail(connection):
+            await connection.execute("CREATE TABLE half_applied (id integer)")
+            raise RuntimeError()
+
+        migrations = MIGRATIONS[:1] + [Migration(2, "Fail", fail)]
+        with pytest.raises(RuntimeError):
+            await migrate(pgpool, migrations)
+
+        async with pgpool.connection() as connection:
+            # The failed migration was rolled back, and is applied again next time
+            cursor = await connection.execute(
+                "SELECT to_regclass('half_applied') IS NULL"
+            )
+            assert await cursor.fetchone() == (True,)
+        assert await migrate(pgpool) == [
+            migration.version for migration in MIGRATIONS[1:]
+        ]
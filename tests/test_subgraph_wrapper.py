@@ -1,8 +1,18 @@
 from unittest import mock
 
+from prometheus_client import REGISTRY
+
+from autoagora.query_metrics import QueryCounts
 from autoagora.subgraph_wrapper import SubgraphWrapper
 
 
+def stage_count(stage):
+    return (
+        REGISTRY.get_sample_value("bandit_cycle_stage_seconds_count", {"stage": stage})
+        or 0
+    )
+
+
 class TestSubgraphWrapper:
     async def test_set_cost_multiplier(self):
         subgraph = "QmTJBvvpknMow6n4YU8R9Swna6N8mHK8N2WufetysBiyuL"
@@ -19,7 +29,12 @@ class TestSubgraphWrapper:
 
                     mock_time.return_value = 10003.0
 
+                    set_cost_multiplier_count = stage_count("set_cost_multiplier")
                     await subgraph_wrapper.set_cost_multiplier(cost_multiplier)
+                    assert (
+                        stage_count("set_cost_multiplier")
+                        == set_cost_multiplier_count + 1
+                    )
 
                     mock_get_cost_variables.assert_called_once_with(subgraph)
                     mock_set_cost_model.assert_called_once_with(
@@ -35,19 +50,26 @@ class TestSubgraphWrapper:
         ) as mock_metric_endpoints_class:
             mock_metric_endpoint_obj = mock_metric_endpoints_class.return_value
             with mock.patch(
-                "autoagora.subgraph_wrapper.subgraph_query_count"
-            ) as mock_subgraph_query_count:
+                "autoagora.subgraph_wrapper.subgraph_query_counts"
+            ) as mock_subgraph_query_counts:
                 with mock.patch("autoagora.subgraph_wrapper.time") as mock_time:
 
                     mock_time.side_effect = [4, 8]
-                    mock_subgraph_query_count.side_effect = [2, 6]
+                    mock_subgraph_query_counts.side_effect = [
+                        QueryCounts(["a"], {"a": 2}),
+                        QueryCounts(["a"], {"a": 6}),
+                    ]
 
+                    query_count_count = stage_count("query_count")
+                    observation_count = stage_count("observation")
                     qps = await subgraph_wrapper.queries_per_second(
                         mock_metric_endpoint_obj, 0.1
                     )
 
-                    mock_subgraph_query_count.assert_called_with(
+                    mock_subgraph_query_counts.assert_called_with(
                         subgraph, mock_metric_endpoint_obj
                     )
-                    assert mock_subgraph_query_count.call_count == 2
+                    assert mock_subgraph_query_counts.call_count == 2
+                    assert stage_count("query_count") == query_count_count + 2
+                    assert stage_count("observation") == observation_count + 1
                     assert qps == 1